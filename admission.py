@@ -0,0 +1,74 @@
+"""Resource estimates for pipeline stages, used to admit jobs against the node's budget.
+
+estimate() sizes a stage from the slide's level-0 dimensions, read from the
+header, so nothing is decoded. The numbers are deliberately rough upper
+bounds: they only have to keep concurrent stages from overcommitting RAM,
+and every constant can be tuned from measured peaks (see /metrics).
+"""
+import os, logging
+import tuning
+from slide_reader import slide_dimensions
+
+# node budget the job queue admits stages against
+RAM_BUDGET_BYTES = int(os.environ.get('RAM_BUDGET_BYTES', tuning.available_memory() * 0.8))
+CPU_BUDGET = int(os.environ.get('CPU_BUDGET', tuning.available_cores()))
+
+# interpreter, numpy, OpenSlide and pyvips in a fresh stage process or pool worker
+PROCESS_BASE_BYTES = 400 * 1024 ** 2
+# segmentor weights, torch and the tiatoolbox engine in the predict process
+MODEL_BASE_BYTES = 2 * 1024 ** 3
+# cores reserved for a predict/process stage; the stage gets the reservation (tia.py --cpus) and
+# splits it between torch threads, loader/post-processing workers and the count/overlay workers
+PREDICT_CPUS = int(os.environ.get('PREDICT_CPUS', max(1, tuning.available_cores() // 2)))
+# inference settings a request can set explicitly, their sum is reserved when above PREDICT_CPUS
+PREDICT_THREAD_SETTINGS = ["torch_threads", "num_loader_workers", "num_postproc_workers"]
+PATCH_SIZE = 1024
+# whole-slide mode holds every nucleus of the slide in memory before it is stored
+WSI_TISSUE_FRACTION = 0.5
+PIXELS_PER_NUCLEUS = 400
+BYTES_PER_NUCLEUS = 1024
+# merge shrinks tiles in 4 threads and keeps the background plus the mosaic at output scale
+MERGE_THREADS = 4
+PYRAMID_BYTES = 1024 ** 3
+
+
+def predict_cpus(options=None):
+    """Cores reserved for a predict/process stage, never more than the node's budget."""
+    options = options or {}
+    explicit = sum(options.get(name) or 0 for name in PREDICT_THREAD_SETTINGS)
+    return max(1, min(CPU_BUDGET, max(PREDICT_CPUS, explicit)))
+
+
+def estimate(stage, file_path, options=None):
+    """{"ram_bytes": ..., "cpus": ...} a stage of this slide is expected to hold at its peak."""
+    options = options or {}
+    try:
+        width, height = slide_dimensions(file_path)
+    except Exception as e:
+        # an unreadable slide fails fast in the stage itself, admit it at the base cost
+        logging.warning(f"Could not read dimensions of {file_path} for admission: {e}")
+        width, height = PATCH_SIZE, PATCH_SIZE
+
+    if stage == "patch":
+        workers = options.get("workers", 1)
+        # every worker holds a tile row of the band it is reading
+        band_bytes = PATCH_SIZE * width * 3
+        return {"ram_bytes": PROCESS_BASE_BYTES + workers * (PROCESS_BASE_BYTES + band_bytes), "cpus": workers}
+
+    if stage in ("predict", "process"):
+        # calibration never picks a CPU batch above tuning.CPU_MAX_BATCH_SIZE
+        batch_size = options.get("batch_size") or tuning.CPU_MAX_BATCH_SIZE
+        ram_bytes = MODEL_BASE_BYTES + batch_size * tuning.CPU_BYTES_PER_SAMPLE
+        if options.get("mode") == "wsi":
+            ram_bytes += int(width * height * WSI_TISSUE_FRACTION / PIXELS_PER_NUCLEUS * BYTES_PER_NUCLEUS)
+        return {"ram_bytes": ram_bytes, "cpus": predict_cpus(options)}
+
+    if stage == "merge":
+        scale = options.get("scale", 0.1)
+        # background and mosaic at output scale, RGBA
+        ram_bytes = PROCESS_BASE_BYTES + int(2 * width * height * scale ** 2 * 4)
+        if options.get("pyramid"):
+            ram_bytes += PYRAMID_BYTES
+        return {"ram_bytes": ram_bytes, "cpus": MERGE_THREADS}
+
+    raise ValueError(f"Unknown stage: {stage}")
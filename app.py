@@ -1,19 +1,46 @@
-import os, sys, logging
-from flask import Flask, flash, request, redirect, url_for, render_template, send_from_directory, jsonify
+import os, sys, json, time, logging
+from flask import Flask, flash, request, redirect, url_for, render_template, send_from_directory, jsonify, make_response, Response
 from werkzeug.utils import secure_filename
 import subprocess
+import inference_worker
+from jobs import JobQueue
+from batch import BatchScheduler
+import admission
+from chunked_upload import ChunkedUploads, UploadError, DEFAULT_CHUNK_SIZE
+import result_cache
+import tile_store
+import spatial_index
+import pyramid
+import overlay_tiles
+import metrics
+import progress
 
-#external python scripts
-patch_script_path = "patch.py"
-predict_script_path = "predict.py"
-merge_script_path = "merge.py"
+#command line the stages run through, each request starts it in a fresh process
+cli_script_path = "tia.py"
 
 #upload
 UPLOAD_FOLDER = '/mnt/c/Users/haslina.makmur/OneDrive - Cancer Research Malaysia/Documents/TIA_GUI/tia/uploads'
 ALLOWED_EXTENSIONS = {'bif', 'svs', 'tif'}
 
+#default number of patch extraction worker processes
+PATCH_WORKERS = int(os.environ.get('PATCH_WORKERS', 1))
+#how many patch/predict/merge stages may run at the same time, within the RAM/CPU budget in admission.py
+MAX_CONCURRENT_STAGES = int(os.environ.get('MAX_CONCURRENT_STAGES', 2))
+#batch requests may name folders below this directory
+BATCH_ROOT = os.environ.get('BATCH_ROOT', UPLOAD_FOLDER)
+#stages a batch runs when the request does not list them
+BATCH_STAGES = ["patch", "predict", "merge"]
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['PATCH_WORKERS'] = PATCH_WORKERS
+app.config['MAX_CONCURRENT_STAGES'] = MAX_CONCURRENT_STAGES
+app.config['BATCH_ROOT'] = BATCH_ROOT
+
+job_queue = JobQueue(max_workers=app.config['MAX_CONCURRENT_STAGES'], ram_budget=admission.RAM_BUDGET_BYTES,
+                     cpu_budget=admission.CPU_BUDGET)
+chunked_uploads = ChunkedUploads(app.config['UPLOAD_FOLDER'])
+stage_metrics = metrics.MetricsAggregator()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -49,59 +76,136 @@ def upload_file():
             })
     return jsonify({"success": False, "message": "Invalid file type"})
 
-@app.route('/patch', methods=['POST'])
-def patch_file():
-    data = request.get_json()
-    filename = data.get('filename')
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename') or '')
 
-    if not filename:
-        return jsonify({
-            "success": False, 
-            "message": "No filename provided"
-        })
-    
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not filename or not allowed_file(filename):
+        return jsonify({"success": False, "message": "Invalid file type"})
+    try:
+        state = chunked_uploads.init(filename, int(data.get('size', 0)),
+                                     int(data.get('chunk_size', DEFAULT_CHUNK_SIZE)))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "size and chunk_size must be integers"})
+    except UploadError as e:
+        return jsonify({"success": False, "message": str(e)})
+    return jsonify(dict(state, success=True))
 
-    if not os.path.exists(file_path):
-        return jsonify({
-            "success": False, 
-            "message": "File not found"
-        })
-    
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    try:
+        state = chunked_uploads.status(upload_id)
+    except UploadError as e:
+        return jsonify({"success": False, "message": str(e)}), 404
+    return jsonify(dict(state, success=True))
+
+@app.route('/upload/<upload_id>/chunk/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    try:
+        state, chunk_sha256 = chunked_uploads.write_chunk(
+            upload_id, index, request.stream, request.headers.get('X-Chunk-SHA256'))
+    except UploadError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({
+        "success": True,
+        "index": index,
+        "sha256": chunk_sha256,
+        "received": len(state["received"]),
+        "total_chunks": state["total_chunks"]
+    })
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    try:
+        file_path, sha256 = chunked_uploads.finalize(upload_id)
+    except UploadError as e:
+        return jsonify({"success": False, "message": str(e)})
+    return jsonify({
+        "success": True,
+        "filename": os.path.basename(file_path),
+        "sha256": sha256,
+        "message": "File uploaded successfully"
+    })
+
+def run_script(filename, command, failure_message):
+    """Run one pipeline script to completion, returns the endpoint style result dict."""
     try:
 
         #file_id = os.path.splitext(filename)[0]
 
         result = subprocess.run(
-            ["python", patch_script_path, file_path],
+            command,
             capture_output=True,
             text=True,
             check=True)
-        return jsonify({
+        return {
             "success": True, 
             "filename": filename,
             "output": result.stdout
-        })
+        }
     except subprocess.CalledProcessError as e:
-        return jsonify({
+        return {
             "success": False,
-            "message": "Patching failed",
+            "message": failure_message,
             "error": e.stderr
-        })
+        }
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": "An unexpected error occurred",
             "error": str(e)
-        })
+        }
 
-@app.route('/predict', methods=['POST'])
-def predict_file():
-    data = request.get_json()
-    filename = data.get('filename')
+# /predict body keys that override the auto-tuned inference settings, with their tia.py predict flags
+PREDICT_OVERRIDES = {
+    "device": ("--device", str),
+    "batch_size": ("--batch-size", int),
+    "num_loader_workers": ("--loader-workers", int),
+    "num_postproc_workers": ("--postproc-workers", int),
+    "torch_threads": ("--torch-threads", int),
+}
+
+def predict_overrides(data):
+    """Inference setting overrides from a request body, raises ValueError on bad values."""
+    overrides = {}
+    for name, (_, cast) in PREDICT_OVERRIDES.items():
+        if data.get(name) is not None:
+            overrides[name] = cast(data[name])
+    if overrides.get("device") not in (None, "auto", "cpu") and not overrides["device"].startswith("cuda"):
+        raise ValueError("device must be auto, cpu or cuda")
+    if any(value < 1 for name, value in overrides.items() if name != "device"):
+        raise ValueError("worker, thread and batch counts must be positive")
+    return overrides
+
+def run_predict(filename, file_path, overrides=None, mode="tile", overlays=True, cpus=None):
+    overrides = overrides or {}
+    # a running inference worker already has the model loaded, so use it when it answers
+    if inference_worker.health() is not None:
+        try:
+            result = inference_worker.submit_job(file_path, dict(overrides, cpus=cpus), mode, overlays)
+            result["filename"] = filename
+            return result
+        except (OSError, EOFError, inference_worker.AuthkeyError) as e:
+            logging.warning(f"Inference worker unavailable, running tia.py predict instead: {e}")
+
+    command = ["python", cli_script_path, "predict", file_path]
+    for name, value in overrides.items():
+        command += [PREDICT_OVERRIDES[name][0], str(value)]
+    command += ["--mode", mode]
+    if cpus:
+        # the cores admission reserved, torch and every worker pool of the stage stay within them
+        command += ["--cpus", str(cpus)]
+    if not overlays:
+        command.append("--no-overlays")
+    return run_script(filename, command, "Predicting failed")
+
+def uploaded_file_path(data):
+    """Resolve the request's filename in the upload folder, returns (filename, file_path, error response)."""
+    filename = data.get('filename') if data else None
 
     if not filename:
-        return jsonify({
+        return None, None, jsonify({
             "success": False, 
             "message": "No filename provided"
         })
@@ -109,83 +213,456 @@ def predict_file():
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
     if not os.path.exists(file_path):
-        return jsonify({
+        return filename, None, jsonify({
             "success": False, 
             "message": "File not found"
         })
-    
+    return filename, file_path, None
+
+def output_name(filename):
+    # same naming the pipeline scripts use for uploads/<file_id_name>/
+    return f"{os.path.splitext(os.path.basename(filename))[0]}_Vaha"
+
+def patch_spec(data, filename, file_path):
+    """(cache params, admission options, runner, runner args) of a patch job, raises ValueError on bad input."""
     try:
+        workers = int(data.get('workers', app.config['PATCH_WORKERS']))
+    except (TypeError, ValueError):
+        workers = 0
+    if workers < 1:
+        raise ValueError("workers must be a positive integer")
 
-        #file_id = os.path.splitext(filename)[0]
+    command = ["python", cli_script_path, "patch", file_path, "--workers", str(workers)]
+    threshold_std = None
+    if data.get('threshold_std') is not None:
+        try:
+            threshold_std = float(data['threshold_std'])
+        except (TypeError, ValueError):
+            raise ValueError("threshold_std must be a number")
+        command += ["--threshold-std", str(threshold_std)]
 
-        result = subprocess.run(
-            ["python", predict_script_path, file_path],
-            capture_output=True,
-            text=True,
-            check=True)
+    # how the cell patches are stored, quality only changes jpeg tiles
+    codec = data.get('codec', tile_store.DEFAULT_CODEC)
+    if codec not in tile_store.CODECS:
+        raise ValueError(f"codec must be one of {', '.join(tile_store.CODECS)}")
+    quality = None
+    if codec == "jpeg":
+        try:
+            quality = int(data.get('quality', tile_store.DEFAULT_QUALITY))
+        except (TypeError, ValueError):
+            quality = 0
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be an integer between 1 and 100")
+        command += ["--quality", str(quality)]
+    command += ["--codec", codec]
+    return ({"threshold_std": threshold_std, "codec": codec, "quality": quality}, {"workers": workers},
+            run_script, (filename, command, "Patching failed"))
+
+def predict_spec(data, filename, file_path):
+    try:
+        overrides = predict_overrides(data)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid inference settings: {e}")
+
+    # tile: segment the patches from /patch, wsi: segment the whole slide inside its tissue mask
+    mode = data.get('mode', 'tile')
+    if mode not in ("tile", "wsi"):
+        raise ValueError("mode must be tile or wsi")
+
+    # device and batching change speed, not the segmentation, so they stay out of the cache key
+    # overlays can be skipped, the viewer renders them on demand from /slides/<filename>/render/...
+    overlays = data.get('overlays') is not False
+    options = dict(overrides, mode=mode)
+    return ({"mode": mode, "overlays": overlays}, options,
+            run_predict, (filename, file_path, overrides, mode, overlays, admission.predict_cpus(options)))
+
+def merge_spec(data, filename, file_path):
+    # size of the merged image relative to the slide
+    try:
+        scale = float(data.get('scale', 0.1))
+        if not 0 < scale <= 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError("scale must be a number in (0, 1]")
+
+    # full-resolution overlay for the tile viewer, dzi or tiff
+    pyramid_format = data.get('pyramid')
+    if pyramid_format not in [None] + pyramid.PYRAMID_FORMATS:
+        raise ValueError(f"pyramid must be one of {', '.join(pyramid.PYRAMID_FORMATS)}")
+
+    command = ["python", cli_script_path, "merge", file_path, "--scale", str(scale)]
+    if pyramid_format:
+        command += ["--pyramid", pyramid_format]
+    return ({"background": "thumbnail", "scale": scale, "pyramid": pyramid_format},
+            {"scale": scale, "pyramid": pyramid_format}, run_script, (filename, command, "Merging failed"))
+
+def process_spec(data, filename, file_path):
+    command = ["python", cli_script_path, "process", file_path]
+    if data.get('save_patches'):
+        command.append("--save-patches")
+    if data.get('overlays') is False:
+        command.append("--no-overlays")
+
+    command += ["--cpus", str(admission.predict_cpus())]
+
+    params = {"save_patches": bool(data.get('save_patches')), "overlays": data.get('overlays') is not False}
+    return params, {}, run_script, (filename, command, "Processing failed")
+
+STAGE_SPECS = {
+    "patch": patch_spec,
+    "predict": predict_spec,
+    "merge": merge_spec,
+    "process": process_spec,
+}
+
+def queue_stage(stage, filename, file_path, data, priority=0, on_done=None):
+    """Job id of the queued stage.
+
+    The result cache is consulted inside the job, so a hit is a short job that
+    restores the outputs, and the copy runs under the queue's admission rather
+    than in the request thread. Raises ValueError when the request body has bad
+    settings for the stage.
+    """
+    params, options, runner, args = STAGE_SPECS[stage](data, filename, file_path)
+    file_id_name = output_name(filename)
+    return job_queue.submit(stage, filename, result_cache.run_cached, stage, file_path, file_id_name,
+                            params, lambda: runner(*args), resources=admission.estimate(stage, file_path, options),
+                            priority=priority, on_done=on_done)
+
+def submit_stage(stage, filename, file_path, data):
+    """Queue the stage, its job restores the outputs when the result cache has them."""
+    try:
+        job_id = queue_stage(stage, filename, file_path, data)
+    except ValueError as e:
         return jsonify({
-            "success": True, 
-            "filename": filename,
-            "output": result.stdout
+            "success": False,
+            "message": str(e)
         })
-    except subprocess.CalledProcessError as e:
+    return job_accepted(job_id, filename)
+
+def job_accepted(job_id, filename):
+    return jsonify({
+        "success": True,
+        "filename": filename,
+        "job_id": job_id,
+        "status": "queued"
+    }), 202
+
+@app.route('/patch', methods=['POST'])
+def patch_file():
+    data = request.get_json()
+    filename, file_path, error = uploaded_file_path(data)
+    if error:
+        return error
+    return submit_stage("patch", filename, file_path, data)
+
+@app.route('/predict', methods=['POST'])
+def predict_file():
+    data = request.get_json()
+    filename, file_path, error = uploaded_file_path(data)
+    if error:
+        return error
+    return submit_stage("predict", filename, file_path, data)
+
+@app.route('/merge', methods=['POST'])
+def merge_file():
+    data = request.get_json()
+    filename, file_path, error = uploaded_file_path(data)
+    if error:
+        return error
+    return submit_stage("merge", filename, file_path, data)
+
+@app.route('/process', methods=['POST'])
+def process_file():
+    """Patch, normalize, segment and count in one streaming run."""
+    data = request.get_json()
+    filename, file_path, error = uploaded_file_path(data)
+    if error:
+        return error
+    return submit_stage("process", filename, file_path, data)
+
+def batch_slides(data):
+    """(filename, file_path) of every slide a batch request names, raises ValueError."""
+    if data.get('folder'):
+        root = os.path.realpath(app.config['BATCH_ROOT'])
+        folder = os.path.realpath(os.path.join(root, data['folder']))
+        if os.path.commonpath([root, folder]) != root or not os.path.isdir(folder):
+            raise ValueError("folder must be a directory inside the batch root")
+        slides = [(name, os.path.join(folder, name)) for name in sorted(os.listdir(folder))
+                  if allowed_file(name) and os.path.isfile(os.path.join(folder, name))]
+    elif isinstance(data.get('filenames'), list):
+        slides = []
+        for filename in data['filenames']:
+            filename = secure_filename(str(filename))
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            if not os.path.exists(file_path):
+                raise ValueError(f"File not found: {filename}")
+            slides.append((filename, file_path))
+    else:
+        raise ValueError("folder or filenames is required")
+
+    if not slides:
+        raise ValueError("No slides found")
+    # every slide writes to uploads/<file_id_name>/, so two with the same name would clobber each other
+    names = [output_name(filename) for filename, _ in slides]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Slides with the same name: {', '.join(duplicates)}")
+    return slides
+
+def start_batch_stage(stage, filename, file_path, options, priority, on_done):
+    return queue_stage(stage, filename, file_path, options, priority=priority, on_done=on_done)
+
+batch_scheduler = BatchScheduler(start_batch_stage)
+
+@app.route('/batches', methods=['POST'])
+def submit_batch():
+    """Run stages over many slides: {"folder": ...} or {"filenames": [...]}, plus "stages" and stage settings."""
+    data = request.get_json() or {}
+    stages = data.get('stages') or BATCH_STAGES
+    if not isinstance(stages, list) or any(stage not in STAGE_SPECS for stage in stages):
         return jsonify({
             "success": False,
-            "message": "Predicting failed",
-            "error": e.stderr
+            "message": f"stages must be a list of {', '.join(STAGE_SPECS)}"
         })
-    except Exception as e:
+    try:
+        slides = batch_slides(data)
+        # settings are shared by every slide, so check them once before anything is queued
+        for stage in stages:
+            STAGE_SPECS[stage](data, *slides[0])
+    except ValueError as e:
         return jsonify({
             "success": False,
-            "message": "An unexpected error occurred",
-            "error": str(e)
+            "message": str(e)
         })
 
-@app.route('/merge', methods=['POST'])
-def merge_file():
-    data = request.get_json()
-    filename = data.get('filename')
+    options = {key: value for key, value in data.items() if key not in ("folder", "filenames", "stages")}
+    batch_id = batch_scheduler.submit(slides, stages, options)
+    return jsonify({
+        "success": True,
+        "batch_id": batch_id,
+        "slides": len(slides),
+        "stages": stages,
+        "status": "running"
+    }), 202
+
+@app.route('/batches', methods=['GET'])
+def list_batches():
+    return jsonify({
+        "success": True,
+        "batches": batch_scheduler.list()
+    })
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    batch = batch_scheduler.get(batch_id)
+    if batch is None:
+        return jsonify({
+            "success": False,
+            "message": "Batch not found"
+        }), 404
+    return jsonify(dict(batch, success=True))
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({
+        "success": True,
+        "max_concurrent_stages": job_queue.max_workers,
+        "counts": job_queue.counts(),
+        "resources": job_queue.usage(),
+        "jobs": job_queue.list()
+    })
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": False,
+            "message": "Job not found"
+        }), 404
+    return jsonify(dict(job, success=True))
+
+# how often the event stream looks at the progress file, and when it sends a keep-alive comment
+EVENT_POLL_SECONDS = 0.5
+EVENT_HEARTBEAT_SECONDS = 15
+# a running job is never reported as stalled sooner than this, see progress.stall_state
+STALL_SECONDS = 60
+
+def job_events(job_id):
+    """Yield server-sent events with the job's stage progress until it finishes."""
+    last_event, last_sent = None, time.time()
+    while True:
+        job = job_queue.get(job_id)
+        if job is None:
+            return
+        finished = job["status"] in ("succeeded", "failed")
+        snapshot = progress.read_progress(output_name(job["filename"]))
+        # a progress file older than the job is left over from an earlier run
+        if snapshot and snapshot.get("updated", 0) < (job["started_at"] or job["submitted_at"]):
+            snapshot = None
+        event = {"job_id": job_id, "stage": job["stage"], "status": job["status"], "progress": snapshot}
+        if finished:
+            event.update(result=job["result"], timings=job["timings"])
+        elif snapshot and job["status"] == "running":
+            idle, stalled = progress.stall_state(snapshot, STALL_SECONDS)
+            event.update(seconds_since_update=round(idle, 1), stalled=stalled)
+
+        # seconds_since_update changes every poll, so compare without it
+        comparable = dict(event, seconds_since_update=None)
+        if comparable != last_event:
+            yield f"data: {json.dumps(event)}\n\n"
+            last_event, last_sent = comparable, time.time()
+        elif time.time() - last_sent >= EVENT_HEARTBEAT_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+        if finished:
+            return
+        time.sleep(EVENT_POLL_SECONDS)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_event_stream(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({
+            "success": False,
+            "message": "Job not found"
+        }), 404
+    response = Response(job_events(job_id), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # keeps reverse proxies from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
+@app.route('/nuclei/query', methods=['POST'])
+def query_nuclei():
+    """Per-class nucleus counts inside a rect [x0, y0, x1, y1] or polygon [[x, y], ...], in level-0 pixels."""
+    data = request.get_json() or {}
+    filename = data.get('filename')
     if not filename:
         return jsonify({
-            "success": False, 
+            "success": False,
             "message": "No filename provided"
-        })
-    
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        }), 400
 
-    if not os.path.exists(file_path):
+    rect, polygon = data.get('rect'), data.get('polygon')
+    try:
+        if polygon is not None:
+            polygon = [(float(x), float(y)) for x, y in polygon]
+            if len(polygon) < 3:
+                raise ValueError("polygon needs at least 3 points")
+        elif rect is not None:
+            rect = [float(v) for v in rect]
+            if len(rect) != 4 or rect[0] >= rect[2] or rect[1] >= rect[3]:
+                raise ValueError("rect must be [x0, y0, x1, y1] with x0 < x1 and y0 < y1")
+        else:
+            raise ValueError("rect or polygon is required")
+        limit = int(data['limit']) if data.get('limit') is not None else None
+    except (TypeError, ValueError) as e:
         return jsonify({
-            "success": False, 
-            "message": "File not found"
-        })
-    
+            "success": False,
+            "message": f"Invalid ROI: {e}"
+        }), 400
+
+    index = spatial_index.load_index(output_name(secure_filename(filename)))
+    if index is None:
+        return jsonify({
+            "success": False,
+            "message": "No segmentation results for this file, run predict first"
+        }), 404
+
+    start_time = time.time()
+    result = spatial_index.roi_counts(index, rect=rect, polygon=polygon,
+                                      with_centroids=bool(data.get('centroids')), limit=limit)
+    result["query_ms"] = round((time.time() - start_time) * 1000, 2)
+    return jsonify(dict(result, success=True))
+
+#browsers may keep tiles this long, the etag changes whenever merge rewrites the pyramid
+TILE_MAX_AGE = 24 * 3600
+
+@app.route('/slides/<filename>/overlay.dzi', methods=['GET'])
+def overlay_descriptor(filename):
     try:
+        overlay = pyramid.open_pyramid(output_name(secure_filename(filename)))
+    except FileNotFoundError:
+        return jsonify({
+            "success": False,
+            "message": "No overlay pyramid for this file, run merge with a pyramid first"
+        }), 404
+    response = make_response(overlay.descriptor())
+    response.headers["Content-Type"] = "application/xml"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
-        #file_id = os.path.splitext(filename)[0]
+@app.route('/slides/<filename>/overlay_files/<int:level>/<int:col>_<int:row>.jpeg', methods=['GET'])
+def overlay_tile(filename, level, col, row):
+    try:
+        data, etag = pyramid.read_tile(output_name(secure_filename(filename)), level, col, row)
+    except FileNotFoundError:
+        data, etag = None, None
+    if data is None:
+        return "", 404
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(data)
+        response.headers["Content-Type"] = "image/jpeg"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={TILE_MAX_AGE}"
+    return response
 
-        result = subprocess.run(
-            ["python", merge_script_path, file_path],
-            capture_output=True,
-            text=True,
-            check=True)
+@app.route('/slides/<filename>/render/<int:zoom>/<int:col>_<int:row>.png', methods=['GET'])
+def render_overlay_tile(filename, zoom, col, row):
+    """Overlay tile drawn on demand from the segmentation results, zoom z shows 2**z level-0 pixels per pixel."""
+    filename = secure_filename(filename)
+    base = request.args.get('base', 'slide')
+    if base not in ("slide", "none") or zoom > overlay_tiles.MAX_RENDER_ZOOM:
         return jsonify({
-            "success": True, 
-            "filename": filename,
-            "output": result.stdout
-        })
-    except subprocess.CalledProcessError as e:
+            "success": False,
+            "message": f"base must be slide or none and zoom at most {overlay_tiles.MAX_RENDER_ZOOM}"
+        }), 400
+
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    data = overlay_tiles.render_tile(output_name(filename), file_path if os.path.exists(file_path) else None,
+                                     zoom, col, row, base)
+    if data is None:
         return jsonify({
             "success": False,
-            "message": "Merging failed",
-            "error": e.stderr
-        })
-    except Exception as e:
+            "message": "No segmentation results for this file, run predict first"
+        }), 404
+    # results can be redone under the same url, so browsers revalidate against the etag
+    response = make_response(data)
+    response.headers["Content-Type"] = "image/png"
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/metrics', methods=['GET'])
+def stage_metrics_endpoint():
+    """Prometheus text: stage totals from the metrics events plus the job queue."""
+    job_counts = job_queue.counts()
+    usage = job_queue.usage()
+    body = stage_metrics.prometheus(gauges={
+        "tia_jobs": ("Stage jobs by status", [({"status": status}, n) for status, n in job_counts.items()]),
+        "tia_admission_reserved": ("Resources reserved by admitted jobs",
+                                   [({"resource": name}, u["reserved"]) for name, u in usage.items()]),
+        "tia_admission_budget": ("Resource budget jobs are admitted against",
+                                 [({"resource": name}, u["budget"]) for name, u in usage.items()
+                                  if u["budget"] is not None]),
+    })
+    response = make_response(body)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return response
+
+@app.route('/worker/health', methods=['GET'])
+def worker_health():
+    state = inference_worker.health()
+    if state is None:
         return jsonify({
             "success": False,
-            "message": "An unexpected error occurred",
-            "error": str(e)
-        })
+            "warm": False,
+            "message": "No inference worker running"
+        }), 503
+    return jsonify(state)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""Batches of slides taken through a list of stages by the job queue.
+
+Every slide moves through the stages in order on its own, so one slide can
+be merging while others are still patching. Each stage is queued with its
+position in the list as priority, which makes the queue finish slides that
+are further along before starting new ones, and lets the job queue's
+admission control decide how many run at once.
+"""
+import time, uuid, logging, threading
+from functools import partial
+from slide_reader import slide_dimensions
+
+# finished batches kept around for GET /batches before the oldest are dropped
+MAX_FINISHED_BATCHES = 50
+
+
+class BatchScheduler:
+    def __init__(self, start_stage):
+        # start_stage(stage, filename, file_path, options, priority, on_done) returns the job id,
+        # or None when the stage's outputs were restored from the result cache
+        self.start_stage = start_stage
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def submit(self, slides, stages, options=None):
+        """Start a batch of (filename, file_path) slides with the same stage options, returns its id."""
+        batch_id = uuid.uuid4().hex
+        batch = {
+            "batch_id": batch_id,
+            "stages": list(stages),
+            "options": dict(options or {}),
+            "submitted_at": time.time(),
+            "finished_at": None,
+            "slides": [],
+        }
+        for filename, file_path in slides:
+            try:
+                width, height = slide_dimensions(file_path)
+            except Exception as e:
+                logging.warning(f"Could not read dimensions of {file_path}: {e}")
+                width, height = 0, 0
+            batch["slides"].append({
+                "filename": filename,
+                "file_path": file_path,
+                "pixels": width * height,
+                "status": "queued",
+                "stage": None,
+                "stages": {},
+                "error": None,
+                "finished_at": None,
+            })
+        with self.lock:
+            self.batches[batch_id] = batch
+            self._prune()
+        for slide in batch["slides"]:
+            self._start(batch, slide, 0)
+        return batch_id
+
+    def _start(self, batch, slide, index):
+        """Queue the slide's stage at index, or finish the slide after its last stage."""
+        stages = batch["stages"]
+        if index == len(stages):
+            self._finish_slide(batch, slide, "succeeded")
+            return
+        stage = stages[index]
+        with self.lock:
+            slide["stage"] = stage
+            slide["status"] = "running"
+        try:
+            job_id = self.start_stage(stage, slide["filename"], slide["file_path"], batch["options"], index,
+                                      partial(self._stage_done, batch, slide, index))
+        except Exception as e:
+            logging.exception(f"Could not queue {stage} for {slide['filename']}")
+            self._finish_slide(batch, slide, "failed", f"{stage}: {e}")
+            return
+        with self.lock:
+            slide["stages"].setdefault(stage, {"job_id": job_id, "status": "queued"})
+
+    def _stage_done(self, batch, slide, index, job):
+        stage = batch["stages"][index]
+        with self.lock:
+            # a stage restored from the result cache still runs as a (short) job
+            status = "cached" if (job["result"] or {}).get("cached") else job["status"]
+            slide["stages"][stage] = {"job_id": job["job_id"], "status": status, **job["timings"]}
+        if job["status"] == "succeeded":
+            self._start(batch, slide, index + 1)
+        else:
+            message = (job["result"] or {}).get("message", "failed")
+            self._finish_slide(batch, slide, "failed", f"{stage}: {message}")
+
+    def _finish_slide(self, batch, slide, status, error=None):
+        with self.lock:
+            slide["status"] = status
+            slide["error"] = error
+            slide["finished_at"] = time.time()
+            if all(s["finished_at"] is not None for s in batch["slides"]):
+                batch["finished_at"] = time.time()
+                logging.info(f"Batch {batch['batch_id']} finished: {self._summary(batch)['slides']}")
+
+    def _prune(self):
+        finished = [batch for batch in self.batches.values() if batch["finished_at"] is not None]
+        if len(finished) > MAX_FINISHED_BATCHES:
+            finished.sort(key=lambda batch: batch["finished_at"])
+            for batch in finished[:len(finished) - MAX_FINISHED_BATCHES]:
+                del self.batches[batch["batch_id"]]
+
+    def _summary(self, batch):
+        """Slide counts and throughput of a batch, called with the lock held."""
+        slides = batch["slides"]
+        statuses = [slide["status"] for slide in slides]
+        elapsed = (batch["finished_at"] or time.time()) - batch["submitted_at"]
+        succeeded = [slide for slide in slides if slide["status"] == "succeeded"]
+
+        stages = {}
+        for stage in batch["stages"]:
+            runs = [slide["stages"][stage] for slide in slides if stage in slide["stages"]]
+            timed = [run for run in runs if "run_seconds" in run]
+            run_seconds = sum(run["run_seconds"] for run in timed)
+            stages[stage] = {
+                "succeeded": sum(run["status"] == "succeeded" for run in runs),
+                "failed": sum(run["status"] == "failed" for run in runs),
+                "cached": sum(run["status"] == "cached" for run in runs),
+                "run_seconds": round(run_seconds, 3),
+                "mean_run_seconds": round(run_seconds / len(timed), 3) if timed else None,
+                # time spent waiting for admission
+                "mean_queued_seconds": round(sum(run["queued_seconds"] for run in timed) / len(timed), 3)
+                                       if timed else None,
+            }
+
+        stage_seconds = sum(stage["run_seconds"] for stage in stages.values())
+        return {
+            "slides": {status: statuses.count(status) for status in ("queued", "running", "succeeded", "failed")},
+            "elapsed_seconds": round(elapsed, 3),
+            "slides_per_hour": round(len(succeeded) / elapsed * 3600, 2) if elapsed > 0 else None,
+            "gigapixels_per_hour": round(sum(slide["pixels"] for slide in succeeded) / 1e9 / elapsed * 3600, 3)
+                                   if elapsed > 0 else None,
+            # average number of stages running at once over the batch
+            "concurrency": round(stage_seconds / elapsed, 2) if elapsed > 0 else None,
+            "stages": stages,
+        }
+
+    def get(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            return {
+                "batch_id": batch_id,
+                "stages": list(batch["stages"]),
+                "options": dict(batch["options"]),
+                "submitted_at": batch["submitted_at"],
+                "finished_at": batch["finished_at"],
+                "status": "finished" if batch["finished_at"] is not None else "running",
+                "throughput": self._summary(batch),
+                "slides": [dict(slide, stages={name: dict(run) for name, run in slide["stages"].items()})
+                           for slide in batch["slides"]],
+            }
+
+    def list(self):
+        with self.lock:
+            batch_ids = sorted(self.batches, key=lambda batch_id: self.batches[batch_id]["submitted_at"])
+        batches = [self.get(batch_id) for batch_id in batch_ids]
+        return [dict(batch, slides=len(batch["slides"])) for batch in batches if batch]
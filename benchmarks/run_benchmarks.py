@@ -0,0 +1,209 @@
+"""Per-stage benchmarks on a synthetic slide.
+
+    python benchmarks/run_benchmarks.py --width 16384 --height 12288 --tissue-fraction 0.4
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<older>.json
+
+Generates a pyramidal TIFF slide, then runs patch, predict (with the stub
+segmentor), count and merge one after another in a scratch directory. Each
+stage runs in its own process so peak RSS is the stage's own; RSS and bytes
+read are sampled across the stage's whole process tree (pool workers
+included). Results go to benchmarks/results/<timestamp>.json.
+"""
+import os, sys, json, time, shutil, argparse, tempfile, platform, subprocess, threading
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO_DIR, BENCH_DIR]
+
+import psutil
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+STAGES = ["patch", "predict", "count", "merge"]
+SAMPLE_INTERVAL = 0.05
+
+
+def file_id_name_of(slide_path):
+    return f"{os.path.splitext(os.path.basename(slide_path))[0]}_Vaha"
+
+
+def run_stage(stage, work_dir, slide_path, options, results):
+    """Body of a stage process, puts (seconds, tiles) on results."""
+    os.chdir(work_dir)
+    file_id_name = file_id_name_of(slide_path)
+    start_time = time.time()
+    if stage == "patch":
+        import patch
+
+        patch.main(slide_path, workers=options["workers"])
+        with open(f"./uploads/{file_id_name}/patches_info_{file_id_name}.csv") as f:
+            tiles = sum(1 for _ in f) - 2
+    elif stage == "predict":
+        import predict
+        import tile_store
+        from stub_segmentor import StubSegmentor
+
+        overrides = {"device": "cpu", "batch_size": 8, "num_loader_workers": 0, "num_postproc_workers": 0,
+                     "torch_threads": 1}
+        if not predict.predict(file_id_name, segmentor=StubSegmentor(), overrides=overrides):
+            raise RuntimeError("predict failed")
+        tiles = len(tile_store.cell_tile_paths(file_id_name))
+    elif stage == "count":
+        import predict
+        import nucleus_store
+
+        predict.cellsCount(file_id_name, overlays=options["overlays"], workers=options["workers"])
+        tiles = len(nucleus_store.tile_dat_pairs(file_id_name))
+    elif stage == "merge":
+        import merge
+        from slide_reader import slide_dimensions
+
+        width, height = slide_dimensions(slide_path)
+        merge.mergeImages(file_id_name, width, height, file_path=slide_path, scale=options["merge_scale"])
+        tiles = len(merge.load_manifest(file_id_name)[1])
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    results.put((time.time() - start_time, tiles))
+
+
+class TreeSampler(threading.Thread):
+    """Samples RSS and bytes read of a process and its descendants until stopped."""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.root = psutil.Process(pid)
+        self.peak_rss = 0
+        self.read_bytes = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                procs = [self.root] + self.root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                break
+            rss = 0
+            for proc in procs:
+                try:
+                    rss += proc.memory_info().rss
+                    # read_chars counts every read() byte, page cache hits included
+                    self.read_bytes[proc.pid] = proc.io_counters().read_chars
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            self.peak_rss = max(self.peak_rss, rss)
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+
+def measure(stage, work_dir, slide_path, options):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(stage, work_dir, slide_path, options, results))
+    wall_start = time.time()
+    process.start()
+    sampler = TreeSampler(process.pid)
+    sampler.start()
+    process.join()
+    sampler.stopped.set()
+    sampler.join()
+    wall_seconds = time.time() - wall_start
+    if process.exitcode != 0 or results.empty():
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+
+    seconds, tiles = results.get()
+    read_mb = sum(sampler.read_bytes.values()) / 1024 ** 2
+    return {
+        "stage_seconds": round(seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),  # includes process start and imports
+        "tiles": tiles,
+        "tiles_per_sec": round(tiles / seconds, 3) if seconds else None,
+        "read_mb": round(read_mb, 1),
+        "read_mb_per_sec": round(read_mb / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 ** 2, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new):
+    with open(old_path) as f:
+        old = json.load(f)
+    print(f"{'stage':<10}{'metric':<18}{'old':>12}{'new':>12}{'change':>10}")
+    for stage, metrics in new["stages"].items():
+        before = old.get("stages", {}).get(stage)
+        if not before:
+            continue
+        for metric in ["stage_seconds", "tiles_per_sec", "read_mb_per_sec", "peak_rss_mb"]:
+            a, b = before.get(metric), metrics.get(metric)
+            change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ""
+            print(f"{stage:<10}{metric:<18}{a if a is not None else '-':>12}{b if b is not None else '-':>12}{change:>10}")
+
+
+def main(args):
+    from synthetic_slide import make_slide
+
+    work_dir = tempfile.mkdtemp(prefix="tia_bench_")
+    slide_path = os.path.join(work_dir, "synthetic.tif")
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "machine": {"platform": platform.platform(), "cores": os.cpu_count(),
+                    "memory_mb": round(psutil.virtual_memory().total / 1024 ** 2)},
+        "slide": {"width": args.width, "height": args.height, "tissue_fraction": args.tissue_fraction,
+                  "seed": args.seed},
+        "options": {"workers": args.workers, "overlays": not args.no_overlays, "merge_scale": args.merge_scale},
+        "stages": {},
+    }
+    try:
+        start_time = time.time()
+        layout = make_slide(slide_path, args.width, args.height, args.tissue_fraction, args.seed)
+        report["slide"].update({"actual_tissue_fraction": round(float(layout.mean()), 3),
+                                "file_mb": round(os.path.getsize(slide_path) / 1024 ** 2, 1),
+                                "generate_seconds": round(time.time() - start_time, 3)})
+
+        for stage in args.stages:
+            report["stages"][stage] = measure(stage, work_dir, slide_path, report["options"])
+            print(f"{stage}: {json.dumps(report['stages'][stage])}")
+    finally:
+        if args.keep:
+            print(f"Kept scratch directory {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = args.out or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out_path}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python benchmarks/run_benchmarks.py [--width W] [--height H] [--tissue-fraction F] [--stages patch,predict,count,merge] [--compare old.json]")
+    parser.add_argument("--width", type=int, default=16384)
+    parser.add_argument("--height", type=int, default=12288)
+    parser.add_argument("--tissue-fraction", type=float, default=0.4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma separated, in order; later stages need the earlier ones' outputs")
+    parser.add_argument("--workers", type=int, default=1, help="patch and overlay worker processes")
+    parser.add_argument("--no-overlays", action="store_true", help="count stage skips overlay rendering")
+    parser.add_argument("--merge-scale", type=float, default=0.1)
+    parser.add_argument("--out", default=None, help="result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the slide and outputs")
+    args = parser.parse_args()
+
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        print(f"Unknown stage(s): {', '.join(sorted(unknown))}")
+        sys.exit(1)
+    main(args)
@@ -0,0 +1,60 @@
+"""Stand-in for NucleusInstanceSegmentor that needs no weights or GPU.
+
+It reads every tile like the real engine does and writes a .dat of fake
+nuclei in the tile engine's format. The nuclei depend only on the tile's
+pixels, so runs are deterministic and the counting, store and merge stages
+downstream see realistic amounts of data.
+"""
+import os, zlib
+import numpy as np
+import joblib
+from PIL import Image
+
+# fake nuclei per tile at full tissue coverage
+NUCLEI_PER_TILE = 400
+CONTOUR_POINTS = 16
+
+
+class _Model:
+    preproc_func = None
+
+
+class StubSegmentor:
+    def __init__(self, batch_size=8, num_loader_workers=0, num_postproc_workers=0):
+        self.batch_size = batch_size
+        self.num_loader_workers = num_loader_workers
+        self.num_postproc_workers = num_postproc_workers
+        self.model = _Model()
+
+    def fake_nuclei(self, tile):
+        """{inst_id: nucleus} for a tile, more nuclei the darker (more tissue) it is."""
+        rng = np.random.default_rng(zlib.crc32(tile[::64, ::64].tobytes()))
+        tissue = float((tile[..., :3].mean(axis=2) < 220).mean())
+        count = int(NUCLEI_PER_TILE * tissue)
+        height, width = tile.shape[:2]
+        angles = np.linspace(0, 2 * np.pi, CONTOUR_POINTS, endpoint=False)
+        nuclei = {}
+        for inst_id in range(1, count + 1):
+            cx, cy = rng.uniform(8, width - 8), rng.uniform(8, height - 8)
+            radius = rng.uniform(3, 8)
+            contour = np.stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)], axis=1).astype(np.int32)
+            nuclei[inst_id] = {
+                "box": np.array([cx - radius, cy - radius, cx + radius, cy + radius], dtype=np.int32),
+                "centroid": np.array([cx, cy]),
+                "contour": contour,
+                "prob": float(rng.uniform(0.5, 1.0)),
+                "type": int(rng.integers(1, 5)),
+            }
+        return nuclei
+
+    def predict(self, imgs, save_dir, mode="tile", device="cpu", crash_on_exception=True, masks=None, **kwargs):
+        if mode != "tile":
+            raise ValueError("The stub segmentor only runs in tile mode")
+        os.makedirs(save_dir, exist_ok=True)
+        outputs = []
+        for i, img_path in enumerate(imgs):
+            tile = np.asarray(Image.open(img_path))
+            save_path = os.path.join(save_dir, str(i))
+            joblib.dump(self.fake_nuclei(tile), f"{save_path}.dat")
+            outputs.append((img_path, save_path))
+        return outputs
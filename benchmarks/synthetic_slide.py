@@ -0,0 +1,86 @@
+"""Synthetic pyramidal TIFF slides for benchmarking.
+
+Tissue is a set of random blobs covering roughly the requested fraction of
+the slide, filled with pink H&E-like texture and purple nuclei; the rest is
+near-white glass, flat enough to fail patch.py's std threshold. Level 0 is
+written tile by tile, so slides larger than memory can be generated, and
+each lower level is a separate tiled page, the layout OpenSlide reads as a
+generic tiled TIFF.
+"""
+import argparse
+import numpy as np
+import tifffile
+
+TILE = 256
+# level-0 pixels per cell of the tissue layout
+LAYOUT_CELL = 256
+
+
+def tissue_layout(width, height, tissue_fraction, seed=0):
+    """Boolean grid of LAYOUT_CELL cells, True where there is tissue."""
+    rng = np.random.default_rng(seed)
+    rows, cols = -(-height // LAYOUT_CELL), -(-width // LAYOUT_CELL)
+    layout = np.zeros((rows, cols), dtype=bool)
+    yy, xx = np.mgrid[0:rows, 0:cols]
+    target = tissue_fraction * rows * cols
+    while layout.sum() < target:
+        cy, cx = rng.uniform(0, rows), rng.uniform(0, cols)
+        ry = rng.uniform(0.05, 0.25) * rows + 1
+        rx = rng.uniform(0.05, 0.25) * cols + 1
+        layout |= ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    return layout
+
+
+def render_tile(layout, x, y, downsample, seed=0):
+    """RGB TILE x TILE pixels at (x, y) of the level with the given downsample."""
+    rng = np.random.default_rng((seed, x, y, downsample))
+    ys = ((y + np.arange(TILE)) * downsample // LAYOUT_CELL).clip(0, layout.shape[0] - 1)
+    xs = ((x + np.arange(TILE)) * downsample // LAYOUT_CELL).clip(0, layout.shape[1] - 1)
+    tissue = layout[np.ix_(ys, xs)]
+
+    tile = np.full((TILE, TILE, 3), 242, dtype=np.int16) + rng.integers(-2, 3, (TILE, TILE, 1))
+    if tissue.any():
+        # eosin background with grain, then haematoxylin-dark nuclei
+        stroma = np.array([226, 160, 190]) + rng.integers(-25, 26, (TILE, TILE, 3))
+        n_nuclei = max(1, int(tissue.mean() * 120 / downsample ** 2))
+        cy, cx = rng.integers(0, TILE, n_nuclei), rng.integers(0, TILE, n_nuclei)
+        radius = max(1, 6 // downsample)
+        grid_y, grid_x = np.ogrid[0:TILE, 0:TILE]
+        nuclei = np.zeros((TILE, TILE), dtype=bool)
+        for y0, x0 in zip(cy, cx):
+            nuclei |= (grid_y - y0) ** 2 + (grid_x - x0) ** 2 <= radius ** 2
+        stroma[nuclei] = np.array([90, 60, 150]) + rng.integers(-15, 16, (int(nuclei.sum()), 3))
+        tile = np.where(tissue[..., None], stroma, tile)
+    return tile.clip(0, 255).astype(np.uint8)
+
+
+def make_slide(path, width, height, tissue_fraction=0.4, seed=0, compression="zlib", levels=None):
+    """Write a synthetic slide, returns the tissue layout used."""
+    layout = tissue_layout(width, height, tissue_fraction, seed)
+    if levels is None:
+        levels = 1
+        while max(width, height) // 2 ** levels >= 2 * TILE:
+            levels += 1
+
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for level in range(levels):
+            downsample = 2 ** level
+            level_width, level_height = -(-width // downsample), -(-height // downsample)
+            tiles = (render_tile(layout, x, y, downsample, seed)
+                     for y in range(0, level_height, TILE) for x in range(0, level_width, TILE))
+            tif.write(tiles, shape=(level_height, level_width, 3), dtype=np.uint8, tile=(TILE, TILE),
+                      photometric="rgb", compression=compression, metadata=None)
+    return layout
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python benchmarks/synthetic_slide.py <out.tif> [--width W] [--height H] [--tissue-fraction F]")
+    parser.add_argument("path")
+    parser.add_argument("--width", type=int, default=16384)
+    parser.add_argument("--height", type=int, default=12288)
+    parser.add_argument("--tissue-fraction", type=float, default=0.4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    layout = make_slide(args.path, args.width, args.height, args.tissue_fraction, args.seed)
+    print(f"Wrote {args.path}: {args.width} x {args.height}, tissue fraction {layout.mean():.2f}")
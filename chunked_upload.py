@@ -0,0 +1,197 @@
+import os, re, json, uuid, hashlib, threading
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChunkedUploads:
+    """Resumable uploads written chunk by chunk at their offsets.
+
+    Partial files and their state live in <upload_folder>/.partial/. The state
+    file lists the acknowledged chunks, so a client can resume after a dropped
+    connection or a server restart. The whole-file SHA-256 is advanced while
+    chunks stream in; chunks that arrive ahead of the hashed prefix are read
+    back from the page cache once the gap before them is filled.
+    """
+
+    def __init__(self, upload_folder):
+        self.upload_folder = upload_folder
+        self.partial_dir = os.path.join(upload_folder, ".partial")
+        self.lock = threading.Lock()
+        # upload_id -> {"sha": hasher over chunks [0, next_chunk), "next_chunk": int, "busy": bool}
+        self.hashers = {}
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.partial_dir, f"{upload_id}.json")
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.partial_dir, f"{upload_id}.part")
+
+    def _load(self, upload_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            raise UploadError("Unknown upload id")
+        try:
+            with open(self._state_path(upload_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadError("Unknown upload id")
+
+    def _save(self, state):
+        tmp_path = f"{self._state_path(state['upload_id'])}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path(state["upload_id"]))
+
+    def _chunk_length(self, state, index):
+        return min(state["chunk_size"], state["size"] - index * state["chunk_size"])
+
+    def init(self, filename, size, chunk_size=DEFAULT_CHUNK_SIZE):
+        if size <= 0:
+            raise UploadError("size must be positive")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError(f"chunk_size must be between 1 and {MAX_CHUNK_SIZE}")
+
+        os.makedirs(self.partial_dir, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        # sparse file at full size, every chunk lands at its own offset
+        with open(self._part_path(upload_id), "wb") as f:
+            f.truncate(size)
+
+        state = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": size,
+            "chunk_size": chunk_size,
+            "total_chunks": (size + chunk_size - 1) // chunk_size,
+            "received": [],
+        }
+        with self.lock:
+            self._save(state)
+            self.hashers[upload_id] = {"sha": hashlib.sha256(), "next_chunk": 0, "busy": False}
+        return state
+
+    def status(self, upload_id):
+        with self.lock:
+            return self._load(upload_id)
+
+    def write_chunk(self, upload_id, index, stream, expected_sha256=None):
+        with self.lock:
+            state = self._load(upload_id)
+            if not 0 <= index < state["total_chunks"]:
+                raise UploadError("Chunk index out of range")
+            already_received = index in state["received"]
+            hasher = self.hashers.get(upload_id)
+            # the chunk right after the hashed prefix feeds the file hash while it streams in
+            inline = (hasher is not None and not hasher["busy"] and hasher["next_chunk"] == index
+                      and not already_received)
+            if inline:
+                hasher["busy"] = True
+                file_sha = hasher["sha"].copy()
+
+        if already_received:
+            # a retry whose first attempt was acknowledged, the data on disk is already verified
+            while stream.read(READ_SIZE):
+                pass
+            return state, None
+
+        expected_length = self._chunk_length(state, index)
+        chunk_sha = hashlib.sha256()
+        written = 0
+        fd = os.open(self._part_path(upload_id), os.O_WRONLY)
+        try:
+            while written < expected_length:
+                data = stream.read(min(READ_SIZE, expected_length - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, index * state["chunk_size"] + written)
+                chunk_sha.update(data)
+                if inline:
+                    file_sha.update(data)
+                written += len(data)
+            if stream.read(1):
+                written += 1
+        finally:
+            os.close(fd)
+
+        error = None
+        if written != expected_length:
+            error = f"Chunk {index} has {written} bytes, expected {expected_length}"
+        elif expected_sha256 and chunk_sha.hexdigest() != expected_sha256.lower():
+            error = f"Chunk {index} checksum mismatch"
+
+        with self.lock:
+            if inline:
+                hasher["busy"] = False
+            if error:
+                raise UploadError(error)
+
+            state = self._load(upload_id)
+            if index not in state["received"]:
+                state["received"].append(index)
+                state["received"].sort()
+                self._save(state)
+            if inline:
+                hasher["sha"] = file_sha
+                hasher["next_chunk"] = index + 1
+            self._advance_hash(upload_id, state)
+        return state, chunk_sha.hexdigest()
+
+    def _advance_hash(self, upload_id, state):
+        hasher = self.hashers.get(upload_id)
+        if hasher is None or hasher["busy"]:
+            return
+        received = set(state["received"])
+        if hasher["next_chunk"] not in received:
+            return
+        with open(self._part_path(upload_id), "rb") as f:
+            while hasher["next_chunk"] in received:
+                f.seek(hasher["next_chunk"] * state["chunk_size"])
+                hasher["sha"].update(f.read(self._chunk_length(state, hasher["next_chunk"])))
+                hasher["next_chunk"] += 1
+
+    def finalize(self, upload_id):
+        with self.lock:
+            state = self._load(upload_id)
+            missing = sorted(set(range(state["total_chunks"])) - set(state["received"]))
+            if missing:
+                raise UploadError(f"{len(missing)} chunk(s) missing, first is {missing[0]}")
+
+            hasher = self.hashers.pop(upload_id, None)
+            if hasher is None or hasher["next_chunk"] != state["total_chunks"]:
+                # hash state was lost (server restart), hash the assembled file once
+                hasher = {"sha": hashlib.sha256(), "next_chunk": 0, "busy": False}
+                with open(self._part_path(upload_id), "rb") as f:
+                    for data in iter(lambda: f.read(READ_SIZE), b""):
+                        hasher["sha"].update(data)
+            sha256 = hasher["sha"].hexdigest()
+
+            file_path = os.path.join(self.upload_folder, state["filename"])
+            os.replace(self._part_path(upload_id), file_path)
+            write_digest(file_path, sha256)
+            os.remove(self._state_path(upload_id))
+        return file_path, sha256
+
+
+def write_digest(file_path, sha256):
+    """Store the SHA-256 of an uploaded slide next to it, with the size/mtime it belongs to."""
+    stat = os.stat(file_path)
+    with open(f"{file_path}.sha256", "w") as f:
+        json.dump({"sha256": sha256, "size": stat.st_size, "mtime": stat.st_mtime}, f)
+
+
+def read_digest(file_path):
+    """SHA-256 recorded at upload time, or None if missing or stale."""
+    try:
+        with open(f"{file_path}.sha256") as f:
+            digest = json.load(f)
+        stat = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if digest.get("size") != stat.st_size or digest.get("mtime") != stat.st_mtime:
+        return None
+    return digest.get("sha256")
@@ -0,0 +1,187 @@
+"""Long-lived inference worker keeping a warm HoVerNet model.
+
+Run it next to the Flask app:
+
+    python inference_worker.py
+
+The app sends slide jobs over a local authenticated socket (see submit_job and
+health below); torch and tiatoolbox are only imported by the worker process.
+Messages on the socket are pickled, so the authkey is a real secret: it comes
+from INFERENCE_WORKER_AUTHKEY, or from a random key the worker writes to
+WORKER_AUTHKEY_FILE (mode 0600) on its first start and the app reads back.
+"""
+import os, sys, time, stat, logging, secrets, threading, argparse
+from multiprocessing.connection import Listener, Client
+
+WORKER_HOST = os.environ.get('INFERENCE_WORKER_HOST', 'localhost')
+WORKER_PORT = int(os.environ.get('INFERENCE_WORKER_PORT', 6011))
+WORKER_AUTHKEY_FILE = os.environ.get('INFERENCE_WORKER_AUTHKEY_FILE', "./uploads/inference_worker.key")
+
+
+class AuthkeyError(RuntimeError):
+    pass
+
+
+def _read_authkey_file():
+    try:
+        fd = os.open(WORKER_AUTHKEY_FILE, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    with os.fdopen(fd, "rb") as f:
+        info = os.fstat(f.fileno())
+        # a key others can read (or swap) is no secret
+        if info.st_mode & (stat.S_IRWXG | stat.S_IRWXO) or info.st_uid != os.getuid():
+            raise AuthkeyError(f"{WORKER_AUTHKEY_FILE} must be owned by this user and mode 0600")
+        return f.read().strip() or None
+
+
+def worker_authkey(create=False):
+    """Authkey of the worker socket, generated into WORKER_AUTHKEY_FILE when create is set and there is none.
+
+    Raises AuthkeyError when no key is available, nothing falls back to a default.
+    """
+    key = os.environ.get('INFERENCE_WORKER_AUTHKEY')
+    if key:
+        return key.encode()
+    key = _read_authkey_file()
+    if key is not None:
+        return key
+    if not create:
+        raise AuthkeyError("No inference worker authkey: set INFERENCE_WORKER_AUTHKEY or start the worker first")
+
+    os.makedirs(os.path.dirname(WORKER_AUTHKEY_FILE) or ".", exist_ok=True)
+    key = secrets.token_hex(32).encode()
+    try:
+        fd = os.open(WORKER_AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another worker got there first
+        return worker_authkey()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def _send(request, timeout=None):
+    with Client((WORKER_HOST, WORKER_PORT), authkey=worker_authkey()) as conn:
+        conn.send(request)
+        if timeout is not None and not conn.poll(timeout):
+            raise TimeoutError("Inference worker did not answer in time")
+        return conn.recv()
+
+
+def health(timeout=2):
+    """Worker state dict, or None when no worker is listening."""
+    try:
+        return _send({"cmd": "health"}, timeout=timeout)
+    except (OSError, EOFError, TimeoutError, AuthkeyError):
+        return None
+
+
+def submit_job(file_path, overrides=None, mode="tile", overlays=True):
+    """Run predict + cellsCount (or whole-slide inference) for a slide on the worker and wait for the result."""
+    return _send({"cmd": "predict", "file_path": file_path, "overrides": overrides, "mode": mode,
+                  "overlays": overlays})
+
+
+class InferenceWorker:
+    def __init__(self):
+        self.segmentor = None
+        self.settings = None
+        self.started = time.time()
+        self.loaded_in = None
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.current_job = None
+        # one slide on the model at a time, health checks still answer meanwhile
+        self.job_lock = threading.Lock()
+
+    def warm_up(self):
+        import predict
+
+        start_time = time.time()
+        self.segmentor, self.settings = predict.prepare_segmentor()
+        self.loaded_in = time.time() - start_time
+        logging.info(f"Loaded {predict.MODEL_NAME} in {self.loaded_in:.1f} seconds")
+
+    def state(self):
+        import predict
+
+        return {
+            "success": True,
+            "warm": self.segmentor is not None,
+            "model": predict.MODEL_NAME,
+            "settings": self.settings,
+            "busy": self.current_job is not None,
+            "current_job": self.current_job,
+            "jobs_done": self.jobs_done,
+            "jobs_failed": self.jobs_failed,
+            "model_load_seconds": self.loaded_in,
+            "uptime_seconds": int(time.time() - self.started),
+        }
+
+    def run_job(self, file_path, overrides=None, mode="tile", overlays=True):
+        import predict
+
+        if not os.path.exists(file_path):
+            return {"success": False, "message": "File not found"}
+
+        with self.job_lock:
+            self.current_job = file_path
+            start_time = time.time()
+            try:
+                ok = predict.main(file_path, segmentor=self.segmentor, overrides=overrides, mode=mode, overlays=overlays)
+            except Exception as e:
+                logging.error(f"Inference job failed for {file_path}: {e}")
+                ok = False
+            finally:
+                self.current_job = None
+
+        elapsed_time = time.time() - start_time
+        if ok:
+            self.jobs_done += 1
+            return {"success": True, "output": f"Predicted {file_path} in {elapsed_time:.1f} seconds"}
+        self.jobs_failed += 1
+        return {"success": False, "message": "Predicting failed",
+                "error": f"See predict_log.txt for {os.path.basename(file_path)}"}
+
+    def handle(self, conn):
+        with conn:
+            try:
+                request = conn.recv()
+                cmd = request.get("cmd")
+                if cmd == "health":
+                    conn.send(self.state())
+                elif cmd == "predict":
+                    conn.send(self.run_job(request["file_path"], request.get("overrides"),
+                                           request.get("mode", "tile"), request.get("overlays", True)))
+                else:
+                    conn.send({"success": False, "message": f"Unknown command: {cmd}"})
+            except (EOFError, OSError):
+                pass
+
+    def serve(self):
+        with Listener((WORKER_HOST, WORKER_PORT), authkey=worker_authkey(create=True)) as listener:
+            logging.info(f"Inference worker listening on {WORKER_HOST}:{WORKER_PORT}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # a client with the wrong authkey must not take the worker down
+                    logging.warning(f"Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python inference_worker.py [--check]")
+    parser.add_argument("--check", action="store_true", help="print the state of a running worker and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        state = health()
+        print(state if state else "No inference worker running")
+        sys.exit(0 if state else 1)
+
+    worker = InferenceWorker()
+    worker.warm_up()
+    worker.serve()
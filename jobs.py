@@ -0,0 +1,135 @@
+import time, uuid, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# finished jobs kept around for GET /jobs before the oldest are dropped
+MAX_FINISHED_JOBS = 500
+# once the first job in line has waited this long, smaller jobs stop overtaking it
+MAX_OVERTAKE_SECONDS = 120
+
+
+class JobQueue:
+    """Runs pipeline stages in a bounded thread pool and keeps their status.
+
+    Each stage function returns the same dict the endpoint used to return
+    ({"success": ..., "output"/"error": ...}), which becomes the job result.
+
+    With a budget, a job also declares the RAM and CPUs it is expected to
+    hold and waits in line until they fit next to the running jobs. Jobs are
+    admitted by priority, then age; a smaller job may overtake one that does
+    not fit yet, for at most MAX_OVERTAKE_SECONDS. A job larger than the
+    whole budget runs on its own.
+    """
+
+    def __init__(self, max_workers=2, ram_budget=None, cpu_budget=None):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.budget = {"ram_bytes": ram_budget, "cpus": cpu_budget}
+        self.reserved = {"ram_bytes": 0, "cpus": 0}
+        self.waiting = []  # (job, fn, args, kwargs, on_done) not yet admitted
+        self.running = 0
+
+    def submit(self, stage, filename, fn, *args, resources=None, priority=0, on_done=None, **kwargs):
+        """Queue fn(*args, **kwargs), on_done(job) is called once it has finished."""
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "stage": stage,
+            "filename": filename,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "timings": {},
+            "resources": resources or {},
+            "priority": priority,
+            "result": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self._prune()
+            self.waiting.append((job, fn, args, kwargs, on_done))
+            self._admit()
+        return job_id
+
+    def _fits(self, resources):
+        return all(limit is None or self.reserved[name] + resources.get(name, 0) <= limit
+                   for name, limit in self.budget.items())
+
+    def _admit(self):
+        """Start the waiting jobs that fit, called with the lock held."""
+        self.waiting.sort(key=lambda entry: (-entry[0]["priority"], entry[0]["submitted_at"]))
+        now = time.time()
+        for entry in list(self.waiting):
+            job = entry[0]
+            if self.running >= self.max_workers:
+                return
+            if not self._fits(job["resources"]):
+                if self.running == 0:
+                    logging.warning(f"{job['stage']} job {job['job_id']} needs more than the budget, running it alone")
+                elif now - job["submitted_at"] > MAX_OVERTAKE_SECONDS:
+                    return  # hold everything behind it until it fits
+                else:
+                    continue
+            self.waiting.remove(entry)
+            for name in self.reserved:
+                self.reserved[name] += job["resources"].get(name, 0)
+            self.running += 1
+            self.executor.submit(self._run, *entry)
+
+    def _run(self, job, fn, args, kwargs, on_done):
+        with self.lock:
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            job["timings"]["queued_seconds"] = round(job["started_at"] - job["submitted_at"], 3)
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"{job['stage']} job {job['job_id']} failed: {e}")
+            result = {"success": False, "message": "An unexpected error occurred", "error": str(e)}
+
+        with self.lock:
+            job["finished_at"] = time.time()
+            job["timings"]["run_seconds"] = round(job["finished_at"] - job["started_at"], 3)
+            job["result"] = result
+            job["status"] = "succeeded" if result and result.get("success") else "failed"
+            for name in self.reserved:
+                self.reserved[name] -= job["resources"].get(name, 0)
+            self.running -= 1
+            self._admit()
+            finished = dict(job, timings=dict(job["timings"]))
+
+        if on_done is not None:
+            try:
+                on_done(finished)
+            except Exception:
+                logging.exception(f"Completion callback of {job['stage']} job {job['job_id']} failed")
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job["finished_at"] is not None]
+        if len(finished) > MAX_FINISHED_JOBS:
+            finished.sort(key=lambda job: job["finished_at"])
+            for job in finished[:len(finished) - MAX_FINISHED_JOBS]:
+                del self.jobs[job["job_id"]]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job, timings=dict(job["timings"])) if job else None
+
+    def list(self):
+        with self.lock:
+            jobs = [dict(job, timings=dict(job["timings"])) for job in self.jobs.values()]
+        return sorted(jobs, key=lambda job: job["submitted_at"])
+
+    def counts(self):
+        with self.lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "succeeded", "failed")}
+
+    def usage(self):
+        """Reserved and total budget per resource, None where unlimited."""
+        with self.lock:
+            return {name: {"reserved": self.reserved[name], "budget": limit} for name, limit in self.budget.items()}
@@ -1,9 +1,13 @@
 import pyvips
-import os, re, time, sys
+import os, re, time, sys, csv
 import logging, warnings
 import numpy as np
-from openslide import OpenSlide
-import tifffile
+from concurrent.futures import ThreadPoolExecutor
+from slide_reader import open_slide, slide_dimensions
+import pyramid
+import metrics
+import tile_store
+from progress import Progress
 
 
 # Setup warnings and logging
@@ -12,85 +16,240 @@ warnings.filterwarnings("ignore")
 if logging.getLogger().hasHandlers():
     logging.getLogger().handlers.clear()
 
-def mergeImages(file_id_name, width, height):
-    start_time = time.time()
+# level-0 pixels per background pixel when blank cells are filled from a low-res read
+BACKGROUND_DOWNSAMPLE = 32
+# size of Merge_<id>.png relative to the slide
+MERGE_SCALE = 0.1
+
+def load_manifest(file_id_name):
+    """Read patches_info_*.csv, returns ((width, height), [(x, y, type), ...])."""
+    csv_file_path = f"./uploads/{file_id_name}/patches_info_{file_id_name}.csv"
+    cells = []
+    with open(csv_file_path, newline='') as file:
+        reader = csv.reader(file)
+        _, width, height = next(reader)[:3]
+        next(reader)  # header
+        for row in reader:
+            if len(row) >= 4:
+                cells.append((int(row[1]), int(row[2]), row[3]))
+    return (int(width), int(height)), cells
+
+
+def background_image(file_path, width, height, background):
+    """RGBA background of the given output size, resized from a cheap low-res read or a flat white fill."""
+    if background == "thumbnail" and file_path:
+        with open_slide(file_path) as reader:
+            thumbnail, _ = reader.read_thumbnail(BACKGROUND_DOWNSAMPLE)
+        image = pyvips.Image.new_from_array(np.ascontiguousarray(thumbnail))
+        image = image.resize(width / image.width, vscale=height / image.height, kernel="linear")
+        image = image.crop(0, 0, min(width, image.width), min(height, image.height))
+        return image.bandjoin(255)
+    return (pyvips.Image.black(width, height, bands=4) + 255).cast("uchar")
+
+
+def load_tiles_from_directory(directory):
+    """{(x, y): path} of the <...>_<x>_<y>.png tiles in a directory."""
+    tiles = {}
+    if not os.path.isdir(directory):
+        return tiles
+    for filename in os.listdir(directory):
+        match = re.search(r'(\d+)_(\d+)\.png$', filename)
+        if match:
+            tiles[tuple(map(int, match.groups()))] = os.path.join(directory, filename)
+    return tiles
+
 
-    # Directories containing your image tiles
-    dir1 = f"./uploads/{file_id_name}/blank/"
-    dir2 = f"./uploads/{file_id_name}/overlay/"
+def load_tiles_from_store(store):
+    """{(x, y): (store, x, y)} of the tiles in an open tile store."""
+    return {(x, y): (store, x, y) for x, y in store.positions()}
 
-    # Function to load and store tiles with coordinates
-    def load_tiles_from_directory(directory):
-        tiles = []
-        tile_size = None
 
-        for filename in os.listdir(directory):
-            if filename.endswith(".png"):
-                match = re.search(r'(\d+)_(\d+)\.png$', filename)
-                if match:
-                    x, y = map(int, match.groups())
-                    img = pyvips.Image.new_from_file(os.path.join(directory, filename))
-                    if tile_size is None:
-                        tile_size = img.width, img.height
-                    tiles.append((x, y, img))
+def tile_dimensions(source):
+    """(width, height) of a tile, a PNG path or a (tile store, x, y) entry, without decoding it."""
+    if isinstance(source, str):
+        header = pyvips.Image.new_from_file(source)
+        return header.width, header.height
+    store, x, y = source
+    height, width = store.shape(x, y)[:2]
+    return width, height
 
-        return tiles, tile_size
 
-    # Load tiles from both directories
-    tiles1, tile_size1 = load_tiles_from_directory(dir1)
-    tiles2, tile_size2 = load_tiles_from_directory(dir2)
+def store_source(store, x, y):
+    """A pyvips source reading one encoded tile straight from the store's mapping, nothing is copied up front."""
+    data = store.encoded(x, y)
+    position = 0
 
-    # Combine tiles from both directories
-    all_tiles = tiles1 + tiles2
-    tile_size = tile_size1 if tile_size1 else tile_size2
-    print(f"Tile size of {file_id_name}: ", tile_size)
+    def on_read(size):
+        nonlocal position
+        chunk = data[position:position + size]
+        position += len(chunk)
+        return bytes(chunk)
 
-    # Sort tiles by their coordinates
-    all_tiles.sort(key=lambda t: (t[1], t[0]))
+    def on_seek(offset, whence):
+        nonlocal position
+        position = [offset, position + offset, len(data) + offset][whence]
+        return position
 
-    # Determine the size of the full image
-    min_x = min(x for x, y, img in all_tiles)
-    min_y = min(y for x, y, img in all_tiles)
-    max_x = max(x for x, y, img in all_tiles)
-    max_y = max(y for x, y, img in all_tiles)
+    source = pyvips.SourceCustom()
+    source.on_read(on_read)
+    source.on_seek(on_seek)
+    return source
 
-    full_image_width = max_x - min_x + tile_size[0]
-    full_image_height = max_y - min_y + tile_size[1]
-    print("Full image width: ", full_image_width)
-    print("Full image height: ", full_image_height)
 
+def tile_image(source, access="random"):
+    """A tile as a pyvips image; raw store tiles are wrapped in place, encoded ones decoded from the mapping."""
+    if isinstance(source, str):
+        return pyvips.Image.new_from_file(source, access=access)
+    store, x, y = source
+    if store.codec == "raw":
+        shape = store.shape(x, y)
+        bands = shape[2] if len(shape) > 2 else 1
+        return pyvips.Image.new_from_memory(store.encoded(x, y), shape[1], shape[0], bands, "uchar")
+    return pyvips.Image.new_from_source(store_source(store, x, y), "", access=access)
 
-    # Create a blank image
-    full_image = pyvips.Image.black(full_image_width, full_image_height)
 
-    # Composite each tile into the correct position
-    for x, y, img in all_tiles:
-        left = x - min_x
-        top = y - min_y
-        full_image = full_image.insert(img, left, top)
-        
-    full_image.write_to_file(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png", Q=85)
+def pack_tiles(file_id_name, tiles):
+    """tiles with every PNG path swapped for an entry of one temporary tile store.
 
-    full_image = pyvips.Image.new_from_file(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png", access="sequential")
+    The PNG bytes are copied as they are, nothing is decoded. The store is
+    unlinked once mapped, so it goes away with the last lazy tile using it.
+    """
+    paths = {xy: source for xy, source in tiles.items() if isinstance(source, str)}
+    if not paths:
+        return tiles
+    path = f"./uploads/{file_id_name}/.merge_{os.getpid()}.tiles"
+    with tile_store.TileStoreWriter(path, "png") as writer:
+        for (x, y), tile_path in paths.items():
+            header = pyvips.Image.new_from_file(tile_path)
+            shape = (header.height, header.width, header.bands)
+            with open(tile_path, "rb") as f:
+                writer.add_encoded(x, y, f.read(), shape)
+    store = tile_store.TileStore(path)
+    os.remove(path)
+    return dict(tiles, **{xy: (store, *xy) for xy in paths})
 
-    # Define the crop area (left, top, width, height)
-    left = 0  # Starting x-coordinate
-    top = 0   # Starting y-coordinate
-    crop_width = width #int(input(f"Enter x dimension for {file_id}: "))
-    crop_height = height #int(input(f"Enter y dimension for {file_id}: "))
 
-    # Crop the image
-    cropped_image = full_image.crop(left, top, crop_width, crop_height)
+def shrink_tile(source, scale, cell):
+    """Decode one tile straight to the output scale, as an RGBA cell in memory; edge tiles sit on the cell's background."""
+    width, height = tile_dimensions(source)
+    cell_size = cell.width
+    tile_width = min(cell_size, max(1, round(width * scale)))
+    tile_height = min(cell_size, max(1, round(height * scale)))
+    if isinstance(source, str):
+        tile = pyvips.Image.thumbnail(source, tile_width, height=tile_height, size="force")
+    elif source[0].codec == "raw":
+        tile = tile_image(source).thumbnail_image(tile_width, height=tile_height, size="force")
+    else:
+        store, x, y = source
+        tile = pyvips.Image.thumbnail_buffer(store.encoded(x, y), tile_width, height=tile_height, size="force")
+    if tile.bands == 3:
+        tile = tile.bandjoin(255)
+    if (tile_width, tile_height) != (cell_size, cell_size):
+        tile = cell.insert(tile, 0, 0)
+    return tile.copy_memory()
+
+
+def full_size_tile(source, cell):
+    """A level-0 tile, decoded lazily top to bottom while the pyramid is written."""
+    tile = tile_image(source, access="sequential")
+    if tile.bands == 3:
+        tile = tile.bandjoin(255)
+    if (tile.width, tile.height) != (cell.width, cell.height):
+        tile = cell.insert(tile, 0, 0)
+    return tile
+
 
-    # Resize the cropped image by 10% of its original dimensions
-    resized_image = cropped_image.resize(0.1)
+def build_mosaic(file_id_name, width, height, file_path=None, background="thumbnail", scale=MERGE_SCALE, workers=4):
+    """The overlay mosaic of a slide at scale times its size, with the scale actually used.
 
-    # Save the final merged image
-    resized_image.write_to_file(f"./uploads/{file_id_name}/Merge_{file_id_name}.png", Q=85)
+    Below full size every tile is shrunk to its output cell as it is decoded
+    and the cells are joined in one arrayjoin, so no slide-sized image is
+    ever built. The cell size is rounded to whole pixels, which puts the
+    effective scale within a pixel per patch of the requested one. At full
+    size (for pyramids) the tiles stay lazy and are streamed by the writer.
+    """
+    # blank tiles are only on disk when patch.py ran with --save-blank
+    blank_tiles = load_tiles_from_directory(f"./uploads/{file_id_name}/blank/")
+    # overlays live in the slide's tile store, overlay/ PNGs are from runs before it
+    overlay_store = tile_store.open_store(file_id_name, "overlay")
+    if overlay_store is not None:
+        overlay_tiles = load_tiles_from_store(overlay_store)
+    else:
+        overlay_tiles = load_tiles_from_directory(f"./uploads/{file_id_name}/overlay/")
+    (slide_width, slide_height), cells = load_manifest(file_id_name)
+    tiles = {**blank_tiles, **overlay_tiles}
+
+    # grid step is the distance between neighbouring cells in the manifest
+    xs = sorted({x for x, y, _ in cells})
+    if len(xs) > 1:
+        patch_size = xs[1] - xs[0]
+    elif tiles:
+        patch_size = tile_dimensions(next(iter(tiles.values())))[0]
+    else:
+        patch_size = slide_width
 
-    # Remove temp file to free space
-    os.remove(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png")
-    print("Temp file removed")
+    cell_size = max(1, round(patch_size * scale))
+    effective_scale = cell_size / patch_size
+    n_cols = (max(x for x, y, _ in cells) + patch_size) // patch_size
+    n_rows = (max(y for x, y, _ in cells) + patch_size) // patch_size
+    print(f"Grid of {file_id_name}: {n_cols} x {n_rows} cells of {patch_size} px, {cell_size} px in the output")
+
+    # cells without a tile show the background, resized once to the output size
+    fill = background_image(file_path, max(1, round(slide_width * effective_scale)),
+                            max(1, round(slide_height * effective_scale)), background)
+    fill = fill.embed(0, 0, n_cols * cell_size, n_rows * cell_size, extend="white")
+    if effective_scale < 1:
+        fill = fill.copy_memory()
+
+    grid = [fill.crop(col * cell_size, row * cell_size, cell_size, cell_size)
+            for row in range(n_rows) for col in range(n_cols)]
+    positions = [(x, y) for x, y in tiles if x % patch_size == 0 and y % patch_size == 0
+                 and x // patch_size < n_cols and y // patch_size < n_rows]
+    cell_index = [(y // patch_size) * n_cols + x // patch_size for x, y in positions]
+    if effective_scale < 1:
+        progress = Progress("merge", file_id_name, total=len(positions))
+        # pyvips decodes outside the GIL, so shrinking tiles in threads scales
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            shrunk = pool.map(shrink_tile, [tiles[xy] for xy in positions], [effective_scale] * len(positions),
+                              [grid[i] for i in cell_index])
+            for i, tile in zip(cell_index, shrunk):
+                grid[i] = tile
+                progress.update(advance=1)
+        progress.finish()
+        if overlay_store is not None:
+            overlay_store.close()
+    else:
+        # every lazy tile stays open until the pyramid is written, so they all come from mapped
+        # stores rather than holding a file descriptor each
+        tiles = pack_tiles(file_id_name, tiles)
+        for xy, i in zip(positions, cell_index):
+            grid[i] = full_size_tile(tiles[xy], grid[i])
+
+    mosaic = pyvips.Image.arrayjoin(grid, across=n_cols)
+    out_width = min(mosaic.width, round(width * effective_scale))
+    out_height = min(mosaic.height, round(height * effective_scale))
+    return mosaic.crop(0, 0, out_width, out_height), effective_scale
+
+
+def mergeImages(file_id_name, width, height, file_path=None, background="thumbnail", scale=MERGE_SCALE,
+                pyramid_format=None):
+    """Write Merge_<id>.png at scale, and the full-resolution overlay pyramid when a format is given."""
+    start_time = time.time()
+
+    with metrics.stage("merge", file_id_name) as event:
+        mosaic, _ = build_mosaic(file_id_name, width, height, file_path, background, scale)
+        mosaic.write_to_file(f"./uploads/{file_id_name}/Merge_{file_id_name}.png", Q=85)
+        event.add(tiles=len(load_manifest(file_id_name)[1]), scale=scale)
+
+    if pyramid_format:
+        with metrics.stage("pyramid", file_id_name) as event:
+            # the writer streams the tiles itself, so only the start and end are reported
+            progress = Progress("pyramid", file_id_name)
+            full, _ = build_mosaic(file_id_name, width, height, file_path, background, scale=1)
+            path = pyramid.write_pyramid(full, file_id_name, pyramid_format)
+            progress.finish()
+            event.add(tiles=len(load_manifest(file_id_name)[1]), format=pyramid_format)
+        print(f"Overlay pyramid written to {path}")
 
     print(f"Image segmentation and merging of {file_id_name} completed.")
     elapsed_time = time.time() - start_time
@@ -98,24 +257,16 @@ def mergeImages(file_id_name, width, height):
     seconds = int(elapsed_time % 60)
     print(f"Elapsed time: {minutes} minutes {seconds} seconds")
     
-    return
+    return file_id_name
 
-def main(file_path):
+def main(file_path, background="thumbnail", scale=MERGE_SCALE, pyramid_format=None):
     norm_method = "Vaha"
     filename = os.path.basename(file_path)
     file_id = os.path.splitext(filename)[0]
     file_id_name = f"{file_id}_{norm_method}"
 
-    if file_path.endswith('.svs') or file_path.endswith('.tif'):
-        slide = OpenSlide(file_path)
-        width, height = slide.level_dimensions[0]
-
-    elif file_path.endswith('.bif'):
-        with tifffile.TiffFile(file_path) as tif:
-            slide_array = tif.pages[2].asarray()
-            height, width = slide_array.shape[:2]
-    else:
-        raise ValueError("Unsupported file type")
+    # read from the slide header, no pixel data is decoded
+    width, height = slide_dimensions(file_path)
 
     #create log file
     time_log_path = f"./uploads/{file_id_name}/merge-log.txt"
@@ -124,7 +275,8 @@ def main(file_path):
     with open(time_log_path, 'a') as time_log_file:
         start_time = time.time()
         try:
-            result = mergeImages(file_id_name, width, height)
+            result = mergeImages(file_id_name, width, height, file_path=file_path, background=background,
+                                 scale=scale, pyramid_format=pyramid_format)
             if result:
                 elapsed_time = time.time() - start_time
                 minutes = int(elapsed_time // 60)
@@ -136,15 +288,15 @@ def main(file_path):
                                     f"Elapsed Time: {minutes} minutes {seconds} seconds\n")
             else:
                 time_log_file.write(f"File ID: {file_id_name}, Processing Failed\n")
+            return bool(result)
         except Exception as exc:
             logging.error(f"File id {file_id_name} generated an exception: {exc}")
                 # Record the exception in the time log file
             time_log_file.write(f"File ID: {file_id_name}, Exception: {exc}\n")
+            return False
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python merge.py <filepath>")
-        sys.exit(1)
-    
-    file_path = sys.argv[1]
-    main(file_path)
\ No newline at end of file
+    # kept for existing callers, the arguments live in tia.py
+    import tia
+
+    sys.exit(tia.main(["merge"] + sys.argv[1:]))
@@ -0,0 +1,168 @@
+"""Structured per-stage metrics shared by patch, predict, count and merge.
+
+Each stage run appends one JSON line to METRICS_PATH:
+
+    with metrics.stage("merge", file_id_name) as event:
+        ...
+        event.add(tiles=len(tiles))
+
+The event carries the duration, status, tiles, nuclei, bytes read and
+written by the process during the stage (from /proc/self/io) and the
+process' peak RSS. The Flask app aggregates the file into Prometheus text
+for /metrics.
+"""
+import os, json, time, resource, threading, logging
+from contextlib import contextmanager
+
+METRICS_PATH = os.environ.get('METRICS_PATH', "./uploads/logs/metrics.jsonl")
+
+_write_lock = threading.Lock()
+
+
+def _io_counters():
+    """(bytes read, bytes written) through read()/write() by this process so far."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def peak_rss_bytes():
+    """Peak resident set of this process or any waited-for child (ru_maxrss is in KiB on Linux)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+class StageEvent:
+    def __init__(self, stage, slide):
+        self.fields = {"stage": stage, "slide": slide, "tiles": 0, "nuclei": 0}
+
+    def add(self, **values):
+        """Add to the event's counters (tiles, nuclei, ...) or set other fields."""
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and isinstance(self.fields.get(name), (int, float)):
+                self.fields[name] += value
+            else:
+                self.fields[name] = value
+
+
+def record(event):
+    os.makedirs(os.path.dirname(METRICS_PATH), exist_ok=True)
+    line = json.dumps(event, sort_keys=True) + "\n"
+    with _write_lock, open(METRICS_PATH, "a") as f:
+        f.write(line)
+
+
+@contextmanager
+def stage(name, slide):
+    """Time a stage and append its event, also when it raises."""
+    event = StageEvent(name, slide)
+    read_before, written_before = _io_counters()
+    start_time = time.time()
+    status = "ok"
+    try:
+        yield event
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        read_after, written_after = _io_counters()
+        event.fields.update({
+            "ts": round(start_time, 3),
+            "status": status,
+            "duration_seconds": round(time.time() - start_time, 3),
+            "bytes_read": read_after - read_before,
+            "bytes_written": written_after - written_before,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "pid": os.getpid(),
+        })
+        try:
+            record(event.fields)
+        except OSError as e:
+            logging.warning(f"Could not record {name} metrics: {e}")
+
+
+class MetricsAggregator:
+    """Running totals over the events file, reading only lines appended since the last call."""
+
+    def __init__(self, path=METRICS_PATH):
+        self.path = path
+        self.offset = 0
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def _update(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.offset:
+            # file was rotated or truncated, start over
+            self.offset, self.stages = 0, {}
+        with open(self.path) as f:
+            f.seek(self.offset)
+            while True:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    break  # a writer is mid-line, pick it up next time
+                self.offset += len(line.encode())
+                try:
+                    self._add(json.loads(line))
+                except (ValueError, KeyError):
+                    continue
+
+    def _add(self, event):
+        totals = self.stages.setdefault(event["stage"], {
+            "runs": {}, "duration_seconds": 0.0, "tiles": 0, "nuclei": 0, "bytes_read": 0,
+            "bytes_written": 0, "peak_rss_bytes": 0, "last_tiles_per_second": 0.0, "last_ts": 0,
+        })
+        totals["runs"][event["status"]] = totals["runs"].get(event["status"], 0) + 1
+        for name in ["duration_seconds", "tiles", "nuclei", "bytes_read", "bytes_written"]:
+            totals[name] += event.get(name, 0)
+        totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"], event.get("peak_rss_bytes", 0))
+        if event["status"] == "ok" and event.get("duration_seconds") and event["ts"] >= totals["last_ts"]:
+            totals["last_ts"] = event["ts"]
+            totals["last_tiles_per_second"] = event.get("tiles", 0) / event["duration_seconds"]
+
+    def snapshot(self):
+        with self.lock:
+            self._update()
+            return json.loads(json.dumps(self.stages))
+
+    def prometheus(self, gauges=None):
+        """Prometheus text exposition of the stage totals plus any extra {name: (help, {labels: value})} gauges."""
+        stages = self.snapshot()
+        series = [
+            ("tia_stage_runs_total", "counter", "Stage runs by status",
+             [({"stage": s, "status": status}, n) for s, t in stages.items() for status, n in t["runs"].items()]),
+            ("tia_stage_duration_seconds_total", "counter", "Time spent in each stage",
+             [({"stage": s}, t["duration_seconds"]) for s, t in stages.items()]),
+            ("tia_stage_tiles_total", "counter", "Tiles processed by each stage",
+             [({"stage": s}, t["tiles"]) for s, t in stages.items()]),
+            ("tia_stage_nuclei_total", "counter", "Nuclei counted by each stage",
+             [({"stage": s}, t["nuclei"]) for s, t in stages.items()]),
+            ("tia_stage_read_bytes_total", "counter", "Bytes read by each stage",
+             [({"stage": s}, t["bytes_read"]) for s, t in stages.items()]),
+            ("tia_stage_written_bytes_total", "counter", "Bytes written by each stage",
+             [({"stage": s}, t["bytes_written"]) for s, t in stages.items()]),
+            ("tia_stage_peak_rss_bytes", "gauge", "Highest peak RSS seen for each stage",
+             [({"stage": s}, t["peak_rss_bytes"]) for s, t in stages.items()]),
+            ("tia_stage_last_tiles_per_second", "gauge", "Throughput of the latest successful run of each stage",
+             [({"stage": s}, round(t["last_tiles_per_second"], 3)) for s, t in stages.items()]),
+        ]
+        for name, (help_text, values) in (gauges or {}).items():
+            series.append((name, "gauge", help_text, list(values)))
+
+        lines = []
+        for name, kind, help_text, samples in series:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,195 @@
+"""Slide-level columnar nucleus store.
+
+HoVerNet writes one pickled {inst_id: {"contour", "centroid", "box", "prob",
+"type"}} dict per tile. The store keeps the same data for a whole slide as
+plain NumPy columns, one .npy file each, so it opens memory-mapped and
+counting or querying millions of nuclei never builds Python objects:
+
+    centroid         (N, 2) float32  level-0 slide coordinates
+    box              (N, 4) int32    x0, y0, x1, y1, level-0 slide coordinates
+    type             (N,)   uint8    monusac class id
+    prob             (N,)   float32  type probability
+    tile             (N,)   int32    row of meta.json "tiles" the nucleus came from
+    contour_offsets  (N+1,) int64    contour i is contour_xy[offsets[i]:offsets[i + 1]]
+    contour_xy       (M, 2) int32    all contour points, level-0 slide coordinates
+
+meta.json lists the tiles as [tile_name, source_name, x, y], with x, y the
+tile's level-0 origin, in natsorted tile order. Rows are written tile by
+tile, so the tile column is sorted and one tile's nuclei are a contiguous
+row range found by binary search.
+"""
+import os, re, glob, json, shutil
+import numpy as np
+import joblib
+import tile_store
+
+STORE_DIR = "nuclei"
+# monusac classes by type id with their overlay colours
+TYPE_COLOURS = {
+    0: ("Background", (255, 255, 255, 0)), #transparent
+    1: ("Epithelial", (255, 0, 0)),
+    2: ("Lymphocyte", (255, 255, 0)),
+    3: ("Macrophage", (0, 255, 0)),
+    4: ("Neutrophil", (0, 0, 255)),
+}
+COLUMNS = {
+    "centroid": (np.float32, (2,)),
+    "box": (np.int32, (4,)),
+    "type": (np.uint8, ()),
+    "prob": (np.float32, ()),
+    "tile": (np.int32, ()),
+}
+
+
+def store_path(file_id_name):
+    return f"./uploads/{file_id_name}/{STORE_DIR}"
+
+
+def tile_origin(tile_name):
+    """Level-0 origin encoded in a tile name like <id>_<x>_<y>, (0, 0) if there is none."""
+    match = re.search(r"_(\d+)_(\d+)$", tile_name)
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+
+class NucleusStore:
+    def __init__(self, path, mmap_mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.tiles = self.meta["tiles"]
+        for name in list(COLUMNS) + ["contour_offsets", "contour_xy"]:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.type)
+
+    def contour(self, i):
+        return self.contour_xy[self.contour_offsets[i]:self.contour_offsets[i + 1]]
+
+    def tile_counts(self, n_types):
+        """(n_tiles, n_types) nucleus counts, in the order of self.tiles."""
+        flat = self.tile.astype(np.int64) * n_types + self.type
+        return np.bincount(flat, minlength=len(self.tiles) * n_types).reshape(len(self.tiles), n_types)
+
+    def tile_rows(self, tile_index):
+        """Rows of one tile's nuclei, a slice of the sorted tile column."""
+        start, stop = np.searchsorted(self.tile, [tile_index, tile_index + 1])
+        return range(int(start), int(stop))
+
+    def tile_inst_dict(self, tile_index):
+        """One tile's nuclei as the tile engine's dict, in tile-local coordinates, for overlay drawing."""
+        _, _, x, y = self.tiles[tile_index]
+        origin = np.array([x, y])
+        inst_dict = {}
+        for i in self.tile_rows(tile_index):
+            inst_dict[int(i)] = {
+                "contour": self.contour(i) - origin,
+                "centroid": self.centroid[i] - origin,
+                "box": self.box[i] - np.tile(origin, 2),
+                "prob": float(self.prob[i]),
+                "type": int(self.type[i]),
+            }
+        return inst_dict
+
+
+def open_store(file_id_name):
+    """The slide's store, or None when it has not been built."""
+    path = store_path(file_id_name)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return NucleusStore(path)
+
+
+def tile_dat_pairs(file_id_name):
+    """(tile_path, dat_path) for every segmented tile, in natsorted tile order."""
+    from natsort import natsorted
+
+    tile_paths = tile_store.cell_tile_paths(file_id_name)
+    result_dir = f"./uploads/{file_id_name}/result/"
+
+    named = [(tile_path, os.path.join(result_dir, f"{os.path.splitext(os.path.basename(tile_path))[0]}.dat"))
+             for tile_path in tile_paths]
+    if all(os.path.exists(dat_path) for _, dat_path in named):
+        return named
+
+    # results from before per-tile checkpoints are 0.dat, 1.dat, ... in natsorted tile order
+    dat_paths = natsorted(path for path in glob.glob(os.path.join(result_dir, "*.dat"))
+                          if re.fullmatch(r"\d+\.dat", os.path.basename(path)))
+    return list(zip(tile_paths, dat_paths))
+
+
+def _columns(inst_dicts_by_tile):
+    """Flatten [(tile_index, origin, inst_dict)] into the store columns."""
+    rows = {name: [] for name in COLUMNS}
+    contours = []
+    for tile_index, (x, y), inst_dict in inst_dicts_by_tile:
+        origin = np.array([x, y])
+        for nucleus in inst_dict.values():
+            rows["centroid"].append(np.asarray(nucleus["centroid"]) + origin)
+            rows["box"].append(np.asarray(nucleus["box"]) + np.tile(origin, 2))
+            rows["type"].append(nucleus["type"] or 0)
+            rows["prob"].append(nucleus.get("prob") or 0.0)
+            rows["tile"].append(tile_index)
+            contours.append(np.asarray(nucleus["contour"], dtype=np.int32).reshape(-1, 2) + origin)
+
+    columns = {}
+    for name, (dtype, shape) in COLUMNS.items():
+        columns[name] = np.array(rows[name], dtype=dtype).reshape((len(rows[name]),) + shape)
+    lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+    columns["contour_offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    columns["contour_xy"] = (np.concatenate(contours).astype(np.int32) if contours
+                             else np.zeros((0, 2), dtype=np.int32))
+    return columns
+
+
+def write_store(path, tiles, columns):
+    """Write the columns next to a temporary name, then swap the store into place."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"tiles": tiles, "count": len(columns["type"])}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def convert_tile_dats(file_id_name, pairs):
+    """Build the store from per-tile .dat files, pairs as from tile_dat_pairs."""
+    tiles = []
+    parts = []
+    for tile_index, (tile_path, dat_path) in enumerate(pairs):
+        tile_name = os.path.splitext(os.path.basename(tile_path))[0]
+        origin = tile_origin(tile_name)
+        tiles.append([tile_name, os.path.splitext(os.path.basename(dat_path))[0], *origin])
+        parts.append((tile_index, origin, joblib.load(dat_path)))
+    return write_store(store_path(file_id_name), tiles, _columns(parts))
+
+
+def convert_slide_dat(file_id_name, dat_path, tile_size):
+    """Build the store from a whole-slide .dat, nuclei grouped into tile_size grid tiles by centroid."""
+    from natsort import natsorted
+
+    nuclei = joblib.load(dat_path)
+    by_tile = {}
+    for inst_id, nucleus in nuclei.items():
+        cx, cy = nucleus["centroid"]
+        origin = (int(cx) // tile_size * tile_size, int(cy) // tile_size * tile_size)
+        by_tile.setdefault(origin, {})[inst_id] = nucleus
+
+    source_name = os.path.splitext(os.path.basename(dat_path))[0]
+    tile_names = natsorted(f"{file_id_name}_{x}_{y}" for x, y in by_tile)
+    tiles = [[tile_name, source_name, *tile_origin(tile_name)] for tile_name in tile_names]
+    # slide-level nuclei are already in slide coordinates
+    parts = [(tile_index, (0, 0), by_tile[(x, y)]) for tile_index, (_, _, x, y) in enumerate(tiles)]
+    return write_store(store_path(file_id_name), tiles, _columns(parts))
+
+
+if __name__ == "__main__":
+    # kept for existing callers, the arguments live in tia.py
+    import sys
+    import tia
+
+    sys.exit(tia.main(["store"] + sys.argv[1:]))
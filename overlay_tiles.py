@@ -0,0 +1,194 @@
+"""Overlay tiles rendered on demand from the segmentation results.
+
+Instead of drawing an overlay PNG for every tissue tile after prediction,
+a tile is drawn when the viewer asks for it: the nuclei under it come from
+the spatial index over the nucleus store, their contours are rasterized in
+one cv2.polylines call per type with the overlay palette, on top of the
+slide region (or transparent). Rendered tiles are kept in a memory LRU
+and a bounded disk LRU shared by all slides.
+"""
+import os, time, hashlib, logging, threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+import nucleus_store
+import spatial_index
+from pyramid import TileCache
+from slide_reader import open_slide
+
+RENDER_TILE_SIZE = 256
+# zoom z shows 2**z level-0 pixels per tile pixel
+MAX_RENDER_ZOOM = 6
+# contour line width at full resolution, as in the pre-rendered overlays
+LINE_THICKNESS = 4
+# nuclei whose centroid is this far outside a tile can still cross into it
+CONTOUR_MARGIN = 64
+DISK_CACHE_DIR = "./uploads/cache/overlay_tiles"
+DISK_CACHE_BYTES = int(os.environ.get('OVERLAY_DISK_CACHE_BYTES', 2 * 1024 ** 3))
+MEMORY_CACHE_BYTES = int(os.environ.get('OVERLAY_MEMORY_CACHE_BYTES', 64 * 1024 ** 2))
+# slides kept open between tile requests
+OPEN_READERS = 8
+# largest region read for one tile, beyond it (a slide without a fitting pyramid level) the base stays white
+MAX_READ_PIXELS = 2048 * 2048
+
+
+class DiskLRU:
+    """Files under a directory, least recently read removed first once over max_bytes."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{hashlib.sha1(key.encode()).hexdigest()}.png")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # mtime tracks the last read
+        return data
+
+    def put(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.directory) if entry.is_file())
+        self.size = sum(size for _, size, _ in entries)
+        # down to 90% so eviction does not run on every write
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+_memory = TileCache(MEMORY_CACHE_BYTES)
+_disk = DiskLRU(DISK_CACHE_DIR, DISK_CACHE_BYTES)
+
+
+_readers = OrderedDict()
+_readers_lock = threading.Lock()
+
+
+def _reader(file_path):
+    """{"reader", "lock"} of an open slide, shared by requests; the least recently used are closed past OPEN_READERS."""
+    key = (file_path, os.path.getmtime(file_path))
+    with _readers_lock:
+        if key in _readers:
+            _readers.move_to_end(key)
+            return _readers[key]
+        entry = _readers[key] = {"reader": open_slide(file_path), "lock": threading.Lock()}
+        while len(_readers) > OPEN_READERS:
+            _, evicted = _readers.popitem(last=False)
+            with evicted["lock"]:
+                evicted["reader"].close()
+                evicted["reader"] = None
+        return entry
+
+
+def slide_region(file_path, x, y, size, downsample):
+    """RGB level-0 region [x, x + size) x [y, y + size) shrunk by downsample, from the closest pyramid level."""
+    out_size = max(1, size // downsample)
+    canvas = np.full((out_size, out_size, 3), 255, dtype=np.uint8)
+    region = None
+    while region is None:
+        entry = _reader(file_path)
+        with entry["lock"]:
+            reader = entry["reader"]
+            if reader is None:
+                continue  # evicted while we waited, open it again
+            width, height = reader.dimensions
+            # coarsest stored level that still has at least the output resolution
+            level, level_downsample = 0, 1.0
+            for i, (level_width, _) in enumerate(reader.level_dimensions):
+                if width / level_width <= downsample:
+                    level, level_downsample = i, width / level_width
+            read_width = min(size, width - x)
+            read_height = min(size, height - y)
+            if read_width <= 0 or read_height <= 0:
+                return canvas
+            level_size = (max(1, int(read_width / level_downsample)), max(1, int(read_height / level_downsample)))
+            if level_size[0] * level_size[1] > MAX_READ_PIXELS:
+                logging.debug(f"No pyramid level of {file_path} fits {downsample}x, tile drawn without the slide")
+                return canvas
+            region = reader.read_region(x, y, *level_size, level=level)
+    region = cv2.resize(np.ascontiguousarray(region[..., :3]),
+                        (max(1, read_width // downsample), max(1, read_height // downsample)),
+                        interpolation=cv2.INTER_AREA)
+    canvas[:region.shape[0], :region.shape[1]] = region
+    return canvas
+
+
+def draw_contours(canvas, index, x, y, size, downsample):
+    """Rasterize the contours of the nuclei in a level-0 square onto canvas, batched by type."""
+    ids = index.query(rect=[x - CONTOUR_MARGIN, y - CONTOUR_MARGIN,
+                            x + size + CONTOUR_MARGIN, y + size + CONTOUR_MARGIN])
+    if len(ids) == 0:
+        return canvas
+    store = index.store
+    types = np.asarray(store.type[ids])
+    thickness = max(1, round(LINE_THICKNESS / downsample))
+    origin = np.array([x, y])
+    for type_id, (_, colour) in nucleus_store.TYPE_COLOURS.items():
+        if len(colour) == 4 and colour[3] == 0:
+            continue  # transparent class, nothing to draw
+        of_type = ids[types == type_id]
+        if len(of_type) == 0:
+            continue
+        contours = [((store.contour(i) - origin) / downsample).round().astype(np.int32) for i in of_type]
+        cv2.polylines(canvas, contours, True, tuple(colour[:3]) + (255,) * (canvas.shape[2] - 3),
+                      thickness, lineType=cv2.LINE_AA if downsample > 1 else cv2.LINE_8)
+    return canvas
+
+
+def render_tile(file_id_name, file_path, zoom, col, row, base="slide"):
+    """PNG bytes of one overlay tile, or None when the slide has no segmentation results."""
+    index = spatial_index.load_index(file_id_name)
+    if index is None:
+        return None
+    key = f"{file_id_name}:{os.path.getmtime(os.path.join(index.store.path, 'meta.json'))}:{base}:{zoom}:{col}:{row}"
+    data = _memory.get(key)
+    if data is None:
+        data = _disk.get(key)
+    if data is None:
+        start_time = time.time()
+        downsample = 2 ** zoom
+        size = RENDER_TILE_SIZE * downsample
+        x, y = col * size, row * size
+        if base == "slide" and file_path:
+            canvas = slide_region(file_path, x, y, size, downsample)
+        else:
+            canvas = np.zeros((RENDER_TILE_SIZE, RENDER_TILE_SIZE, 4), dtype=np.uint8)
+        canvas = draw_contours(canvas, index, x, y, size, downsample)
+        ok, encoded = cv2.imencode(".png", cv2.cvtColor(canvas, cv2.COLOR_RGB2BGR if canvas.shape[2] == 3
+                                                        else cv2.COLOR_RGBA2BGRA))
+        if not ok:
+            raise RuntimeError("Could not encode overlay tile")
+        data = encoded.tobytes()
+        _disk.put(key, data)
+        logging.debug(f"Rendered overlay tile {file_id_name} z{zoom} {col},{row} in {time.time() - start_time:.3f}s")
+    _memory.put(key, data)
+    return data
@@ -1,25 +1,187 @@
-import tifffile
-from PIL import Image
 import numpy as np
 import os, time, csv, logging, sys
-from datetime import datetime
-from time import sleep
-import matplotlib as mpl
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
-from openslide import OpenSlide
-from tiatoolbox import data
-from tiatoolbox.tools import stainnorm
-from tiatoolbox.wsicore.wsireader import WSIReader
-from tiatoolbox.wsicore import wsireader
+import stain
+import tissue
+import metrics
+import tile_store
+from progress import Progress
+from slide_reader import open_slide
 
+level = 0
+# level-0 size of a patch, also the grid whole-slide inference buckets nuclei into
+patch_size = 1024
+stain_method = "Vahadane"
+norm_batch_size = 16
 
-def main(file_path):
+# slide handle owned by this process (each pool worker opens its own)
+_worker_slide = None
+# (thumbnail, scale) used to fill in background patches that were never read
+_worker_thumbnail = None
+
+
+#function to read slides and convert into numpy array
+def read_slide(reader, x, y, width, height):
+    return reader.read_region(x, y, width, height, level)
+
+
+def _init_worker(file_path, background):
+    global _worker_slide, _worker_thumbnail
+    _worker_slide = open_slide(file_path)
+    _worker_thumbnail = background
+
+
+def extract_band(band):
+    """Extract, classify and encode the patches of one band of tile rows.
+
+    Returns ([(x, y, patch_type), ...] in row-major order, [(x, y, encoded cell, shape), ...]);
+    the parent appends the cells to the tile store.
+    """
+    file_id_name, ys, tissue_rows, output_dir_blank, codec, quality, patch_size, threshold_std, save_blank = band
+    reader = _worker_slide
+    img_width, img_height = reader.dimensions
+
+    # restored from the on-disk cache, the parent fits it before any worker starts
+    stain_normalizer = stain.get_normalizer(stain_method)
+    pending_cells = []
+    rows = []
+    cells = []
+
+    def save_cell_batch():
+        # apply normalization on a batch of cell images
+        normalized = stain.transform_batch(stain_normalizer, [p for _, p in pending_cells])
+        for ((x, y), _), slide_patch in zip(pending_cells, normalized):
+            cells.append((x, y, tile_store.encode_tile(slide_patch, codec, quality), slide_patch.shape))
+        pending_cells.clear()
+
+    for row, y in enumerate(ys):
+        for col, x in enumerate(range(0, img_width, patch_size)):
+            patch_filename = f"{file_id_name}_{x}_{y}.png"
+
+            # cells with no tissue in the thumbnail are background, skip the level-0 read
+            if tissue_rows is not None and not tissue_rows[row][col]:
+                if save_blank:
+                    thumbnail, scale = _worker_thumbnail
+                    slide_patch = tissue.background_patch(thumbnail, scale, x, y,
+                                                          min(patch_size, img_width - x),
+                                                          min(patch_size, img_height - y))
+                patch_std = 0
+            else:
+                # Adjust the patch size near the edges
+                slide_patch = read_slide(reader, x, y, patch_size, patch_size)
+                patch_std = np.mean(np.std(slide_patch, axis=-1))
+
+            #selecting patches
+            if patch_std > threshold_std:
+                pending_cells.append(((x, y), slide_patch))
+                if len(pending_cells) >= norm_batch_size:
+                    save_cell_batch()
+                patch_type = "cell"
+            else:
+                # blank cells live only in the csv unless asked for, merge fills them from the manifest
+                if save_blank:
+                    patch_full_path = os.path.join(output_dir_blank, patch_filename)
+                    plt.imsave(patch_full_path, slide_patch)
+                patch_type = "blank"
+
+            rows.append((x, y, patch_type))
+
+    if pending_cells:
+        save_cell_batch()
+    return rows, cells
+
+
+def generate_patches(file_path, file_id_name, output_dir_blank, cell_store_path, patch_size, threshold_std, csv_file_path, workers=1, band_rows=1, mask_threshold=None, save_blank=False, codec=tile_store.DEFAULT_CODEC, quality=tile_store.DEFAULT_QUALITY):
+    global _worker_slide, _worker_thumbnail
+    reader = open_slide(file_path)
+    img_width, img_height = reader.dimensions
+    print(f"Image dimensions: {img_width}x{img_height}")
+
+    # tissue detection on a thumbnail, only grid cells touching tissue are read at level 0
+    if mask_threshold is not None:
+        tissue_cells, thumbnail, scale = tissue.detect_tissue_cells(reader, patch_size, mask_threshold)
+        background = (thumbnail, scale)
+        print(f"Grid cells with tissue: {int(tissue_cells.sum())}/{tissue_cells.size}")
+    else:
+        tissue_cells, background = None, None
+
+    # fit once here so every worker only loads the cached stain matrix
+    stain.get_normalizer(stain_method)
+
+    # split the tile grid into bands of tile rows
+    tile_rows = list(range(0, img_height, patch_size))
+    bands = [(file_id_name, tile_rows[i:i + band_rows],
+              None if tissue_cells is None else tissue_cells[i:i + band_rows],
+              output_dir_blank, codec, quality, patch_size, threshold_std, save_blank)
+             for i in range(0, len(tile_rows), band_rows)]
+    tile_cols = len(range(0, img_width, patch_size))
+    progress = Progress("patch", file_id_name, total=len(tile_rows) * tile_cols)
+
+    # every cell patch goes into one tile store, written here as the bands come back
+    band_results = []
+    with tile_store.TileStoreWriter(cell_store_path, codec, quality,
+                                    replaces=tile_store.legacy_dir(file_id_name)) as cell_store:
+        def collect(band, result):
+            rows, cells = result
+            band_results.append(rows)
+            for x, y, data, shape in cells:
+                cell_store.add_encoded(x, y, data, shape)
+            progress.update(advance=len(band[1]) * tile_cols)
+
+        if workers > 1:
+            # workers open their own slide handle, so drop ours before they start
+            reader.close()
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(file_path, background)) as executor:
+                # map yields in submission order, which keeps the csv deterministic
+                for band, result in zip(bands, executor.map(extract_band, bands)):
+                    collect(band, result)
+        else:
+            _worker_slide, _worker_thumbnail = reader, background
+            try:
+                for band in bands:
+                    collect(band, extract_band(band))
+            finally:
+                reader.close()
+                _worker_slide, _worker_thumbnail = None, None
+
+    total_patches = 0
+    patches_with_cells = 0
+    patches_without_cells = 0
+
+    with open(csv_file_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Lvl0:", img_width, img_height])
+        writer.writerow(["No.", "X", "Y", "Type"])
+
+        for rows in band_results:
+            for x, y, patch_type in rows:
+                total_patches += 1
+                if patch_type == "cell":
+                    patches_with_cells += 1
+                else:
+                    patches_without_cells += 1
+
+                #coordinate records
+                writer.writerow([total_patches, x, y, patch_type])
+
+    progress.finish(tissue_tiles=patches_with_cells)
+
+    return total_patches, patches_with_cells, patches_without_cells
+
+
+def main(file_path, workers=1, threshold_std=5, mask_threshold=None, use_tissue_mask=True, save_blank=False,
+         codec=tile_store.DEFAULT_CODEC, quality=tile_store.DEFAULT_QUALITY):
     try:
         #file_path = os.path.join(folder_path, f"{file_id}.bif")
 
         # documenting log
         log_file = f"./uploads/ProcessLog.txt"
-        logging.basicConfig(filename=log_file, filemode='a', 
+        logging.basicConfig(filename=log_file, filemode='a',
                             format='%(asctime)s - %(levelname)s - %(message)s',
                             level=logging.INFO)
 
@@ -29,110 +191,35 @@ def main(file_path):
         file_id = os.path.splitext(filename)[0]
         file_id_name = f"{file_id}_{norm_method}"
         output_dir_blank = os.path.join(f"./uploads/{file_id_name}/blank/") #need to change this
-        output_dir_cell = os.path.join(f"./uploads/{file_id_name}/cell/")
+        cell_store_path = tile_store.store_path(file_id_name)
         csv_file_path = os.path.join(f"./uploads/{file_id_name}/patches_info_{file_id_name}.csv")
-        patch_size = 1024
-        threshold_std = 5
+        # thumbnail averaging softens the stain, so the mask is looser than the level-0 check
+        if mask_threshold is None:
+            mask_threshold = threshold_std / 2
+        if not use_tissue_mask:
+            mask_threshold = None
 
         #create directories if not exist
-        os.makedirs(output_dir_blank, exist_ok=True)
-        os.makedirs(output_dir_cell, exist_ok=True)
-
-        #initialize counters
-        level=0
-        total_patches = 0
-        patches_with_cells = 0
-        patches_without_cells = 0
-
-        #function to read slides and convert into numpy array
-        def read_slide(image_data, x, y, width, height, if_openslide = True):
-            if if_openslide:
-                region = image_data.read_region((x, y), level, (width, height))
-                region = region.convert('RGB')
-                region = np.asarray(region)
-                return region
-            else:
-                img_height, img_width, _ = image_data.shape
-                # Ensure the requested patch stays within bounds
-                width = min(width, img_width - x)  # Adjust width if it exceeds the image width
-                height = min(height, img_height - y)  # Adjust height if it exceeds the image height
-                    
-                region = image_data[y:y + height, x:x + width]
-                return np.asarray(region)
-        
-        def generate_patches(image_data, if_openslide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path, total_patches, patches_with_cells, patches_without_cells):
-            if if_openslide:
-                img_width, img_height = image_data.level_dimensions[0]
-            else:
-                img_height, img_width, _ = image_data.shape
-            print(f"Image dimensions: {img_width}x{img_height}")
-            with open(csv_file_path, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Lvl0:", img_width, img_height])
-                writer.writerow(["No.", "X", "Y", "Type"])
-
-                for y in range(0, img_height, patch_size):
-                        for x in range(0, img_width, patch_size):
-                            # Adjust the patch size near the edges
-                            slide_patch = read_slide(image_data, x, y, patch_size, patch_size, if_openslide)
-                            total_patches += 1
-
-                            patch_std = np.mean(np.std(slide_patch, axis=-1))
-                            patch_filename = f"{file_id_name}_{x}_{y}.png"
-
-                            #selecting patches
-                            if patch_std > threshold_std:
-                                # Apply normalization on cell image
-                                target_image = data.stain_norm_target()
-                                stain_normalizer = stainnorm.get_normalizer("Vahadane")
-                                stain_normalizer.fit(target_image)
-
-                                slide_patch = stain_normalizer.transform(slide_patch.copy())
-                                patch_full_path = os.path.join(output_dir_cell, patch_filename)
-                                patches_with_cells += 1
-                                patch_type = "cell"
-                            else:
-                                patch_full_path = os.path.join(output_dir_blank, patch_filename)
-                                patches_without_cells += 1
-                                patch_type = "blank"
-
-                            plt.imsave(patch_full_path, slide_patch)
-                            #print(f"Saved patch {total_patches}: {patch_full_path}")
-
-                            #coordinate records
-                            writer.writerow([total_patches, x, y, patch_type])
-            return total_patches, patches_with_cells, patches_without_cells
-        
-        start_time = time.time()
+        if save_blank:
+            os.makedirs(output_dir_blank, exist_ok=True)
 
-        #if openslide cannot open use tifffile
-        # Load the image using tifffile
-
-        if file_path.endswith('.svs') or file_path.endswith('.tif'):
-            slide = OpenSlide(file_path)
-            if_openslide = True
-
-        elif file_path.endswith('.bif'):
-            with tifffile.TiffFile(file_path) as tif:
-                slide_array = tif.pages[2].asarray()
-                if_openslide = False
-        else:
-            raise ValueError("Unsupported file type")
-
-        #with tifffile.TiffFile(file_path) as tif:
-            #slide = tif.pages[2].asarray()
+        start_time = time.time()
 
         #generate patches and save the patches
-        total_patches, patches_with_cells, patches_without_cells = generate_patches(
-            slide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path,
-            total_patches, patches_with_cells, patches_without_cells)
-        
+        with metrics.stage("patch", file_id_name) as event:
+            total_patches, patches_with_cells, patches_without_cells = generate_patches(
+                file_path, file_id_name, output_dir_blank, cell_store_path, patch_size, threshold_std,
+                csv_file_path, workers=workers, mask_threshold=mask_threshold, save_blank=save_blank,
+                codec=codec, quality=quality)
+            event.add(tiles=total_patches, tissue_tiles=patches_with_cells, workers=workers, codec=codec,
+                      bytes_stored=os.path.getsize(cell_store_path))
+
         #print(f"Patch extraction of {file_id} completed.")
         #print(f"Total patches generated: {total_patches}")
         #print(f"Patches with cells: {patches_with_cells}")
         #print(f"Patches without cells: {patches_without_cells}")
 
-        
+
 
         end_time = time.time()
 
@@ -147,26 +234,26 @@ def main(file_path):
         Total patches generated: {total_patches}
         Patches with cells: {patches_with_cells}
         Patches without cells: {patches_without_cells}
+        Workers: {workers}
         Elapsed time: {minutes} minutes {seconds} seconds
         """
         print(summary)
 
         logging.info(f"Total patches: {total_patches}, with cells: {patches_with_cells}, without cells: {patches_without_cells}")
-        logging.info(f"Process completed in {time.time() - start_time:.2f} seconds")
+        logging.info(f"Process completed in {time.time() - start_time:.2f} seconds with {workers} worker(s)")
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         print(f"An error occurred: {e}")
-    
-    return 
+        return False
+
+    return True
+
+
 
-            
-    
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python patch.py <filepath>")
-        sys.exit(1)
-    
-    file_path = sys.argv[1]
-    main(file_path)
\ No newline at end of file
+    # kept for existing callers, the arguments live in tia.py
+    import tia
+
+    sys.exit(tia.main(["patch"] + sys.argv[1:]))
@@ -0,0 +1,307 @@
+"""End-to-end streaming pipeline: extract -> normalize -> segment -> count.
+
+The stages run in their own threads and hand tiles over through bounded
+queues, so slide reading, stain normalization, HoVerNet and counting overlap
+instead of waiting on each other through cell/ and result/ on disk.
+
+Usage: python tia.py process <filepath> [--save-patches] [--no-overlays]
+"""
+import os, sys, csv, time, shutil, logging, tempfile, threading, queue
+from collections import Counter
+import numpy as np
+import joblib
+from PIL import Image
+from natsort import natsorted
+
+import stain
+import tissue
+import patch
+import predict
+import metrics
+import tile_store
+import nucleus_store
+from progress import Progress
+from slide_reader import open_slide
+
+patch_size = 1024
+level = 0
+
+# marks the end of a stage's output
+DONE = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+def _put(q, item, abort):
+    # a failed downstream stage must not leave us blocked on a full queue
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+    raise PipelineAborted()
+
+
+def _get(q, abort):
+    while not abort.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    raise PipelineAborted()
+
+
+class SlidePipeline:
+    def __init__(self, file_path, threshold_std=5, mask_threshold=None, save_patches=False,
+                 render_overlays=True, norm_workers=2, batch_size=16, queue_size=32, segmentor=None,
+                 overrides=None):
+        self.file_path = file_path
+        filename = os.path.basename(file_path)
+        file_id = os.path.splitext(filename)[0]
+        self.file_id_name = f"{file_id}_Vaha"
+        self.out_dir = f"./uploads/{self.file_id_name}"
+        self.threshold_std = threshold_std
+        self.mask_threshold = threshold_std / 2 if mask_threshold is None else mask_threshold
+        self.save_patches = save_patches
+        self.render_overlays = render_overlays
+        self.norm_workers = norm_workers
+        self.batch_size = batch_size
+        self.segmentor = segmentor
+        self.overrides = overrides
+        # tile store writers, opened by run()
+        self.cell_store = None
+        self.overlay_store = None
+
+        self.to_normalize = queue.Queue(maxsize=queue_size)
+        self.to_segment = queue.Queue(maxsize=queue_size)
+        self.to_count = queue.Queue(maxsize=queue_size)
+        self.abort = threading.Event()
+        self.errors = []
+
+        self.manifest = []  # (x, y, type) for every grid cell
+        self.stage_seconds = Counter()
+        self.stage_lock = threading.Lock()
+
+    def _stage(self, name, fn, *args):
+        def run():
+            start_time = time.time()
+            try:
+                fn(*args)
+            except PipelineAborted:
+                pass
+            except Exception as e:
+                logging.exception(f"Pipeline stage {name} failed")
+                self.errors.append(f"{name}: {e}")
+                self.abort.set()
+            finally:
+                with self.stage_lock:
+                    self.stage_seconds[name] += time.time() - start_time
+        return threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+
+    def extract(self):
+        with open_slide(self.file_path) as reader:
+            img_width, img_height = reader.dimensions
+            self.dimensions = (img_width, img_height)
+            tissue_cells, _, _ = tissue.detect_tissue_cells(reader, patch_size, self.mask_threshold)
+
+            for row, y in enumerate(range(0, img_height, patch_size)):
+                for col, x in enumerate(range(0, img_width, patch_size)):
+                    patch_type = "blank"
+                    if tissue_cells[row, col]:
+                        slide_patch = reader.read_region(x, y, patch_size, patch_size, level)
+                        if np.mean(np.std(slide_patch, axis=-1)) > self.threshold_std:
+                            patch_type = "cell"
+                            _put(self.to_normalize, (x, y, slide_patch), self.abort)
+                    self.manifest.append((x, y, patch_type))
+
+        for _ in range(self.norm_workers):
+            _put(self.to_normalize, DONE, self.abort)
+
+    def normalize(self, stain_normalizer):
+        while True:
+            item = _get(self.to_normalize, self.abort)
+            if item is DONE:
+                _put(self.to_segment, DONE, self.abort)
+                return
+            x, y, slide_patch = item
+            slide_patch = stain_normalizer.transform(slide_patch.copy())
+            tile_name = f"{self.file_id_name}_{x}_{y}"
+            if self.cell_store is not None:
+                self.cell_store.add(x, y, slide_patch)
+            _put(self.to_segment, (tile_name, slide_patch), self.abort)
+
+    def segment(self):
+        segmentor, settings = self.segmentor, None
+        result_dir = os.path.join(self.out_dir, "result")
+        scratch_dir = tempfile.mkdtemp(prefix=f"{self.file_id_name}_", dir=tile_store.scratch_root())
+        finished_normalizers = 0
+        batch = []
+
+        def run_batch():
+            nonlocal segmentor, settings
+            # the tile engine takes image paths, so the batch goes through uncompressed scratch files
+            batch_dir = tempfile.mkdtemp(dir=scratch_dir)
+            tile_paths = []
+            for tile_name, slide_patch in batch:
+                tile_path = os.path.join(batch_dir, f"{tile_name}.png")
+                Image.fromarray(slide_patch).save(tile_path, compress_level=0)
+                tile_paths.append(tile_path)
+
+            if settings is None:
+                # tuned (and calibrated if needed) on the first batch of real tiles
+                segmentor, settings = predict.prepare_segmentor(self.overrides, segmentor,
+                                                                tile_paths[:predict.CALIBRATION_TILES])
+            outputs = segmentor.predict(tile_paths, save_dir=os.path.join(batch_dir, "out"), mode="tile",
+                                        device=settings["device"], crash_on_exception=True)
+            outputs = {os.path.basename(str(img_path)): str(save_path) for img_path, save_path in outputs}
+
+            for (tile_name, slide_patch), tile_path in zip(batch, tile_paths):
+                dat_path = predict.output_dat_path(outputs[os.path.basename(tile_path)])
+                tile_preds = joblib.load(dat_path)
+                # scratch lives on another filesystem, so copy it next to the results before the checkpoint move
+                staged_path = os.path.join(result_dir, f".{tile_name}.dat.tmp")
+                shutil.copyfile(dat_path, staged_path)
+                final_path = predict.record_completed(result_dir, tile_name, staged_path)
+                _put(self.to_count, (tile_name, predict.tile_name_of(final_path), slide_patch, tile_preds), self.abort)
+
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            batch.clear()
+
+        try:
+            while finished_normalizers < self.norm_workers:
+                item = _get(self.to_segment, self.abort)
+                if item is DONE:
+                    finished_normalizers += 1
+                    continue
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    run_batch()
+            if batch:
+                run_batch()
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+        _put(self.to_count, DONE, self.abort)
+
+    def count(self):
+        """Runs in the calling thread, returns {tile_name: (dat name, class counts)}."""
+        tile_counts = {}
+        # how many tissue tiles there are is only known once extract is done, so the total stays open
+        progress = Progress("process", self.file_id_name)
+        nuclei = 0
+        while True:
+            item = _get(self.to_count, self.abort)
+            if item is DONE:
+                progress.finish(scanned=len(self.manifest), nuclei=nuclei)
+                return tile_counts
+            tile_name, dat_name, slide_patch, tile_preds = item
+            class_counts = predict.count_classes(tile_preds)
+            tile_counts[tile_name] = (dat_name, class_counts)
+            nuclei += sum(class_counts.values())
+            progress.update(advance=1, scanned=len(self.manifest), nuclei=nuclei)
+            if self.overlay_store is not None:
+                x, y = nucleus_store.tile_origin(tile_name)
+                self.overlay_store.add(x, y, predict.render_overlay(slide_patch, tile_preds))
+
+    def write_csvs(self, tile_counts):
+        img_width, img_height = self.dimensions
+        with open(os.path.join(self.out_dir, f"patches_info_{self.file_id_name}.csv"), mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Lvl0:", img_width, img_height])
+            writer.writerow(["No.", "X", "Y", "Type"])
+            for number, (x, y, patch_type) in enumerate(self.manifest, start=1):
+                writer.writerow([number, x, y, patch_type])
+
+        # same row order as cellsCount, which walks the natsorted tile names
+        total_counts = Counter()
+        with open(os.path.join(self.out_dir, f"nucleus_info_{self.file_id_name}.csv"), mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(predict.NUCLEUS_CSV_HEADER)
+            for tile_name in natsorted(tile_counts):
+                # the Dat File column names the tile's result/<dat>.dat, as cellsCount writes it
+                dat_name, class_counts = tile_counts[tile_name]
+                total_counts.update(class_counts)
+                writer.writerow(predict.count_row(tile_name, dat_name, class_counts))
+            writer.writerow(predict.count_row("END", "Total", total_counts))
+        return total_counts
+
+    def run(self):
+        # every tile is segmented again, and the patches' fingerprint is unknown until the store is written,
+        # so tile mode predict never resumes from these results
+        predict.reset_checkpoint(os.path.join(self.out_dir, "result"), None)
+        # patches and overlays each go into one tile store, swapped into place once every stage is done
+        if self.save_patches:
+            self.cell_store = tile_store.TileStoreWriter(tile_store.store_path(self.file_id_name),
+                                                         replaces=tile_store.legacy_dir(self.file_id_name))
+        if self.render_overlays:
+            self.overlay_store = tile_store.TileStoreWriter(tile_store.store_path(self.file_id_name, "overlay"),
+                                                            replaces=tile_store.legacy_dir(self.file_id_name, "overlay"))
+
+        start_time = time.time()
+        stain_normalizer = stain.get_normalizer(patch.stain_method)
+        threads = [self._stage("extract", self.extract), self._stage("segment", self.segment)]
+        threads += [self._stage("normalize", self.normalize, stain_normalizer) for _ in range(self.norm_workers)]
+        for thread in threads:
+            thread.start()
+
+        tile_counts = {}
+        try:
+            tile_counts = self.count()
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            logging.exception("Pipeline stage count failed")
+            self.errors.append(f"count: {e}")
+            self.abort.set()
+
+        for thread in threads:
+            thread.join()
+        for store in (self.cell_store, self.overlay_store):
+            if store is None:
+                continue
+            if self.errors:
+                store.abort()
+            else:
+                store.close()
+        if self.errors:
+            raise RuntimeError("; ".join(self.errors))
+
+        total_counts = self.write_csvs(tile_counts)
+        elapsed_time = time.time() - start_time
+        return tile_counts, total_counts, elapsed_time
+
+
+def main(file_path, **options):
+    logging.info(f"Starting pipeline for file: {file_path}")
+    pipeline = SlidePipeline(file_path, **options)
+    with metrics.stage("process", pipeline.file_id_name) as event:
+        tile_counts, total_counts, elapsed_time = pipeline.run()
+        # busy seconds per pipeline thread, the stages overlap so they add up to more than the duration
+        event.add(tiles=len(pipeline.manifest), tissue_tiles=len(tile_counts), nuclei=sum(total_counts.values()),
+                  stage_busy_seconds={name: round(busy, 3) for name, busy in pipeline.stage_seconds.items()})
+
+    minutes = int(elapsed_time // 60)
+    seconds = int(elapsed_time % 60)
+    stage_times = ", ".join(f"{name} {busy:.0f}s" for name, busy in pipeline.stage_seconds.items())
+    summary = f"""
+    File Processed: {file_path}
+    File Name: {pipeline.file_id_name}
+    Total patches generated: {len(pipeline.manifest)}
+    Patches with cells: {len(tile_counts)}
+    Nuclei counted: {sum(total_counts.values())}
+    Stage busy time: {stage_times}
+    Elapsed time: {minutes} minutes {seconds} seconds
+    """
+    print(summary)
+    logging.info(f"Pipeline completed for {pipeline.file_id_name} in {elapsed_time:.2f} seconds")
+    return pipeline.file_id_name
+
+
+if __name__ == "__main__":
+    # kept for existing callers, the arguments live in tia.py
+    import tia
+
+    sys.exit(tia.main(["process"] + sys.argv[1:]))
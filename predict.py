@@ -1,21 +1,17 @@
 import logging
 from logging.handlers import RotatingFileHandler
-import cv2
 import joblib
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import numpy as np
-import os, glob, time, re, sys
+import os, glob, time, sys, json, shutil, tempfile
 import csv
-import pyvips
-from openslide import OpenSlide
-from tiatoolbox import logger
-from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
-from tiatoolbox.utils.misc import imread
-from tiatoolbox.utils.visualization import overlay_prediction_contours
-from natsort import natsorted
 from collections import Counter
 import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import tuning
+import nucleus_store
+import tile_store
+import metrics
+from progress import Progress
 
 log_directory = "./uploads/logs"
 os.makedirs(log_directory, exist_ok=True)
@@ -31,16 +27,143 @@ logging.basicConfig(level=logging.INFO,
                         RotatingFileHandler(log_file_path, maxBytes=10485760, backupCount=5)
                     ])
 
-def predict(file_id_name):
-    """Run the prediction for a given file_id and normalization method."""
+# pretrained HoVerNet weights used for every slide
+MODEL_NAME = "hovernet_fast-monusac"
+# tiles timed per batch size when calibrating
+CALIBRATION_TILES = 2
+
+# monusac classes, in the column order of nucleus_info_*.csv
+NUCLEUS_CSV_HEADER = ["Tile", "Dat File", "Background", "Epithelial", "Lymphocyte", "Macrophage", "Neutrophil"]
+TYPE_COLOURS = nucleus_store.TYPE_COLOURS
+
+
+def build_segmentor(settings=None):
+    """Create the nucleus segmentor, loading the pretrained model."""
+    # torch and the tiatoolbox engine take seconds to import, only inference pays for them
+    from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
+
+    if settings is None:
+        settings = tuning.resolve_settings()
+    segmentor = NucleusInstanceSegmentor(
+        pretrained_model=MODEL_NAME,
+        num_loader_workers=settings["num_loader_workers"],
+        num_postproc_workers=settings["num_postproc_workers"],
+        batch_size=settings["batch_size"],
+    )
+    tuning.apply_settings(segmentor, settings)
+    return segmentor
+
+
+def prepare_segmentor(overrides=None, segmentor=None, sample_tiles=None):
+    """Resolve inference settings (calibrating on sample_tiles if needed), returns (segmentor, settings)."""
+    if segmentor is None:
+        segmentor = build_segmentor(tuning.resolve_settings(overrides))
+    settings = tuning.resolve_settings(overrides, segmentor=segmentor, sample_tiles=sample_tiles)
+    tuning.apply_settings(segmentor, settings)
+    return segmentor, settings
+
+
+# tiles handed to the segmentor per checkpoint, a crash loses at most one chunk
+CHECKPOINT_TILES = 64
+# one json line per tile whose .dat is complete, appended as tiles finish, after a first line
+# with the cell_digest() of the patches they were segmented from
+CHECKPOINT_FILE = "completed.jsonl"
+
+
+def output_dat_path(save_path):
+    """Path of the .dat the tile engine wrote for an output entry."""
+    save_path = str(save_path)
+    return save_path if save_path.endswith(".dat") else f"{save_path}.dat"
+
+
+def load_checkpoint(result_dir):
+    """{tile_name: size of its .dat} for tiles recorded as complete."""
+    completed = {}
+    try:
+        with open(os.path.join(result_dir, CHECKPOINT_FILE)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line of a crashed run
+                if "tile" in entry:
+                    completed[entry["tile"]] = entry["size"]
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def checkpoint_source(result_dir):
+    """cell_digest() of the patches the checkpointed tiles were segmented from, None when unknown."""
+    try:
+        with open(os.path.join(result_dir, CHECKPOINT_FILE)) as f:
+            return json.loads(f.readline()).get("source")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def reset_checkpoint(result_dir, source):
+    """Drop every result and start an empty checkpoint for patches with the given cell_digest()."""
+    shutil.rmtree(result_dir, ignore_errors=True)
+    os.makedirs(result_dir)
+    with open(os.path.join(result_dir, CHECKPOINT_FILE), "w") as f:
+        f.write(json.dumps({"source": source}) + "\n")
+
+
+def record_completed(result_dir, tile_name, dat_path):
+    """Move a finished .dat into place as result/<tile_name>.dat and checkpoint it."""
+    final_path = os.path.join(result_dir, f"{tile_name}.dat")
+    os.replace(dat_path, final_path)
+    with open(os.path.join(result_dir, CHECKPOINT_FILE), "a") as f:
+        f.write(json.dumps({"tile": tile_name, "size": os.path.getsize(final_path)}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return final_path
+
+
+def pending_tiles(tile_paths, result_dir):
+    """Tiles without a complete .dat; missing, truncated or unrecorded outputs are redone."""
+    completed = load_checkpoint(result_dir)
+    pending = []
+    for tile_path in tile_paths:
+        tile_name = os.path.splitext(os.path.basename(tile_path))[0]
+        dat_path = os.path.join(result_dir, f"{tile_name}.dat")
+        if tile_name not in completed or not os.path.exists(dat_path) \
+                or os.path.getsize(dat_path) != completed[tile_name]:
+            pending.append(tile_path)
+    return pending
+
+
+# tile stores opened by this process, keyed by path and mtime so a rewritten store is reopened;
+# pool workers read many tiles of the same store
+_open_tile_stores = {}
+
+
+def read_cell_tile(tile_path, store_path=None):
+    """RGB pixels of a cell patch, from the tile store when given, else from its PNG."""
+    if store_path is None:
+        from tiatoolbox.utils.misc import imread
+
+        return imread(tile_path)
+    key = (store_path, os.path.getmtime(store_path))
+    if key not in _open_tile_stores:
+        for stale in [k for k in _open_tile_stores if k[0] == store_path]:
+            _open_tile_stores.pop(stale).close()
+        _open_tile_stores[key] = tile_store.TileStore(store_path)
+    return _open_tile_stores[key].read(*nucleus_store.tile_origin(tile_name_of(tile_path)))
+
+
+def predict(file_id_name, segmentor=None, overrides=None):
+    """Run the prediction for a given file_id and normalization method.
+
+    Pass an already built segmentor to reuse a loaded model across slides, and
+    overrides ({"device": ..., "batch_size": ..., ...}) to bypass auto-tuning.
+    """
     full_id = file_id_name
     logging.info(f"Processing file id: {full_id}")
     
-    tile_dir = f"./uploads/{full_id}/cell/"
     save_dir_base = f"./uploads/{full_id}/result/"
-
-    tile_paths = glob.glob(os.path.join(tile_dir, "*.png"))
-    tile_paths = natsorted(tile_paths)
+    tile_paths = tile_store.cell_tile_paths(full_id)
 
     if not tile_paths:
         logging.warning(f"No tiles found for file id: {full_id}")
@@ -50,17 +173,64 @@ def predict(file_id_name):
     start_time = time.time()
 
     try:
-        # Initialize the segmentor
-        inst_segmentor = NucleusInstanceSegmentor(
-            pretrained_model="hovernet_fast-monusac",
-            num_loader_workers=2,
-            num_postproc_workers=2,
-            batch_size=4,
-        )
-
-        # Perform segmentation on the tile
-        inst_segmentor.predict(tile_paths, save_dir=save_dir_base, mode="tile", device='cuda', crash_on_exception=True)
-        
+        with metrics.stage("predict", full_id) as event:
+            os.makedirs(save_dir_base, exist_ok=True)
+            source = tile_store.cell_digest(full_id)
+            if checkpoint_source(save_dir_base) != source:
+                # results of patches that were since rewritten (re-patched or restored) cannot be resumed
+                logging.info(f"Patches of {full_id} changed since the last prediction, segmenting every tile")
+                reset_checkpoint(save_dir_base, source)
+            # leftovers of an interrupted chunk are never trusted
+            for stale_dir in glob.glob(os.path.join(save_dir_base, ".chunk_*")):
+                shutil.rmtree(stale_dir, ignore_errors=True)
+
+            todo = pending_tiles(tile_paths, save_dir_base)
+            progress = Progress("predict", full_id, total=len(tile_paths))
+            progress.update(done=len(tile_paths) - len(todo))
+            if len(todo) < len(tile_paths):
+                logging.info(f"Resuming {full_id}: {len(tile_paths) - len(todo)}/{len(tile_paths)} tiles already segmented")
+
+            store = tile_store.open_store(full_id)
+            scratch_dir = tempfile.mkdtemp(prefix=f"{full_id}_", dir=tile_store.scratch_root()) if store else None
+
+            def segmentor_inputs(paths, name):
+                # the tile engine takes image paths, so patches from the tile store go through uncompressed scratch files
+                if store is None:
+                    return paths
+                out_dir = os.path.join(scratch_dir, name)
+                os.makedirs(out_dir, exist_ok=True)
+                names = [tile_name_of(path) for path in paths]
+                return store.export_png([nucleus_store.tile_origin(n) for n in names], out_dir, names)
+
+            try:
+                if todo:
+                    # Initialize the segmentor unless a warm one was handed in, then tune it for this machine
+                    inst_segmentor, settings = prepare_segmentor(
+                        overrides, segmentor, segmentor_inputs(todo[:CALIBRATION_TILES], "calibration"))
+
+                # Perform segmentation on the tiles, one checkpointed chunk at a time
+                for chunk_start in range(0, len(todo), CHECKPOINT_TILES):
+                    chunk = todo[chunk_start:chunk_start + CHECKPOINT_TILES]
+                    chunk_dir = os.path.join(save_dir_base, f".chunk_{chunk_start}")
+                    inputs = segmentor_inputs(chunk, f"chunk_{chunk_start}")
+                    outputs = inst_segmentor.predict(inputs, save_dir=chunk_dir, mode="tile", device=settings["device"], crash_on_exception=True)
+
+                    for img_path, save_path in outputs:
+                        tile_name = os.path.splitext(os.path.basename(str(img_path)))[0]
+                        record_completed(save_dir_base, tile_name, output_dat_path(save_path))
+                    shutil.rmtree(chunk_dir, ignore_errors=True)
+                    if scratch_dir:
+                        shutil.rmtree(os.path.join(scratch_dir, f"chunk_{chunk_start}"), ignore_errors=True)
+                    progress.update(advance=len(chunk))
+                    logging.info(f"Segmented {min(chunk_start + CHECKPOINT_TILES, len(todo))}/{len(todo)} pending tiles")
+            finally:
+                if store is not None:
+                    store.close()
+                    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+            event.add(tiles=len(todo), resumed_tiles=len(tile_paths) - len(todo))
+            progress.finish()
+
         # Log checkpoint timer
         elapsed_time = time.time() - start_time
         minutes = int(elapsed_time // 60)
@@ -75,94 +245,146 @@ def predict(file_id_name):
     #return full_id
     return True
 
-def cellsCount(file_id_name):
-    try:
-        ## Overlay image making
-        # Load each .dat file collect class count and overlay the image 
-        dat_dir = f"./uploads/{file_id_name}/result/"  # Directory containing the .dat files
-        overlaid_dir = f"./uploads/{file_id_name}/overlay/" 
+def count_classes(tile_preds):
+    """Count nuclei per class id in one tile's predictions."""
+    return Counter(nucleus["type"] for nucleus in tile_preds.values())
 
-        os.makedirs(overlaid_dir, exist_ok=True)
-        dat_paths = natsorted(glob.glob(os.path.join(dat_dir, "*.dat")))
 
-        tile_dir = f"./uploads/{file_id_name}/cell/"
-        csv_file_path = f"./uploads/{file_id_name}/nucleus_info_{file_id_name}.csv"  # Path for the CSV file
+def count_row(tile_name, dat_name, class_counts):
+    return [tile_name, dat_name] + [class_counts.get(class_id, 0) for class_id in range(len(TYPE_COLOURS))]
 
-        tile_paths = glob.glob(os.path.join(tile_dir, "*.png"))
-        sorted_tile_paths = natsorted(tile_paths)
-        tile_paths = sorted_tile_paths
 
-        start_time = time.time()
+def render_overlay(tile_img, tile_preds):
+    """Draw the predicted nucleus contours on a tile, coloured by type."""
+    from tiatoolbox.utils.visualization import overlay_prediction_contours
 
-        total_counts = Counter()
+    return overlay_prediction_contours(
+        canvas=tile_img,
+        inst_dict=tile_preds,
+        draw_dot=False,
+        type_colours=TYPE_COLOURS,
+        line_thickness=4,
+    )
 
-        ## Open CSV file to record nucleus counts
-        with open(csv_file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Tile", "Dat File", "Background", "Epithelial", "Lymphocyte", "Macrophage", "Neutrophil"])
-            
-            # Loop through all .dat files in the directory
-            for i in range(len(tile_paths)):
-                # Load the predictions
-                tile_preds = joblib.load(dat_paths[i])
-                tile_name = os.path.splitext(os.path.basename(tile_paths[i]))[0]
-                dat_name = os.path.splitext(os.path.basename(dat_paths[i]))[0]
-                print(f"Tile with dat code: ", tile_name, "@", dat_name)
-
-                # Count occurrences of each cell type
-                class_counts = Counter()
-                for nucleus in tile_preds.values():
-                    class_id = nucleus["type"]
-                    class_counts[class_id] += 1
-
-                # Update the total counts with the current tile's counts            
-                total_counts.update(class_counts)         
-                    
-                # Record counts in CSV
-                writer.writerow([
-                    tile_name,
-                    dat_name,
-                    class_counts.get(0, 0),  #background
-                    class_counts.get(1, 0),  # Epithelial
-                    class_counts.get(2, 0),  # Lymphocyte
-                    class_counts.get(3, 0),  # Macrophage
-                    class_counts.get(4, 0),  # Neutrophil
-                
-                ])
-                    
-                # Read the corresponding tile image for visualization
-                tile_img = imread(tile_paths[i])
-
-                # Create the overlay image
-                overlaid_predictions = overlay_prediction_contours(
-                    canvas=tile_img,
-                    inst_dict=tile_preds,
-                    draw_dot=False,
-                    type_colours={
-                        0: ("Background", (255, 255, 255, 0)), #transparent
-                        1: ("Epithelial", (255, 0, 0)),
-                        2: ("Lymphocyte", (255, 255, 0)),
-                        3: ("Macrophage", (0, 255, 0)),
-                        4: ("Neutrophil", (0, 0, 255)),
-                    },
-                    line_thickness=4,    
-                )
-                        
-                # Save the overlaid image
-                overlay_path = f"./uploads/{file_id_name}/overlay/overlay_{tile_name}.png"
-                plt.imsave(overlay_path, overlaid_predictions)
-            
-                # After all tiles are processed, write the total counts to the CSV
-            writer.writerow([
-                "END",
-                "Total",
-                total_counts.get(0, 0), #total background
-                total_counts.get(1, 0),  # Total Epithelial
-                total_counts.get(2, 0),  # Total Lymphocyte
-                total_counts.get(3, 0),  # Total Macrophage
-                total_counts.get(4, 0),  # Total Neutrophil
-            ])   
 
+def tile_name_of(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def write_counts(file_id_name, pairs=None, store=None):
+    """Write nucleus_info_<id>.csv from the .dat files or a nucleus store, returns the total per class."""
+    csv_file_path = f"./uploads/{file_id_name}/nucleus_info_{file_id_name}.csv"
+    if store is not None:
+        counts = store.tile_counts(len(TYPE_COLOURS))
+        rows = [(tile_name, dat_name, Counter(dict(enumerate(tile_counts.tolist()))))
+                for (tile_name, dat_name, _, _), tile_counts in zip(store.tiles, counts)]
+    else:
+        rows = ((tile_name_of(tile_path), tile_name_of(dat_path), count_classes(joblib.load(dat_path)))
+                for tile_path, dat_path in pairs)
+
+    total_counts = Counter()
+    progress = Progress("count", file_id_name, total=len(store.tiles) if store is not None else len(pairs))
+    with open(csv_file_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(NUCLEUS_CSV_HEADER)
+        for tile_name, dat_name, class_counts in rows:
+            total_counts.update(class_counts)
+            writer.writerow(count_row(tile_name, dat_name, class_counts))
+            progress.update(advance=1, nuclei=sum(total_counts.values()))
+        writer.writerow(count_row("END", "Total", total_counts))
+    progress.finish(nuclei=sum(total_counts.values()))
+    return total_counts
+
+
+# nucleus stores opened by this process, keyed by path and build time so a rebuilt store is reopened
+_open_nucleus_stores = {}
+
+
+def load_tile_preds(source):
+    """A tile's predictions from its .dat path or a (store path, tile index) pair."""
+    if isinstance(source, tuple):
+        store_dir, tile_index = source
+        key = (store_dir, os.path.getmtime(os.path.join(store_dir, "meta.json")))
+        if key not in _open_nucleus_stores:
+            _open_nucleus_stores.clear()
+            _open_nucleus_stores[key] = nucleus_store.NucleusStore(store_dir)
+        return _open_nucleus_stores[key].tile_inst_dict(tile_index)
+    return joblib.load(source)
+
+
+def render_tile_overlay(job):
+    """Pool task: (tile_path, cell store path or None, predictions source, codec, quality) -> (x, y, encoded, shape)."""
+    tile_path, cell_store_path, source, codec, quality = job
+    overlay = render_overlay(read_cell_tile(tile_path, cell_store_path), load_tile_preds(source))
+    x, y = nucleus_store.tile_origin(tile_name_of(tile_path))
+    return x, y, tile_store.encode_tile(overlay, codec, quality), overlay.shape
+
+
+def render_overlays(file_id_name, sources, workers=None):
+    """Render the overlay of every (tile_path, predictions source) into the slide's overlay tile store."""
+    cell_store_path = tile_store.store_path(file_id_name)
+    if os.path.exists(cell_store_path):
+        with tile_store.TileStore(cell_store_path) as cells:
+            codec, quality = cells.codec, cells.quality
+    else:
+        cell_store_path = None
+        codec, quality = tile_store.DEFAULT_CODEC, tile_store.DEFAULT_QUALITY
+    jobs = [(tile_path, cell_store_path, source, codec, quality) for tile_path, source in sources]
+    workers = min(workers or tuning.available_cores(), len(jobs))
+    progress = Progress("overlay", file_id_name, total=len(jobs))
+    # the workers only render and encode, every overlay is appended here
+    with tile_store.TileStoreWriter(tile_store.store_path(file_id_name, "overlay"), codec, quality,
+                                    replaces=tile_store.legacy_dir(file_id_name, "overlay")) as overlays:
+        if workers <= 1:
+            for job in jobs:
+                overlays.add_encoded(*render_tile_overlay(job))
+                progress.update(advance=1)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                for rendered in pool.map(render_tile_overlay, jobs, chunksize=max(1, len(jobs) // (workers * 4))):
+                    overlays.add_encoded(*rendered)
+                    progress.update(advance=1)
+    progress.finish()
+    return overlays.path
+
+
+def cellsCount(file_id_name, overlays=True, workers=None):
+    """Count nuclei per tile into nucleus_info_<id>.csv, then render the overlays (optional)."""
+    try:
+        # each tile with its own .dat, in natsorted tile order; without them fall back to the nucleus store
+        pairs = nucleus_store.tile_dat_pairs(file_id_name)
+        store = None if pairs else nucleus_store.open_store(file_id_name)
+
+        start_time = time.time()
+        with metrics.stage("count", file_id_name) as event:
+            if store is not None:
+                total_counts = write_counts(file_id_name, store=store)
+                cell_dir = f"./uploads/{file_id_name}/cell"
+                sources = [(os.path.join(cell_dir, f"{tile_name}.png"), (store.path, tile_index))
+                           for tile_index, (tile_name, _, _, _) in enumerate(store.tiles)]
+                # only tiles whose patch is still around, in the cell tile store or as a PNG
+                cells = tile_store.open_store(file_id_name)
+                if cells is not None:
+                    with cells:
+                        sources = [(tile_path, source) for tile_path, source in sources
+                                   if nucleus_store.tile_origin(tile_name_of(tile_path)) in cells]
+                else:
+                    sources = [(tile_path, source) for tile_path, source in sources if os.path.exists(tile_path)]
+                n_tiles = len(store.tiles)
+            else:
+                total_counts = write_counts(file_id_name, pairs)
+                sources = pairs
+                n_tiles = len(pairs)
+            event.add(tiles=n_tiles, nuclei=sum(total_counts.values()))
+        logging.info(f"Counted {sum(total_counts.values())} nuclei in {n_tiles} tiles "
+                     f"in {time.time() - start_time:.1f} seconds")
+
+        if overlays:
+            render_start = time.time()
+            with metrics.stage("overlay", file_id_name) as event:
+                render_overlays(file_id_name, sources, workers)
+                event.add(tiles=len(sources))
+            logging.info(f"Rendered {len(sources)} overlays in {time.time() - render_start:.1f} seconds")
 
         # Calculate the elapsed time
         elapsed_time = time.time() - start_time
@@ -178,7 +400,7 @@ def cellsCount(file_id_name):
 
     return file_id_name
 
-def main(file_path):
+def main(file_path, segmentor=None, overrides=None, mode="tile", overlays=True, count_workers=None):
     norm_method = "Vaha"
     filename = os.path.basename(file_path)
     file_id = os.path.splitext(filename)[0]
@@ -198,11 +420,22 @@ def main(file_path):
         logging.info(f"Startig to process run {run_id} for file: {file_id_name}")
 
         try:
-            result = predict(file_id_name)
+            if mode == "wsi":
+                # whole-slide inference writes the nucleus csv itself, no tiles to count
+                import wsi_predict
+
+                nuclei = wsi_predict.predict_wsi(file_path, file_id_name, segmentor=segmentor, overrides=overrides)
+                elapsed_time = time.time() - start_time
+                time_log_file.write(f"File ID: {file_id_name}, Start Time: {time.ctime(start_time)}, Mode: wsi, "
+                                    f"Nuclei: {nuclei}, Elapsed Time: {int(elapsed_time // 60)} minutes "
+                                    f"{int(elapsed_time % 60)} seconds\n")
+                return True
+
+            result = predict(file_id_name, segmentor=segmentor, overrides=overrides)
             if not result:
                 logging.warning(f"Prediction failed for file: {file_id_name}")
                 time_log_file.write(f"File ID: {file_id_name}, Start time: {time.ctime(start_time)}")
-                return
+                return False
             
             logging.info(f"Prediction completed successfully for file: {file_id_name}") #if success
                 #elapsed_time = time.time() - start_time
@@ -212,7 +445,8 @@ def main(file_path):
                 #logging.info(f"Completed processing for file id: {file_id_name}")
 
             try:
-                cellsCount(file_id_name)
+                # counting stays within the stage's core reservation too
+                cellsCount(file_id_name, overlays=overlays, workers=count_workers or (overrides or {}).get("cpus"))
 
                 elapsed_time = time.time() - start_time
                 minutes = int(elapsed_time // 60)
@@ -222,6 +456,7 @@ def main(file_path):
                 
                 logging.info(f"Completed full processing for file: {file_id_name} in {minutes}m {seconds}s")
                 time_log_file.write(success_msg)
+                return True
 
             except Exception as e:
                 elapsed_time = time.time() - start_time
@@ -234,6 +469,7 @@ def main(file_path):
                 logging.error(f"Cell count failed for file {file_id_name}: {str(e)}")
                 logging.error(f"Trace: {traceback.format_exc()}")
                 time_log_file.write(error_msg)
+                return False
 
                 '''
                 import traceback
@@ -248,18 +484,18 @@ def main(file_path):
             seconds = int(elapsed_time % 60)
 
             error_msg = f"File ID: {file_id_name}, Start Time: {time.ctime(start_time)}, " \
-                f"Failed overall process, Elapsed time: {minutes}m {seconds}s, Error: {str(e)}\n"
+                f"Failed overall process, Elapsed time: {minutes}m {seconds}s, Error: {str(exc)}\n"
                 
-            logging.error(f"Processing failed for file {file_id_name}: {str(e)}")
+            logging.error(f"Processing failed for file {file_id_name}: {str(exc)}")
             logging.error(f"Trace: {traceback.format_exc()}")
             time_log_file.write(error_msg)
+            return False
             
             #logging.error(f"File id {file_id_name} generated an exception: {exc}")  
             #time_log_file.write(f"File ID: {file_id_name}, Exception: {exc}\n") # Record the exception in the time log file
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python predict.py <file_path> <file_name>")
-    else:
-        file_path = sys.argv[1]
-        main(file_path)
+    # kept for existing callers, the arguments live in tia.py
+    import tia
+
+    sys.exit(tia.main(["predict"] + sys.argv[1:]))
@@ -0,0 +1,90 @@
+"""Per-slide stage progress, written by the stage scripts and streamed by the app.
+
+A stage keeps a Progress and calls update() as tiles finish; the snapshot
+is rewritten atomically to uploads/<id>/progress.json at most every
+MIN_INTERVAL seconds, so updating after every tile costs a clock read. The
+app turns changes of that file into server-sent events.
+
+Stages advance at very different paces (a predict chunk can take minutes on
+CPU), so stall_state() judges a stage against its own average time per step.
+"""
+import os, json, time
+
+MIN_INTERVAL = 0.5
+# a stage is stalled once it has gone this many times its average step without advancing
+STALL_FACTOR = 5
+
+
+def progress_path(file_id_name):
+    return f"./uploads/{file_id_name}/progress.json"
+
+
+class Progress:
+    def __init__(self, stage, file_id_name, total=None, unit="tiles"):
+        self.path = progress_path(file_id_name)
+        now = time.time()
+        # steps counts the update(advance=...) calls, advanced is the time of the latest one
+        self.state = {"stage": stage, "slide": file_id_name, "unit": unit, "done": 0, "total": total,
+                      "started": now, "advanced": now, "steps": 0, "finished": False}
+        self.last_write = 0.0
+        self.write()
+
+    def update(self, done=None, advance=0, total=None, **extra):
+        """Set or advance the done counter (and any extra counters, e.g. nuclei=...), written when due."""
+        if done is not None:
+            self.state["done"] = done
+        self.state["done"] += advance
+        if advance:
+            self.state["advanced"] = time.time()
+            self.state["steps"] += 1
+        if total is not None:
+            self.state["total"] = total
+        self.state.update(extra)
+        if time.time() - self.last_write >= MIN_INTERVAL:
+            self.write()
+
+    def finish(self, **extra):
+        self.state.update(extra, finished=True)
+        self.write()
+
+    def write(self):
+        now = time.time()
+        elapsed = now - self.state["started"]
+        self.state["updated"] = now
+        self.state["rate"] = round(self.state["done"] / elapsed, 3) if elapsed > 0 else None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # progress is best effort, never fail a stage over it
+        self.last_write = now
+
+
+def stall_state(snapshot, min_seconds, now=None):
+    """(seconds since the stage last advanced, stalled) for a running stage's snapshot.
+
+    A stage is stalled when it has been idle for STALL_FACTOR times its
+    average time per step, and at least min_seconds. Stages that have not
+    stepped yet (or only report start and finish) have no pace to judge.
+    """
+    now = time.time() if now is None else now
+    started = snapshot.get("started", now)
+    advanced = snapshot.get("advanced", snapshot.get("updated", started))
+    idle = now - advanced
+    steps = snapshot.get("steps", 0)
+    if not steps:
+        return idle, False
+    pace = (advanced - started) / steps
+    return idle, idle > max(min_seconds, STALL_FACTOR * pace)
+
+
+def read_progress(file_id_name):
+    """Latest snapshot for a slide, or None."""
+    try:
+        with open(progress_path(file_id_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,153 @@
+"""Deep-zoom pyramids of the overlay mosaic and the tiles the viewer asks for.
+
+merge.py writes the full-resolution overlay either as a DZI (a .dzi
+descriptor plus a <name>_files/<level>/<col>_<row>.jpeg tree) or as one
+pyramidal tiled TIFF. Both are served under the same Deep Zoom URLs: DZI
+tiles are read from disk, TIFF tiles are cut from the closest pyramid page.
+Recently served tiles stay in an in-process LRU.
+"""
+import os, math, shutil, threading
+from collections import OrderedDict
+
+TILE_SIZE = 256
+TILE_FORMAT = "jpeg"
+TILE_QUALITY = 85
+TILE_CACHE_BYTES = int(os.environ.get('TILE_CACHE_BYTES', 128 * 1024 ** 2))
+PYRAMID_FORMATS = ["dzi", "tiff"]
+
+
+def pyramid_base(file_id_name):
+    return f"./uploads/{file_id_name}/pyramid_{file_id_name}"
+
+
+def write_pyramid(image, file_id_name, pyramid_format="dzi"):
+    """Save a full-resolution image as a DZI or a pyramidal tiled TIFF, returns the path written."""
+    base = pyramid_base(file_id_name)
+    # dzsave refuses to write over an earlier pyramid, and only one format is kept
+    shutil.rmtree(f"{base}_files", ignore_errors=True)
+    for stale in (f"{base}.dzi", f"{base}.tif"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    if image.bands == 4:
+        image = image.flatten(background=[255, 255, 255])
+    if pyramid_format == "tiff":
+        image.tiffsave(f"{base}.tif", tile=True, pyramid=True, tile_width=TILE_SIZE, tile_height=TILE_SIZE,
+                       compression="jpeg", Q=TILE_QUALITY, bigtiff=True)
+        return f"{base}.tif"
+    image.dzsave(base, tile_size=TILE_SIZE, overlap=0, suffix=f".{TILE_FORMAT}[Q={TILE_QUALITY}]")
+    return f"{base}.dzi"
+
+
+def dzi_xml(width, height):
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{TILE_FORMAT}" '
+            f'Overlap="0" TileSize="{TILE_SIZE}"><Size Width="{width}" Height="{height}"/></Image>\n')
+
+
+class TileCache:
+    """Byte-bounded LRU of encoded tiles."""
+
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.tiles.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.tiles:
+                return
+            self.tiles[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.tiles:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Pyramid:
+    """The overlay pyramid of one slide, whichever format merge.py wrote."""
+
+    def __init__(self, file_id_name):
+        base = pyramid_base(file_id_name)
+        if os.path.exists(f"{base}.dzi"):
+            self.path, self.format = f"{base}.dzi", "dzi"
+        elif os.path.exists(f"{base}.tif"):
+            self.path, self.format = f"{base}.tif", "tiff"
+        else:
+            raise FileNotFoundError(f"No overlay pyramid for {file_id_name}")
+        self.base = base
+        self.version = os.path.getmtime(self.path)
+        self._pages = {}
+
+    def descriptor(self):
+        if self.format == "dzi":
+            with open(self.path) as f:
+                return f.read()
+        page = self._page(0)
+        return dzi_xml(page.width, page.height)
+
+    def _page(self, index):
+        if index not in self._pages:
+            import pyvips
+
+            self._pages[index] = pyvips.Image.new_from_file(self.path, page=index)
+        return self._pages[index]
+
+    def tile(self, level, col, row):
+        """Encoded tile bytes, or None outside the pyramid."""
+        if self.format == "dzi":
+            path = os.path.join(f"{self.base}_files", str(level), f"{col}_{row}.{TILE_FORMAT}")
+            if not os.path.isfile(path):
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+
+        full = self._page(0)
+        max_level = math.ceil(math.log2(max(full.width, full.height)))
+        if not 0 <= level <= max_level:
+            return None
+        # tiffsave halves each page, so the page for a level is its power of two below full size
+        shrink = max_level - level
+        n_pages = full.get("n-pages") if full.get_typeof("n-pages") else 1
+        page_index = min(shrink, n_pages - 1)
+        image = self._page(page_index)
+        if shrink > page_index:
+            image = image.resize(1 / 2 ** (shrink - page_index))
+        left, top = col * TILE_SIZE, row * TILE_SIZE
+        if left >= image.width or top >= image.height:
+            return None
+        region = image.crop(left, top, min(TILE_SIZE, image.width - left), min(TILE_SIZE, image.height - top))
+        return region.write_to_buffer(f".{TILE_FORMAT}[Q={TILE_QUALITY}]")
+
+
+_cache = TileCache()
+_pyramids = {}
+_lock = threading.Lock()
+
+
+def open_pyramid(file_id_name):
+    """Pyramid for a slide, reopened when merge.py rewrote it; raises FileNotFoundError."""
+    with _lock:
+        pyramid = _pyramids.get(file_id_name)
+        if pyramid is None or not os.path.exists(pyramid.path) or os.path.getmtime(pyramid.path) != pyramid.version:
+            pyramid = _pyramids[file_id_name] = Pyramid(file_id_name)
+        return pyramid
+
+
+def read_tile(file_id_name, level, col, row):
+    """(tile bytes or None, etag) through the LRU."""
+    pyramid = open_pyramid(file_id_name)
+    etag = f"{file_id_name}-{int(pyramid.version)}-{level}-{col}-{row}"
+    data = _cache.get(etag)
+    if data is None:
+        data = pyramid.tile(level, col, row)
+        if data is not None:
+            _cache.put(etag, data)
+    return data, etag
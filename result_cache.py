@@ -0,0 +1,240 @@
+"""Content-addressed cache of stage outputs.
+
+Entries are keyed by the slide's SHA-256 plus the parameters that change a
+stage's output, so a slide uploaded again under another name (or re-run
+unchanged) gets its patch/predict/merge artifacts back without recomputing.
+Artifacts are copied in and out of the cache, never hard linked: several
+stages rewrite their outputs in place, which would change a shared inode
+under the entry. Restoring clears each artifact path first, so nothing from
+an earlier run is left next to the restored files. The slide's output name
+is swapped for a placeholder in file names and CSV contents so an entry can
+be handed to any file name.
+"""
+import os, json, time, shutil, hashlib, logging, threading
+from chunked_upload import read_digest, write_digest
+import tile_store
+
+RESULTS_ROOT = "./uploads"
+CACHE_DIR = os.path.join(RESULTS_ROOT, "cache")
+MAX_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 50 * 1024 ** 3))
+
+# keep in step with patch.py (patch_size, threshold_std, stain_method), tile_store.py and predict.py (MODEL_NAME)
+DEFAULT_PARAMS = {
+    "patch_size": 1024,
+    "threshold_std": 5.0,
+    "codec": "png",
+    "norm_method": "Vahadane",
+    "model": "hovernet_fast-monusac",
+    "mode": "tile",
+}
+
+# outputs of each stage, relative to uploads/<file_id_name>/, "{id}" is the output name
+STAGE_ARTIFACTS = {
+    "patch": ["cell_{id}.tiles", "cell", "blank", "patches_info_{id}.csv"],
+    "predict": ["result", "overlay_{id}.tiles", "overlay", "nucleus_info_{id}.csv", "nuclei_{id}.dat", "nuclei", "tissue_mask.png"],
+    "merge": ["Merge_{id}.png", "pyramid_{id}.dzi", "pyramid_{id}_files", "pyramid_{id}.tif"],
+}
+STAGE_ARTIFACTS["process"] = STAGE_ARTIFACTS["patch"] + STAGE_ARTIFACTS["predict"]
+
+# upstream outputs a stage reads; their fingerprint is part of its key, so predicting a
+# re-patched slide (or merging re-predicted overlays) never restores results of the old inputs
+STAGE_INPUTS = {
+    "predict": ["patches_info_{id}.csv", "cell_{id}.tiles", "cell"],
+    "merge": ["patches_info_{id}.csv", "blank", "overlay_{id}.tiles", "overlay"],
+}
+
+PLACEHOLDER = "@SLIDE@"
+# input_digest() of inputs that cannot be fingerprinted, the stage is neither restored nor stored
+UNCACHEABLE = False
+READ_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def slide_digest(file_path, compute=True):
+    """SHA-256 of a slide, from the upload sidecar or hashed (and recorded) on demand."""
+    digest = read_digest(file_path)
+    if digest is None and compute:
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for data in iter(lambda: f.read(READ_SIZE), b""):
+                sha.update(data)
+        digest = sha.hexdigest()
+        write_digest(file_path, digest)
+    return digest
+
+
+def input_digest(stage, file_id_name, params=None):
+    """Fingerprint of the upstream outputs a stage reads, None when it starts from the slide alone.
+
+    CSVs are hashed by content, tile stores by their index (positions, codec
+    and encoded sizes) and directories by file names and sizes, so the
+    fingerprint never has to read the tile pixels. Returns UNCACHEABLE when a
+    tile store cannot be read; the stage then runs uncached and fails on it.
+    """
+    artifacts = STAGE_INPUTS.get(stage)
+    # whole-slide prediction segments the slide itself, not the patches
+    if artifacts is None or (stage == "predict" and (params or {}).get("mode") == "wsi"):
+        return None
+    out_dir = os.path.join(RESULTS_ROOT, file_id_name)
+    sha = hashlib.sha256()
+    for artifact in artifacts:
+        path = os.path.join(out_dir, artifact.replace("{id}", file_id_name))
+        sha.update(f"\0{artifact}\0".encode())
+        if path.endswith(".tiles") and os.path.isfile(path):
+            try:
+                sha.update(tile_store.read_index(path))
+            except (OSError, ValueError):
+                # damaged or truncated below the footer
+                return UNCACHEABLE
+        elif os.path.isfile(path):
+            with open(path, "rb") as f:
+                sha.update(f.read().replace(file_id_name.encode(), PLACEHOLDER.encode()))
+        elif os.path.isdir(path):
+            for dir_path, _, file_names in sorted(os.walk(path)):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(dir_path, file_name)
+                    name = os.path.relpath(file_path, path).replace(file_id_name, PLACEHOLDER)
+                    sha.update(f"{name}:{os.path.getsize(file_path)}\n".encode())
+    return sha.hexdigest()
+
+
+def stage_key(digest, stage, params, inputs=None):
+    """Cache key of a stage; inputs is the stage's input_digest() when it reads upstream outputs."""
+    key_params = dict(DEFAULT_PARAMS, **{k: v for k, v in params.items() if v is not None})
+    payload = {"slide": digest, "stage": stage, "params": key_params}
+    if inputs is not None:
+        payload["inputs"] = inputs
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+def _copy(src, dst, file_id_name_from, file_id_name_to):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if src.endswith(".csv"):
+        # csv rows carry tile names, rewrite them instead of copying
+        with open(src) as f:
+            text = f.read()
+        with open(dst, "w") as f:
+            f.write(text.replace(file_id_name_from, file_id_name_to))
+        return
+    shutil.copy2(src, dst)
+
+
+def _clear(root, artifacts, name):
+    """Remove the artifact paths of a stage under root."""
+    for artifact in artifacts:
+        path = os.path.join(root, artifact.replace("{id}", name))
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+def _transfer(src_root, dst_root, artifacts, name_from, name_to):
+    size = 0
+    for artifact in artifacts:
+        src = os.path.join(src_root, artifact.replace("{id}", name_from))
+        if os.path.isdir(src):
+            # walk nested trees too (deep-zoom pyramids keep one directory per level)
+            for dir_path, _, file_names in os.walk(src):
+                dst_dir = os.path.join(dst_root, artifact.replace("{id}", name_to), os.path.relpath(dir_path, src))
+                os.makedirs(dst_dir, exist_ok=True)
+                for file_name in file_names:
+                    src_file = os.path.join(dir_path, file_name)
+                    _copy(src_file, os.path.join(dst_dir, file_name.replace(name_from, name_to)),
+                          name_from, name_to)
+                    size += os.path.getsize(src_file)
+        elif os.path.isfile(src):
+            _copy(src, os.path.join(dst_root, artifact.replace("{id}", name_to)), name_from, name_to)
+            size += os.path.getsize(src)
+    return size
+
+
+def lookup(key):
+    """Cache entry metadata for key, or None."""
+    try:
+        with open(os.path.join(_entry_dir(key), "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def restore(key, file_id_name):
+    """Materialize a cached entry as uploads/<file_id_name>/ outputs, returns True on a hit."""
+    with _lock:
+        meta = lookup(key)
+        if meta is None:
+            return False
+        out_dir = os.path.join(RESULTS_ROOT, file_id_name)
+        os.makedirs(out_dir, exist_ok=True)
+        # outputs of an earlier run (another codec, legacy PNG dirs, more tiles) must not outlive the restore
+        _clear(out_dir, STAGE_ARTIFACTS[meta["stage"]], file_id_name)
+        _transfer(_entry_dir(key), out_dir, STAGE_ARTIFACTS[meta["stage"]], PLACEHOLDER, file_id_name)
+
+        meta["last_used"] = time.time()
+        meta["hits"] = meta.get("hits", 0) + 1
+        with open(os.path.join(_entry_dir(key), "meta.json"), "w") as f:
+            json.dump(meta, f)
+    logging.info(f"Result cache hit for {meta['stage']} of {file_id_name}")
+    return True
+
+
+def store(key, stage, file_id_name):
+    """Add the current outputs of a stage to the cache, then evict down to the size budget."""
+    with _lock:
+        if lookup(key) is not None:
+            return
+        tmp_dir = f"{_entry_dir(key)}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        size = _transfer(os.path.join(RESULTS_ROOT, file_id_name), tmp_dir, STAGE_ARTIFACTS[stage],
+                         file_id_name, PLACEHOLDER)
+        now = time.time()
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"stage": stage, "size": size, "created": now, "last_used": now, "hits": 0}, f)
+        os.replace(tmp_dir, _entry_dir(key))
+        _evict()
+
+
+def _evict(max_bytes=None):
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        meta = lookup(entry.name) if entry.is_dir() else None
+        if meta is not None:
+            entries.append((meta["last_used"], meta["size"], entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    # least recently used go first
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        logging.info(f"Evicted result cache entry {os.path.basename(path)} ({size} bytes)")
+
+
+def run_cached(stage, file_path, file_id_name, params, runner):
+    """Return the cached result of a stage, or run it and cache its outputs on success.
+
+    runner() returns the endpoint style result dict.
+    """
+    inputs = input_digest(stage, file_id_name, params)
+    if inputs is UNCACHEABLE:
+        return runner()
+    key = stage_key(slide_digest(file_path), stage, params, inputs)
+    if restore(key, file_id_name):
+        return {"success": True, "cached": True, "output": f"{stage} outputs restored from cache"}
+
+    result = runner()
+    if result and result.get("success"):
+        try:
+            store(key, stage, file_id_name)
+        except OSError as e:
+            logging.warning(f"Could not cache {stage} outputs of {file_id_name}: {e}")
+    return result
@@ -0,0 +1,139 @@
+import numpy as np
+
+# level-0 page of a Roche/Ventana .bif (page 0 is the label, page 1 the overview)
+BIF_LEVEL0_PAGE = 2
+
+
+class OpenSlideReader:
+    """Level-0 region reader for slides OpenSlide can open (.svs, .tif)."""
+
+    def __init__(self, file_path):
+        # imported per format, a .bif run never loads OpenSlide and an .svs run never loads zarr
+        from openslide import OpenSlide
+
+        self.file_path = file_path
+        self.slide = OpenSlide(file_path)
+        self.dimensions = self.slide.level_dimensions[0]
+        self.level_dimensions = list(self.slide.level_dimensions)
+
+    def read_region(self, x, y, width, height, level=0):
+        # regions beyond the slide edge come back padded, as read_region always did
+        region = self.slide.read_region((x, y), level, (width, height))
+        region = region.convert('RGB')
+        return np.asarray(region)
+
+    def read_thumbnail(self, downsample):
+        """Low resolution RGB view of the slide, returns (thumbnail, (scale_x, scale_y))."""
+        img_width, img_height = self.dimensions
+        size = (max(1, img_width // downsample), max(1, img_height // downsample))
+        # openslide picks the closest pyramid level and only resizes that
+        thumbnail = np.asarray(self.slide.get_thumbnail(size).convert('RGB'))
+        return thumbnail, (img_width / thumbnail.shape[1], img_height / thumbnail.shape[0])
+
+    def close(self):
+        self.slide.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BifReader:
+    """Lazy region reader for .bif slides.
+
+    Regions are decoded tile by tile through tifffile's zarr store, or read straight
+    from a memory map when the page is stored uncompressed, so memory use follows
+    the region size instead of the slide size. The lower pyramid pages that follow
+    level 0 are exposed as levels 1, 2, ..., as OpenSlide does for other formats.
+    """
+
+    def __init__(self, file_path, page=BIF_LEVEL0_PAGE):
+        import tifffile
+
+        self.file_path = file_path
+        self.tif = tifffile.TiffFile(file_path)
+        self.page_index = page
+        self.page = self.tif.pages[page]
+        # dimensions come from the TIFF tags, nothing is decoded
+        self.dimensions = (self.page.imagewidth, self.page.imagelength)
+        img_width, img_height = self.dimensions
+
+        # the lower pyramid levels follow level 0 with its aspect ratio, largest first
+        lower = [page for page in self.tif.pages[page + 1:]
+                 if page.imagewidth < img_width
+                 and abs(page.imagewidth / page.imagelength - img_width / img_height) < 0.05]
+        self.level_pages = [self.page] + sorted(lower, key=lambda page: page.imagewidth, reverse=True)
+        self.level_dimensions = [(page.imagewidth, page.imagelength) for page in self.level_pages]
+        self._stores = {}
+        self._store = self._level_store(0)
+
+    def _level_store(self, level):
+        """Array view of a level's page, opened on first use."""
+        import tifffile
+        import zarr
+
+        if level not in self._stores:
+            page = self.level_pages[level]
+            if page.is_memmappable:
+                self._stores[level] = tifffile.memmap(self.file_path, page=page.index, mode='r')
+            else:
+                self._stores[level] = zarr.open(page.aszarr(), mode='r')
+        return self._stores[level]
+
+    def read_region(self, x, y, width, height, level=0):
+        img_width, img_height = self.dimensions
+        if level:
+            # x, y are level-0 coordinates and width, height level pixels, as with OpenSlide
+            level_width, level_height = self.level_dimensions[level]
+            x, y = x * level_width // img_width, y * level_height // img_height
+            img_width, img_height = level_width, level_height
+        # Ensure the requested patch stays within bounds
+        width = min(width, img_width - x)  # Adjust width if it exceeds the image width
+        height = min(height, img_height - y)  # Adjust height if it exceeds the image height
+
+        region = np.asarray(self._level_store(level)[y:y + height, x:x + width])
+        return region[..., :3]
+
+    def read_thumbnail(self, downsample):
+        """Low resolution RGB view of the slide, returns (thumbnail, (scale_x, scale_y))."""
+        img_width, img_height = self.dimensions
+        target_width = max(1, img_width // downsample)
+
+        # use the smallest pyramid level still at least target_width wide
+        levels = [page for page in self.level_pages[1:] if target_width <= page.imagewidth]
+        if levels:
+            thumbnail = np.asarray(min(levels, key=lambda page: page.imagewidth).asarray())
+        else:
+            # no pyramid, subsample level 0
+            thumbnail = np.asarray(self._store[::downsample, ::downsample])
+        thumbnail = thumbnail[..., :3]
+        return thumbnail, (img_width / thumbnail.shape[1], img_height / thumbnail.shape[0])
+
+    def close(self):
+        self._store = None
+        self._stores = {}
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_slide(file_path):
+    """Return a region reader for file_path based on its extension."""
+    if file_path.endswith('.svs') or file_path.endswith('.tif'):
+        return OpenSlideReader(file_path)
+    elif file_path.endswith('.bif'):
+        return BifReader(file_path)
+    else:
+        raise ValueError("Unsupported file type")
+
+
+def slide_dimensions(file_path):
+    """Level-0 (width, height) of a slide without reading any pixel data."""
+    with open_slide(file_path) as reader:
+        return reader.dimensions
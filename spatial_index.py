@@ -0,0 +1,139 @@
+"""Grid spatial index over a slide's nucleus store, for region of interest queries.
+
+Nuclei are bucketed by centroid into GRID_CELL x GRID_CELL level-0 cells.
+The index is two arrays saved next to the store: the nucleus ids ordered by
+cell (index_order.npy) and where each cell starts in that order
+(index_offsets.npy, CSR style). A query only touches the cells under the
+ROI's bounding box and tests those centroids exactly.
+"""
+import os, json, time, logging, threading
+import numpy as np
+from matplotlib.path import Path
+
+import nucleus_store
+
+GRID_CELL = 256
+# monusac classes by type id
+CLASS_NAMES = [name for name, _ in nucleus_store.TYPE_COLOURS.values()]
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def store_version(store):
+    """Identifies one build of the store: meta.json is written last and swapped in with the store."""
+    return os.stat(os.path.join(store.path, "meta.json")).st_mtime_ns
+
+
+def build_index(store, cell=GRID_CELL):
+    centroids = np.asarray(store.centroid)
+    cols = int(centroids[:, 0].max() // cell) + 1 if len(centroids) else 1
+    rows = int(centroids[:, 1].max() // cell) + 1 if len(centroids) else 1
+    cell_ids = (centroids[:, 1] // cell).astype(np.int64) * cols + (centroids[:, 0] // cell).astype(np.int64)
+    order = np.argsort(cell_ids, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(cell_ids[order], np.arange(rows * cols + 1)).astype(np.int64)
+
+    np.save(os.path.join(store.path, "index_order.npy"), order)
+    np.save(os.path.join(store.path, "index_offsets.npy"), offsets)
+    # written last, its presence marks a complete index
+    with open(os.path.join(store.path, "index.json"), "w") as f:
+        json.dump({"cell": cell, "cols": cols, "rows": rows, "count": len(store),
+                   "store_version": store_version(store)}, f)
+
+
+class SpatialIndex:
+    def __init__(self, store):
+        self.store = store
+        with open(os.path.join(store.path, "index.json")) as f:
+            meta = json.load(f)
+        self.cell, self.cols, self.rows = meta["cell"], meta["cols"], meta["rows"]
+        self.order = np.load(os.path.join(store.path, "index_order.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(store.path, "index_offsets.npy"), mmap_mode="r")
+
+    def candidates(self, x0, y0, x1, y1):
+        """Nucleus ids in the grid cells overlapping the rectangle."""
+        c0, c1 = max(0, int(x0 // self.cell)), min(self.cols - 1, int(x1 // self.cell))
+        r0, r1 = max(0, int(y0 // self.cell)), min(self.rows - 1, int(y1 // self.cell))
+        if c0 > c1 or r0 > r1:
+            return np.zeros(0, dtype=np.int64)
+        # cells of one grid row are contiguous in the order
+        parts = [self.order[self.offsets[r * self.cols + c0]:self.offsets[r * self.cols + c1 + 1]]
+                 for r in range(r0, r1 + 1)]
+        return np.concatenate(parts)
+
+    def query(self, rect=None, polygon=None):
+        """Sorted ids of nuclei whose centroid lies in the rectangle [x0, y0, x1, y1] or the polygon [[x, y], ...]."""
+        if polygon is not None:
+            vertices = np.asarray(polygon, dtype=np.float64)
+            x0, y0 = vertices.min(axis=0)
+            x1, y1 = vertices.max(axis=0)
+        else:
+            x0, y0, x1, y1 = rect
+        ids = self.candidates(x0, y0, x1, y1)
+        centroids = self.store.centroid[ids]
+        inside = ((centroids[:, 0] >= x0) & (centroids[:, 0] < x1)
+                  & (centroids[:, 1] >= y0) & (centroids[:, 1] < y1))
+        if polygon is not None:
+            inside &= Path(vertices).contains_points(centroids)
+        return np.sort(ids[inside])
+
+
+def _results_changed(file_id_name, store):
+    """True when tile prediction recorded results after the store was built."""
+    checkpoint = f"./uploads/{file_id_name}/result/completed.jsonl"
+    meta_path = os.path.join(store.path, "meta.json")
+    return os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > os.path.getmtime(meta_path)
+
+
+def _open_store(file_id_name):
+    store = nucleus_store.open_store(file_id_name)
+    if store is None or _results_changed(file_id_name, store):
+        # tile mode results only exist as .dat files until converted
+        pairs = nucleus_store.tile_dat_pairs(file_id_name)
+        if not pairs:
+            return None
+        store = nucleus_store.NucleusStore(nucleus_store.convert_tile_dats(file_id_name, pairs))
+    return store
+
+
+def load_index(file_id_name):
+    """The slide's spatial index, building the store and index on first use; None without results."""
+    path = nucleus_store.store_path(file_id_name)
+    with _lock:
+        meta_path = os.path.join(path, "meta.json")
+        version = os.path.getmtime(meta_path) if os.path.exists(meta_path) else None
+        cached = _cache.get(file_id_name)
+        if cached is not None and version is not None and cached[0] == version \
+                and not _results_changed(file_id_name, cached[1].store):
+            return cached[1]
+
+        start_time = time.time()
+        store = _open_store(file_id_name)
+        if store is None:
+            return None
+        try:
+            with open(os.path.join(store.path, "index.json")) as f:
+                # a rebuilt store can hold as many nuclei as the old one, so the build is compared
+                stale = json.load(f)["store_version"] != store_version(store)
+        except (OSError, ValueError, KeyError):
+            stale = True
+        if stale:
+            build_index(store)
+            logging.info(f"Built spatial index for {file_id_name} ({len(store)} nuclei) "
+                         f"in {time.time() - start_time:.1f} seconds")
+        index = SpatialIndex(store)
+        _cache[file_id_name] = (os.path.getmtime(os.path.join(store.path, "meta.json")), index)
+        return index
+
+
+def roi_counts(index, rect=None, polygon=None, with_centroids=False, limit=None):
+    """Per-class counts (and optionally centroids) of the nuclei inside an ROI."""
+    ids = index.query(rect=rect, polygon=polygon)
+    counts = np.bincount(index.store.type[ids], minlength=len(CLASS_NAMES))
+    result = {"total": int(len(ids)), "counts": {name: int(counts[i]) for i, name in enumerate(CLASS_NAMES)}}
+    if with_centroids:
+        shown = ids if limit is None else ids[:limit]
+        result["centroids"] = np.asarray(index.store.centroid[shown]).round(1).tolist()
+        result["types"] = np.asarray(index.store.type[shown]).tolist()
+        result["truncated"] = len(shown) < len(ids)
+    return result
@@ -0,0 +1,91 @@
+import os, time, hashlib, logging
+import numpy as np
+
+# fitted stain matrices are kept here, one .npz per target image and method
+STAIN_CACHE_DIR = "./uploads/stain_cache"
+
+# normalizers already fitted (or restored) in this process
+_fitted_normalizers = {}
+
+
+def target_key(target_image, method):
+    """Cache key for a target image and normalization method."""
+    target_image = np.ascontiguousarray(target_image)
+    digest = hashlib.sha1()
+    digest.update(str(target_image.shape).encode())
+    digest.update(str(target_image.dtype).encode())
+    digest.update(target_image.tobytes())
+    return f"{method.lower()}_{digest.hexdigest()[:16]}"
+
+
+def _fitted_state(normalizer):
+    # everything fit() learns from the target is stored as arrays/numbers on the normalizer
+    state = {}
+    for name, value in vars(normalizer).items():
+        if isinstance(value, (np.ndarray, np.generic, int, float)) and not isinstance(value, bool):
+            state[name] = np.asarray(value)
+    return state
+
+
+def get_normalizer(method="Vahadane", target_image=None, cache_dir=STAIN_CACHE_DIR):
+    """Return a normalizer fitted on target_image, fitting at most once per target and method."""
+    # tiatoolbox loads slowly, so only processes that normalize pay for it
+    from tiatoolbox import data
+    from tiatoolbox.tools import stainnorm
+
+    if target_image is None:
+        target_image = data.stain_norm_target()
+
+    key = target_key(target_image, method)
+    if key in _fitted_normalizers:
+        return _fitted_normalizers[key]
+
+    normalizer = stainnorm.get_normalizer(method)
+    cache_path = os.path.join(cache_dir, f"{key}.npz")
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            for name in cached.files:
+                setattr(normalizer, name, cached[name])
+        logging.info(f"Loaded fitted {method} stain matrix from {cache_path}")
+    else:
+        fit_start = time.time()
+        normalizer.fit(target_image)
+        logging.info(f"Fitted {method} normalizer in {time.time() - fit_start:.2f} seconds")
+
+        # write to a temp file first so concurrent runs never read a half written cache
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **_fitted_state(normalizer))
+        os.replace(tmp_path, cache_path)
+
+    _fitted_normalizers[key] = normalizer
+    return normalizer
+
+
+def transform_batch(normalizer, patches):
+    """Normalize a batch of RGB patches with an already fitted normalizer."""
+    return [normalizer.transform(patch.copy()) for patch in patches]
+
+
+class SlideStainTransform:
+    """Per-patch transform with the source stain matrix fitted once on a slide sample.
+
+    Same maths as normalizer.transform(), but the source side is estimated once
+    for the whole slide instead of on every patch, so patches stay consistent
+    with each other and the per-patch cost is a few matrix products. Plain
+    attributes only, so it pickles into data loader workers.
+    """
+
+    def __init__(self, normalizer, source_sample):
+        self.get_concentrations = type(normalizer).get_concentrations
+        self.stain_matrix_source = normalizer.extractor.get_stain_matrix(source_sample)
+        source_concentrations = self.get_concentrations(source_sample, self.stain_matrix_source)
+        max_c_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+        self.scale = normalizer.maxC_target / max_c_source
+        self.stain_matrix_target = normalizer.stain_matrix_target
+
+    def __call__(self, img):
+        concentrations = self.get_concentrations(img[..., :3], self.stain_matrix_source) * self.scale
+        trans = 255 * np.exp(-1 * np.dot(concentrations, self.stain_matrix_target))
+        return np.clip(trans, 0, 255).reshape(img.shape[:2] + (3,)).astype(np.uint8)
@@ -0,0 +1,28 @@
+import os
+import numpy as np
+
+
+def write_cells(codec):
+    import tile_store
+
+    with tile_store.TileStoreWriter(tile_store.store_path("s_Vaha"), codec) as store:
+        store.add(0, 0, np.zeros((8, 8, 3), dtype=np.uint8))
+
+
+def test_repatching_invalidates_the_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import predict
+    import tile_store
+
+    write_cells("png")
+    result_dir = "uploads/s_Vaha/result"
+    predict.reset_checkpoint(result_dir, tile_store.cell_digest("s_Vaha"))
+    with open(os.path.join(result_dir, "tmp.dat"), "wb") as f:
+        f.write(b"dat")
+    predict.record_completed(result_dir, "s_Vaha_0_0", os.path.join(result_dir, "tmp.dat"))
+    assert predict.pending_tiles(["uploads/s_Vaha/cell/s_Vaha_0_0.png"], result_dir) == []
+    assert predict.checkpoint_source(result_dir) == tile_store.cell_digest("s_Vaha")
+
+    # patch again with another codec, the segmentation of the old pixels must not be reused
+    write_cells("raw")
+    assert predict.checkpoint_source(result_dir) != tile_store.cell_digest("s_Vaha")
@@ -0,0 +1,19 @@
+import os
+
+
+def test_truncated_tile_store_is_uncacheable(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import result_cache
+
+    os.makedirs("uploads/s_Vaha")
+    with open("uploads/s_Vaha/patches_info_s_Vaha.csv", "w") as f:
+        f.write("Tile\n")
+    with open("uploads/s_Vaha/cell_s_Vaha.tiles", "wb") as f:
+        f.write(b"TIATILE1")  # shorter than the footer
+
+    assert result_cache.input_digest("predict", "s_Vaha") is result_cache.UNCACHEABLE
+    calls = []
+    result = result_cache.run_cached("predict", "slide.svs", "s_Vaha", {"mode": "tile"},
+                                     lambda: calls.append(1) or {"success": True})
+    assert result == {"success": True} and calls == [1]
+    assert not os.path.exists(result_cache.CACHE_DIR)
@@ -0,0 +1,6 @@
+def test_failed_stage_exits_non_zero(tmp_path, monkeypatch):
+    # the result cache only stores outputs of stages that exit 0
+    monkeypatch.chdir(tmp_path)
+    import tia
+
+    assert tia.main(["patch", str(tmp_path / "missing.bif")]) == 1
@@ -0,0 +1,20 @@
+import pytest
+
+import tuning
+
+
+def threads(settings):
+    return settings["torch_threads"] + settings["num_loader_workers"] + settings["num_postproc_workers"]
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+@pytest.mark.parametrize("cpus", [1, 2, 3, 4, 5, 8, 32])
+def test_default_settings_stay_within_the_reservation(device, cpus):
+    settings = tuning.default_settings(device, cpus)
+    assert threads(settings) <= cpus
+    assert settings["torch_threads"] >= 1
+
+
+def test_small_reservations_share_one_worker():
+    assert tuning.split_cores(1, 1, 1) == (0, 0, 1)
+    assert tuning.split_cores(2, 2, 4) == (1, 0, 1)
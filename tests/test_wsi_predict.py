@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+
+
+class FakeReader:
+    """Slide with tissue in its top-left quarter, grey noise on white."""
+
+    def __init__(self, width=4096, height=3072):
+        self.dimensions = (width, height)
+        rng = np.random.default_rng(0)
+        self.pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+        self.pixels[:height // 2, :width // 2] = rng.integers(60, 200, (height // 2, width // 2, 3))
+
+    def read_region(self, x, y, width, height, level=0):
+        return self.pixels[y:y + height, x:x + width]
+
+    def read_thumbnail(self, downsample):
+        return self.pixels[::downsample, ::downsample], (downsample, downsample)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class SetupDone(Exception):
+    pass
+
+
+@pytest.fixture
+def wsi_predict(tmp_path, monkeypatch):
+    # predict.py creates its log directory on import
+    monkeypatch.chdir(tmp_path)
+    import wsi_predict
+
+    return wsi_predict
+
+
+def test_tissue_mask_and_stain_sample(wsi_predict, tmp_path):
+    import patch
+
+    reader = FakeReader()
+    cells = wsi_predict.write_tissue_mask(reader, str(tmp_path / "mask.png"), threshold_std=5)
+    assert cells.shape == (3072 // patch.patch_size, 4096 // patch.patch_size)
+    assert cells[0, 0] and not cells[-1, -1]
+    assert os.path.exists(tmp_path / "mask.png")
+
+    sample = wsi_predict.stain_sample(reader, cells)
+    assert sample.shape[1:] == (wsi_predict.STAIN_SAMPLE_SIZE, 3)
+
+
+def test_predict_wsi_reaches_the_segmentor(wsi_predict, monkeypatch):
+    import predict
+    import stain
+
+    monkeypatch.setattr(wsi_predict, "open_slide", lambda file_path: FakeReader())
+    monkeypatch.setattr(stain, "get_normalizer", lambda method: object())
+
+    def prepare_segmentor(overrides, segmentor):
+        raise SetupDone(overrides)
+
+    monkeypatch.setattr(predict, "prepare_segmentor", prepare_segmentor)
+    with pytest.raises(SetupDone):
+        wsi_predict.predict_wsi("slide.svs", "slide_Vaha", overrides={"device": "cpu"})
+    assert os.path.exists("uploads/slide_Vaha/tissue_mask.png")
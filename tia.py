@@ -0,0 +1,245 @@
+"""One command line for the pipeline stages.
+
+    python tia.py patch <slide> [--workers N] [--threshold-std T] ...
+    python tia.py predict <slide> [--mode tile|wsi] [--device auto|cuda|cpu] ...
+    python tia.py count <slide> [--no-overlays] [--workers N]
+    python tia.py merge <slide> [--scale S] [--pyramid dzi|tiff]
+    python tia.py process <slide> [--save-patches] [--no-overlays] ...
+    python tia.py store <file_id_name>
+    python tia.py --profile-imports merge <slide>
+
+Only the standard library is imported up front. A command imports its
+stage module when it runs, and the stage modules import torch, tiatoolbox,
+OpenSlide or zarr only in the functions that need them, so usage errors and
+the count and merge paths start without them. --profile-imports reruns the
+command under -X importtime and prints the import time per package afterwards.
+"""
+import os, sys, time, argparse, subprocess
+import pyramid
+import tile_store
+
+_start_time = time.perf_counter()
+
+# packages listed by --profile-imports
+PROFILE_TOP = 20
+MERGE_BACKGROUNDS = ["thumbnail", "white"]
+
+
+def file_id_name_of(file_path):
+    # same naming the stage scripts use for uploads/<file_id_name>/
+    return f"{os.path.splitext(os.path.basename(file_path))[0]}_Vaha"
+
+
+def ready(command):
+    """Note how long the command took to get past its imports, when profiling."""
+    if os.environ.get("TIA_PROFILE_IMPORTS"):
+        print(f"tia {command}: ready after {time.perf_counter() - _start_time:.3f} s", file=sys.stderr)
+
+
+def run_patch(args):
+    if args.workers < 1:
+        print("--workers must be at least 1")
+        sys.exit(1)
+    if not 1 <= args.quality <= 100:
+        print("--quality must be between 1 and 100")
+        sys.exit(1)
+    import patch
+
+    ready("patch")
+    # patch and merge log their errors and report them in the return value
+    ok = patch.main(args.file_path, workers=args.workers, threshold_std=args.threshold_std,
+               mask_threshold=args.mask_threshold, use_tissue_mask=not args.no_tissue_mask,
+               save_blank=args.save_blank, codec=args.codec, quality=args.quality)
+    return 0 if ok else 1
+
+
+def run_predict(args):
+    import predict
+
+    ready("predict")
+    ok = predict.main(args.file_path, overrides={
+        "device": args.device,
+        "batch_size": args.batch_size,
+        "num_loader_workers": args.loader_workers,
+        "num_postproc_workers": args.postproc_workers,
+        "torch_threads": args.torch_threads,
+        "cpus": args.cpus,
+    }, mode=args.mode, overlays=not args.no_overlays, count_workers=args.count_workers)
+    return 0 if ok else 1
+
+
+def run_count(args):
+    if args.workers is not None and args.workers < 1:
+        print("--workers must be at least 1")
+        sys.exit(1)
+    import predict
+
+    ready("count")
+    predict.cellsCount(file_id_name_of(args.file_path), overlays=not args.no_overlays, workers=args.workers)
+    return 0
+
+
+def run_merge(args):
+    if args.scale is not None and not 0 < args.scale <= 1:
+        print("--scale must be in (0, 1]")
+        sys.exit(1)
+    import merge
+
+    ready("merge")
+    ok = merge.main(args.file_path, background=args.background,
+               scale=merge.MERGE_SCALE if args.scale is None else args.scale, pyramid_format=args.pyramid)
+    return 0 if ok else 1
+
+
+def run_process(args):
+    import pipeline
+
+    ready("process")
+    try:
+        pipeline.main(args.file_path, threshold_std=args.threshold_std, save_patches=args.save_patches,
+                      render_overlays=not args.no_overlays, norm_workers=max(1, args.norm_workers),
+                      batch_size=max(1, args.batch_size), queue_size=max(1, args.queue_size),
+                      overrides={"device": args.device, "cpus": args.cpus})
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return 1
+    return 0
+
+
+def run_store(args):
+    import nucleus_store
+
+    ready("store")
+    path = nucleus_store.convert_tile_dats(args.file_id_name, nucleus_store.tile_dat_pairs(args.file_id_name))
+    print(f"Wrote {len(nucleus_store.NucleusStore(path))} nuclei to {path}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tia.py", usage="python tia.py [--profile-imports] <command> ...")
+    parser.add_argument("--profile-imports", action="store_true",
+                        help="report the import time per package once the command has run")
+    commands = parser.add_subparsers(dest="command", metavar="command", required=True, prog="python tia.py")
+
+    patch = commands.add_parser("patch", help="cut the slide into tissue patches",
+                                usage="python tia.py patch <filepath> [--workers N] [--threshold-std T] [--mask-threshold M] [--no-tissue-mask] [--save-blank] [--codec raw|png|jpeg]")
+    patch.add_argument("file_path")
+    patch.add_argument("--workers", type=int, default=1,
+                       help="number of worker processes reading the slide (default: 1)")
+    patch.add_argument("--threshold-std", type=float, default=5,
+                       help="mean channel std above which a level-0 patch counts as cell (default: 5)")
+    patch.add_argument("--mask-threshold", type=float, default=None,
+                       help="channel std above which a thumbnail pixel counts as tissue (default: threshold-std / 2)")
+    patch.add_argument("--no-tissue-mask", action="store_true",
+                       help="read every grid cell at level 0 instead of skipping background")
+    patch.add_argument("--save-blank", action="store_true",
+                       help="also write blank patches as PNGs to blank/ (merge does not need them)")
+    patch.add_argument("--codec", choices=tile_store.CODECS, default=tile_store.DEFAULT_CODEC,
+                       help=f"how cell patches are stored in the tile store (default: {tile_store.DEFAULT_CODEC})")
+    patch.add_argument("--quality", type=int, default=tile_store.DEFAULT_QUALITY,
+                       help=f"jpeg quality (default: {tile_store.DEFAULT_QUALITY})")
+    patch.set_defaults(run=run_patch)
+
+    predict = commands.add_parser("predict", help="segment nuclei, then count them",
+                                  usage="python tia.py predict <file_path> [--device auto|cuda|cpu] [--batch-size N] ...")
+    predict.add_argument("file_path")
+    predict.add_argument("--device", default="auto", help="cuda, cpu or auto (default: auto)")
+    predict.add_argument("--batch-size", type=int, default=None, help="skip calibration and use this batch size")
+    predict.add_argument("--loader-workers", type=int, default=None)
+    predict.add_argument("--postproc-workers", type=int, default=None)
+    predict.add_argument("--torch-threads", type=int, default=None)
+    predict.add_argument("--mode", choices=["tile", "wsi"], default="tile",
+                         help="tile: segment the PNG patches, wsi: segment the slide inside its tissue mask")
+    predict.add_argument("--no-overlays", action="store_true", help="only write nucleus_info_*.csv, skip the overlays")
+    predict.add_argument("--count-workers", type=int, default=None,
+                         help="processes rendering overlays (default: --cpus, else available cores)")
+    predict.add_argument("--cpus", type=int, default=None,
+                         help="cores the stage may use, split between torch, its workers and counting (default: all)")
+    predict.set_defaults(run=run_predict)
+
+    count = commands.add_parser("count", help="count segmented nuclei and render the overlays",
+                                usage="python tia.py count <file_path> [--no-overlays] [--workers N]")
+    count.add_argument("file_path")
+    count.add_argument("--no-overlays", action="store_true", help="only write nucleus_info_*.csv, skip the overlays")
+    count.add_argument("--workers", type=int, default=None,
+                       help="processes rendering overlays (default: available cores)")
+    count.set_defaults(run=run_count)
+
+    merge = commands.add_parser("merge", help="merge the overlays into one image and optional pyramid",
+                                usage="python tia.py merge <filepath> [--background thumbnail|white] [--scale S] [--pyramid dzi|tiff]")
+    merge.add_argument("file_path")
+    merge.add_argument("--background", choices=MERGE_BACKGROUNDS, default="thumbnail",
+                       help="how blank cells are filled when blank/ has no tiles (default: thumbnail)")
+    merge.add_argument("--scale", type=float, default=None,
+                       help="output size relative to the slide (default: MERGE_SCALE in merge.py)")
+    merge.add_argument("--pyramid", choices=pyramid.PYRAMID_FORMATS, default=None,
+                       help="also write the full-resolution overlay as a deep-zoom pyramid")
+    merge.set_defaults(run=run_merge)
+
+    process = commands.add_parser("process", help="patch, normalize, segment and count in one streaming run",
+                                  usage="python tia.py process <filepath> [--save-patches] [--no-overlays] [--norm-workers N] [--batch-size N]")
+    process.add_argument("file_path")
+    process.add_argument("--save-patches", action="store_true",
+                         help="also write the normalized cell patches to the cell tile store")
+    process.add_argument("--no-overlays", action="store_true",
+                         help="skip rendering overlays (merge needs them)")
+    process.add_argument("--threshold-std", type=float, default=5)
+    process.add_argument("--norm-workers", type=int, default=2,
+                         help="stain normalization threads (default: 2)")
+    process.add_argument("--batch-size", type=int, default=16,
+                         help="tiles handed to the segmentor at once (default: 16)")
+    process.add_argument("--queue-size", type=int, default=32,
+                         help="tiles buffered between stages (default: 32)")
+    process.add_argument("--device", default="auto", help="cuda, cpu or auto (default: auto)")
+    process.add_argument("--cpus", type=int, default=None,
+                         help="cores the segmentor may use, split between torch and its workers (default: all)")
+    process.set_defaults(run=run_process)
+
+    store = commands.add_parser("store", help="convert a slide's tile .dat files into the nucleus store",
+                                usage="python tia.py store <file_id_name>")
+    store.add_argument("file_id_name")
+    store.set_defaults(run=run_store)
+    return parser
+
+
+def profile_imports(argv):
+    """Run the command under -X importtime, passing its output through, then list the slowest packages."""
+    command = [sys.executable, "-X", "importtime", os.path.abspath(__file__)] + argv
+    process = subprocess.Popen(command, stderr=subprocess.PIPE, text=True,
+                               env=dict(os.environ, TIA_PROFILE_IMPORTS="1"))
+    packages = {}  # top-level package -> [own import seconds of its modules, modules imported]
+    for line in process.stderr:
+        if not line.startswith("import time:"):
+            sys.stderr.write(line)
+            continue
+        try:
+            self_us, _, name = line[len("import time:"):].split("|")
+            self_us = int(self_us)
+        except ValueError:
+            continue  # the header line
+        # self times add up to the whole import time, so each package is charged only for its own modules
+        totals = packages.setdefault(name.strip().split(".")[0], [0.0, 0])
+        totals[0] += self_us / 1e6
+        totals[1] += 1
+    returncode = process.wait()
+
+    total = sum(seconds for seconds, _ in packages.values())
+    print(f"\nImport time by package, {total:.3f} s in total:", file=sys.stderr)
+    print(f"{'package':<32}{'seconds':>10}{'modules':>10}", file=sys.stderr)
+    ranked = sorted(packages.items(), key=lambda item: item[1][0], reverse=True)
+    for package, (seconds, count) in ranked[:PROFILE_TOP]:
+        print(f"{package:<32}{seconds:>10.3f}{count:>10}", file=sys.stderr)
+    return returncode
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = build_parser().parse_args(argv)
+    if args.profile_imports:
+        return profile_imports([arg for arg in argv if arg != "--profile-imports"])
+    # a stage that fails exits non-zero, so callers (and the result cache) never take its outputs as done
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
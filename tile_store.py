@@ -0,0 +1,262 @@
+"""Single-file tile stores: every patch (or overlay) of a slide in one file.
+
+uploads/<file_id_name>/<kind>_<file_id_name>.tiles holds the encoded tiles
+back to back, followed by a JSON index of (x, y) -> offset, length and shape,
+the index length and a magic number:
+
+    MAGIC | tile | tile | ... | index json | u64 index length | MAGIC
+
+Codecs: "raw" stores the pixels as they are, page aligned, so a read is a
+view into the memory-mapped file; "png" is lossless at the fastest zlib
+level; "jpeg" is lossy at the store's quality. Readers map the file once and
+look tiles up by their level-0 (x, y), so a slide costs one inode and one
+open instead of thousands. Slides processed before the stores keep their
+tiles as PNGs in uploads/<file_id_name>/<kind>/; a slide has one or the
+other, and writing a store removes the PNG directory it replaces.
+"""
+import os, json, shutil, struct, hashlib, threading
+
+MAGIC = b"TIATILE1"
+FOOTER = struct.Struct("<Q8s")
+CODECS = ["raw", "png", "jpeg"]
+DEFAULT_CODEC = os.environ.get('TILE_CODEC', "png")
+DEFAULT_QUALITY = 90
+PNG_COMPRESSION = 1
+# raw tiles start on a page boundary so their views map whole pages
+RAW_ALIGNMENT = 4096
+
+
+def store_path(file_id_name, kind="cell"):
+    return f"./uploads/{file_id_name}/{kind}_{file_id_name}.tiles"
+
+
+def legacy_dir(file_id_name, kind="cell"):
+    """Directory of the per-tile PNGs a store of this kind replaces."""
+    return f"./uploads/{file_id_name}/{kind}"
+
+
+def scratch_root():
+    # scratch tiles for the segmentor live in RAM when /dev/shm exists
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _cv2_order(tile):
+    import cv2
+
+    if tile.ndim == 3 and tile.shape[2] == 3:
+        return cv2.cvtColor(tile, cv2.COLOR_RGB2BGR)
+    if tile.ndim == 3 and tile.shape[2] == 4:
+        return cv2.cvtColor(tile, cv2.COLOR_RGBA2BGRA)
+    return tile
+
+
+def encode_tile(tile, codec=DEFAULT_CODEC, quality=DEFAULT_QUALITY):
+    """Encoded bytes of an RGB(A) uint8 tile."""
+    import cv2
+    import numpy as np
+
+    tile = np.ascontiguousarray(tile, dtype=np.uint8)
+    if codec == "raw":
+        return tile.tobytes()
+    if codec == "png":
+        ok, data = cv2.imencode(".png", _cv2_order(tile), [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    elif codec == "jpeg":
+        if tile.ndim == 3 and tile.shape[2] == 4:
+            tile = tile[..., :3]
+        ok, data = cv2.imencode(".jpg", _cv2_order(tile), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        raise ValueError(f"Unknown tile codec: {codec}")
+    if not ok:
+        raise ValueError(f"Could not encode a {tile.shape} tile as {codec}")
+    return data.tobytes()
+
+
+def decode_tile(data, codec, shape):
+    """RGB(A) uint8 array of an encoded tile, read-only for raw tiles."""
+    import cv2
+    import numpy as np
+
+    if codec == "raw":
+        return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    tile = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if tile is None:
+        raise ValueError("Corrupt tile in tile store")
+    if tile.ndim == 3 and tile.shape[2] == 3:
+        return cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+    if tile.ndim == 3 and tile.shape[2] == 4:
+        return cv2.cvtColor(tile, cv2.COLOR_BGRA2RGBA)
+    return tile
+
+
+class TileStoreWriter:
+    """Appends tiles to a new store, which replaces path on close(). Safe to share between threads.
+
+    replaces is a legacy PNG directory removed on close(), so readers never
+    pick stale PNGs (or a stale store) for the slide.
+    """
+
+    def __init__(self, path, codec=DEFAULT_CODEC, quality=DEFAULT_QUALITY, replaces=None):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {', '.join(CODECS)}")
+        self.path = path
+        self.replaces = replaces
+        self.codec = codec
+        self.quality = quality
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, x, y, tile):
+        self.add_encoded(x, y, encode_tile(tile, self.codec, self.quality), tile.shape)
+
+    def add_encoded(self, x, y, data, shape):
+        """Append a tile encoded with this store's codec, e.g. by encode_tile() in a pool worker."""
+        with self.lock:
+            offset = self.file.tell()
+            if self.codec == "raw" and offset % RAW_ALIGNMENT:
+                self.file.write(b"\0" * (RAW_ALIGNMENT - offset % RAW_ALIGNMENT))
+                offset = self.file.tell()
+            self.file.write(data)
+            self.entries[(int(x), int(y))] = [offset, len(data), *map(int, shape)]
+
+    def close(self):
+        index = json.dumps({
+            "codec": self.codec,
+            "quality": self.quality,
+            "tiles": [[x, y, *entry] for (x, y), entry in sorted(self.entries.items(), key=lambda e: e[0][::-1])],
+        }).encode()
+        self.file.write(index)
+        self.file.write(FOOTER.pack(len(index), MAGIC))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        if self.replaces:
+            shutil.rmtree(self.replaces, ignore_errors=True)
+        return self.path
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TileStore:
+    """Memory-mapped reader of a tile store, tiles looked up by their level-0 (x, y)."""
+
+    def __init__(self, path):
+        import mmap
+
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_length, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC or self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"Not a tile store: {path}")
+        index_end = len(self.map) - FOOTER.size
+        index = json.loads(self.map[index_end - index_length:index_end])
+        self.codec = index["codec"]
+        self.quality = index["quality"]
+        self.entries = {(x, y): (offset, length, tuple(shape)) for x, y, offset, length, *shape in index["tiles"]}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, xy):
+        return tuple(xy) in self.entries
+
+    def positions(self):
+        """(x, y) of every tile, row by row."""
+        return list(self.entries)
+
+    def shape(self, x, y):
+        return self.entries[(x, y)][2]
+
+    def encoded(self, x, y):
+        """The tile's encoded bytes as a view into the mapped file."""
+        offset, length, _ = self.entries[(x, y)]
+        return memoryview(self.map)[offset:offset + length]
+
+    def read(self, x, y):
+        return decode_tile(self.encoded(x, y), self.codec, self.shape(x, y))
+
+    def export_png(self, positions, out_dir, names):
+        """Write tiles as uncompressed PNGs for tools that only take paths, returns the paths."""
+        from PIL import Image
+
+        paths = []
+        for (x, y), name in zip(positions, names):
+            path = os.path.join(out_dir, f"{name}.png")
+            Image.fromarray(self.read(x, y)).save(path, compress_level=0)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # raw views handed out are still alive, the map goes with them
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_index(path):
+    """The raw JSON index bytes of a store, without mapping it."""
+    with open(path, "rb") as f:
+        f.seek(-FOOTER.size, os.SEEK_END)
+        index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a tile store: {path}")
+        f.seek(-FOOTER.size - index_length, os.SEEK_END)
+        return f.read(index_length)
+
+
+def cell_digest(file_id_name):
+    """Fingerprint of the slide's cell patches, changes whenever patch (or a cache restore) rewrites them."""
+    sha = hashlib.sha256()
+    path = store_path(file_id_name)
+    if os.path.exists(path):
+        sha.update(read_index(path))
+    else:
+        # legacy PNGs, by name, size and modification time
+        for tile_path in cell_tile_paths(file_id_name):
+            stat = os.stat(tile_path)
+            sha.update(f"{os.path.basename(tile_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+
+def open_store(file_id_name, kind="cell"):
+    """The slide's tile store of that kind, or None when it has none."""
+    path = store_path(file_id_name, kind)
+    return TileStore(path) if os.path.exists(path) else None
+
+
+def cell_tile_paths(file_id_name):
+    """cell/<tile>.png of every cell patch in natsorted order.
+
+    Patches in the slide's tile store have no file of their own, their path
+    only names them; predict.read_cell_tile() finds the pixels either way.
+    """
+    import glob
+    from natsort import natsorted
+
+    store = open_store(file_id_name)
+    if store is None:
+        return natsorted(glob.glob(f"./uploads/{file_id_name}/cell/*.png"))
+    with store:
+        return natsorted(f"./uploads/{file_id_name}/cell/{file_id_name}_{x}_{y}.png" for x, y in store.positions())
@@ -0,0 +1,55 @@
+import numpy as np
+from PIL import Image
+
+# thumbnail pixels per patch side, a 1024px patch is seen as roughly 16x16 pixels
+THUMBNAIL_PIXELS_PER_PATCH = 16
+
+
+def tissue_mask(thumbnail, mask_threshold):
+    """Pixel mask of tissue, using the same channel std statistic as the level-0 check."""
+    return np.std(thumbnail.astype(np.float32), axis=-1) > mask_threshold
+
+
+def grid_tissue_cells(mask, scale, img_width, img_height, patch_size, margin=1):
+    """Map a thumbnail tissue mask onto the patch grid.
+
+    Returns a (n_rows, n_cols) bool array, True where a grid cell touches tissue
+    (grown by `margin` thumbnail pixels so faint borders are not lost).
+    """
+    scale_x, scale_y = scale
+    mask_height, mask_width = mask.shape
+
+    # summed-area table, so every cell is counted with four lookups
+    integral = np.zeros((mask_height + 1, mask_width + 1), dtype=np.int64)
+    integral[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    xs = np.arange(0, img_width, patch_size)
+    ys = np.arange(0, img_height, patch_size)
+    x0 = np.clip(np.floor(xs / scale_x).astype(int) - margin, 0, mask_width)
+    x1 = np.clip(np.ceil(np.minimum(xs + patch_size, img_width) / scale_x).astype(int) + margin, 0, mask_width)
+    y0 = np.clip(np.floor(ys / scale_y).astype(int) - margin, 0, mask_height)
+    y1 = np.clip(np.ceil(np.minimum(ys + patch_size, img_height) / scale_y).astype(int) + margin, 0, mask_height)
+
+    counts = (integral[y1][:, x1] - integral[y0][:, x1]
+              - integral[y1][:, x0] + integral[y0][:, x0])
+    return counts > 0
+
+
+def detect_tissue_cells(reader, patch_size, mask_threshold):
+    """Read a thumbnail and return (grid of tissue cells, thumbnail, scale)."""
+    downsample = max(1, patch_size // THUMBNAIL_PIXELS_PER_PATCH)
+    thumbnail, scale = reader.read_thumbnail(downsample)
+    img_width, img_height = reader.dimensions
+    cells = grid_tissue_cells(tissue_mask(thumbnail, mask_threshold), scale, img_width, img_height, patch_size)
+    return cells, thumbnail, scale
+
+
+def background_patch(thumbnail, scale, x, y, width, height):
+    """Level-0 sized stand-in for a background patch, upsampled from the thumbnail."""
+    scale_x, scale_y = scale
+    left = min(int(x / scale_x), thumbnail.shape[1] - 1)
+    top = min(int(y / scale_y), thumbnail.shape[0] - 1)
+    right = max(left + 1, int(np.ceil((x + width) / scale_x)))
+    bottom = max(top + 1, int(np.ceil((y + height) / scale_y)))
+    crop = np.ascontiguousarray(thumbnail[top:bottom, left:right])
+    return np.asarray(Image.fromarray(crop).resize((width, height), Image.BILINEAR))
@@ -0,0 +1,161 @@
+"""Device selection and throughput tuning for the nucleus segmentor.
+
+resolve_settings() picks the device, loader/post-processing workers, torch
+threads and batch size from the machine (or from the cores the job queue
+reserved for the stage), optionally times a few batch sizes on real tiles,
+and lets any value be overridden. The calibration result is
+cached per machine shape so it is only paid once.
+"""
+import os, json, time, shutil, logging, tempfile
+
+TUNING_CACHE = "./uploads/logs/tuning.json"
+
+# batch sizes tried by the calibration pass
+CALIBRATION_BATCH_SIZES = [2, 4, 8, 16]
+# rough host memory one HoVerNet-fast input patch needs in a CPU batch (activations + buffers)
+CPU_BYTES_PER_SAMPLE = 400 * 1024 ** 2
+# largest CPU batch defaults and calibration pick, admission.py reserves memory for it
+CPU_MAX_BATCH_SIZE = 8
+GPU_DEFAULT_BATCH_SIZE = 4
+
+SETTING_NAMES = ["device", "batch_size", "num_loader_workers", "num_postproc_workers", "torch_threads"]
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """Bytes of memory available to new allocations."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def cpu_batch_cap():
+    return max(1, int(available_memory() * 0.5 // CPU_BYTES_PER_SAMPLE))
+
+
+def select_device(requested=None):
+    import torch
+
+    if requested and requested != "auto":
+        return requested
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def cpu_max_batch_size():
+    return min(CPU_MAX_BATCH_SIZE, cpu_batch_cap())
+
+
+def split_cores(cores, side_workers, max_torch_threads):
+    """(loader workers, post-processing workers, torch threads), together at most cores."""
+    if cores < 3:
+        # a single worker loads, post-processing runs in the engine's process (0 workers)
+        return min(1, cores - 1), 0, 1
+    side_workers = min(side_workers, (cores - 1) // 2)
+    return side_workers, side_workers, max(1, min(max_torch_threads, cores - 2 * side_workers))
+
+
+def default_settings(device, cores=None):
+    """Settings that keep the model and its workers within cores (default: every available core)."""
+    cores = max(1, cores or available_cores())
+    if device == "cpu":
+        # loaders and post-processing each get a quarter of the cores, the model the rest
+        loader_workers, postproc_workers, torch_threads = split_cores(cores, max(1, min(8, cores // 4)), cores)
+        batch_size = cpu_max_batch_size()
+    else:
+        loader_workers, postproc_workers, torch_threads = split_cores(cores, max(2, min(8, cores // 4)), 4)
+        batch_size = GPU_DEFAULT_BATCH_SIZE
+    return {
+        "device": device,
+        "batch_size": batch_size,
+        "num_loader_workers": loader_workers,
+        "num_postproc_workers": postproc_workers,
+        "torch_threads": torch_threads,
+    }
+
+
+def apply_settings(segmentor, settings):
+    """Point an existing segmentor (and torch) at the given settings."""
+    import torch
+
+    torch.set_num_threads(settings["torch_threads"])
+    segmentor.batch_size = settings["batch_size"]
+    segmentor.num_loader_workers = settings["num_loader_workers"]
+    segmentor.num_postproc_workers = settings["num_postproc_workers"]
+
+
+def _cache_key(settings):
+    return f"{settings['device']}:{available_cores()}:{settings['num_loader_workers']}"
+
+
+def calibrate(segmentor, settings, sample_tiles):
+    """Time the candidate batch sizes on sample tiles, returns the fastest."""
+    max_batch = cpu_max_batch_size() if settings["device"] == "cpu" else max(CALIBRATION_BATCH_SIZES)
+    candidates = [b for b in CALIBRATION_BATCH_SIZES if b <= max_batch] or [1]
+    scratch_dir = tempfile.mkdtemp(prefix="calibrate_")
+    results = {}
+    try:
+        for run, batch_size in enumerate([candidates[0]] + candidates):
+            apply_settings(segmentor, dict(settings, batch_size=batch_size))
+            start_time = time.time()
+            segmentor.predict(sample_tiles, save_dir=os.path.join(scratch_dir, str(run)), mode="tile",
+                              device=settings["device"], crash_on_exception=True)
+            if run > 0:  # the first run only warms up the model and allocator
+                results[batch_size] = len(sample_tiles) / (time.time() - start_time)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    for batch_size, tiles_per_sec in results.items():
+        logging.info(f"Calibration batch_size={batch_size}: {tiles_per_sec:.3f} tiles/sec")
+    return max(results, key=results.get)
+
+
+def _load_cache():
+    try:
+        with open(TUNING_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    os.makedirs(os.path.dirname(TUNING_CACHE), exist_ok=True)
+    with open(TUNING_CACHE, "w") as f:
+        json.dump(cache, f, indent=2)
+
+
+def resolve_settings(overrides=None, segmentor=None, sample_tiles=None):
+    """Settings to run with: machine defaults, then calibration, then explicit overrides.
+
+    Calibration needs a built segmentor and sample tiles, and is skipped when
+    the batch size is overridden or a cached result exists for this machine.
+    overrides["cpus"] is the stage's core reservation, the defaults are split within it.
+    """
+    overrides = {k: v for k, v in (overrides or {}).items() if v is not None}
+    cpus = overrides.pop("cpus", None)
+    settings = default_settings(select_device(overrides.get("device")), cpus)
+    settings.update({k: v for k, v in overrides.items() if k != "device"})
+
+    if "batch_size" not in overrides:
+        cache = _load_cache()
+        key = _cache_key(settings)
+        if key in cache:
+            # entries calibrated before the CPU cap may be larger than admission reserved for
+            settings["batch_size"] = cache[key] if settings["device"] != "cpu" else min(cache[key], cpu_max_batch_size())
+        elif segmentor is not None and sample_tiles:
+            settings["batch_size"] = calibrate(segmentor, settings, sample_tiles)
+            cache[key] = settings["batch_size"]
+            _save_cache(cache)
+
+    logging.info("Inference settings: " + ", ".join(f"{name}={settings[name]}" for name in SETTING_NAMES))
+    return settings
@@ -0,0 +1,107 @@
+"""Whole-slide HoVerNet inference driven by a tissue mask.
+
+Instead of segmenting the PNG tiles patch.py wrote, the segmentor runs in
+mode="wsi" straight on the slide: tiatoolbox streams patches from the
+pyramid, only inside the tissue mask, with stain normalization applied on
+the fly, and nuclei crossing tile borders are merged rather than cut.
+The result is one slide-level instance store, nuclei_<id>.dat, with nuclei
+in level-0 coordinates, and converted into the columnar nucleus store
+(nucleus_store.py) that nucleus_info_<id>.csv is counted from.
+"""
+import os, time, shutil, logging
+import numpy as np
+from PIL import Image
+
+import stain
+import tissue
+import patch
+import predict
+import nucleus_store
+import metrics
+from progress import Progress
+from slide_reader import open_slide
+
+# level-0 regions sampled to estimate the slide's own stain matrix
+STAIN_SAMPLE_REGIONS = 16
+STAIN_SAMPLE_SIZE = 512
+
+
+def slide_store_path(file_id_name):
+    return f"./uploads/{file_id_name}/nuclei_{file_id_name}.dat"
+
+
+def write_tissue_mask(reader, mask_path, threshold_std):
+    """Save the thumbnail tissue mask as a PNG the segmentor can read, returns the grid cells with tissue."""
+    cells, thumbnail, _ = tissue.detect_tissue_cells(reader, patch.patch_size, threshold_std / 2)
+    mask = tissue.tissue_mask(thumbnail, threshold_std / 2)
+    Image.fromarray(mask.astype(np.uint8) * 255).save(mask_path)
+    return cells
+
+
+def stain_sample(reader, tissue_cells, seed=0):
+    """Mosaic of level-0 regions from tissue cells, used to fit the slide's stain matrix once."""
+    rows, cols = np.nonzero(tissue_cells)
+    if len(rows) == 0:
+        raise ValueError("No tissue found in slide")
+    picks = np.random.default_rng(seed).choice(len(rows), size=min(STAIN_SAMPLE_REGIONS, len(rows)), replace=False)
+    # regions are shifted back inside the slide, so edge cells and slides smaller than a region still count
+    img_width, img_height = reader.dimensions
+    width, height = min(STAIN_SAMPLE_SIZE, img_width), min(STAIN_SAMPLE_SIZE, img_height)
+    regions = []
+    for i in picks:
+        x = min(int(cols[i]) * patch.patch_size, img_width - width)
+        y = min(int(rows[i]) * patch.patch_size, img_height - height)
+        region = reader.read_region(x, y, width, height)
+        if region.shape[:2] == (height, width):
+            regions.append(region)
+    if not regions:
+        raise ValueError("No tissue found in slide")
+    return np.concatenate(regions, axis=0)
+
+
+def predict_wsi(file_path, file_id_name, segmentor=None, overrides=None, threshold_std=5):
+    """Segment a whole slide inside its tissue mask, returns the number of nuclei found."""
+    out_dir = f"./uploads/{file_id_name}"
+    work_dir = os.path.join(out_dir, "wsi_work")
+    os.makedirs(out_dir, exist_ok=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+
+    start_time = time.time()
+    mask_path = os.path.join(out_dir, "tissue_mask.png")
+    with open_slide(file_path) as reader:
+        tissue_cells = write_tissue_mask(reader, mask_path, threshold_std)
+        sample = stain_sample(reader, tissue_cells)
+
+    # stain normalization inside the data loader, with the source matrix fitted once for the slide
+    normalizer = stain.get_normalizer(patch.stain_method)
+    inst_segmentor, settings = predict.prepare_segmentor(overrides, segmentor)
+    previous_preproc = inst_segmentor.model.preproc_func
+    inst_segmentor.model.preproc_func = stain.SlideStainTransform(normalizer, sample)
+    logging.info(f"Tissue mask and stain fit for {file_id_name} in {time.time() - start_time:.1f} seconds")
+
+    try:
+        with metrics.stage("predict_wsi", file_id_name) as event:
+            # the engine runs the whole slide in one call, so only the tissue total is known up front
+            progress = Progress("predict_wsi", file_id_name, total=int(tissue_cells.sum()))
+            outputs = inst_segmentor.predict([file_path], masks=[mask_path], save_dir=os.path.join(work_dir, "out"),
+                                             mode="wsi", device=settings["device"], crash_on_exception=True)
+            # patch grid cells with tissue, the units tile mode would have segmented
+            event.add(tiles=int(tissue_cells.sum()))
+            progress.finish(done=int(tissue_cells.sum()))
+    finally:
+        # a warm segmentor is shared with tile mode jobs
+        inst_segmentor.model.preproc_func = previous_preproc
+
+    _, save_path = outputs[0]
+    store_path = slide_store_path(file_id_name)
+    os.replace(predict.output_dat_path(save_path), store_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    # columnar store with nuclei bucketed into the patch grid, the csv is counted from it
+    with metrics.stage("count", file_id_name) as event:
+        store = nucleus_store.NucleusStore(nucleus_store.convert_slide_dat(file_id_name, store_path, patch.patch_size))
+        total_counts = predict.write_counts(file_id_name, store=store)
+        event.add(tiles=len(store.tiles), nuclei=len(store))
+    logging.info(f"WSI prediction of {file_id_name}: {len(store)} nuclei in {time.time() - start_time:.1f} seconds")
+    return sum(total_counts.values())